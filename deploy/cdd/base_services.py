@@ -11,6 +11,10 @@ from aws_cdk import (
     aws_cognito as cognito,
     aws_apigateway as apigateway,
     aws_iot as iot,
+    aws_kinesis as kinesis,
+    aws_lambda_event_sources as event_sources,
+    aws_events as events,
+    aws_events_targets as targets,
     core,
 )
 
@@ -33,7 +37,7 @@ def add_cors_options(api_resource):
             {
                 "statusCode": "200",
                 "responseParameters": {
-                    "method.response.header.Access-Control-Allow-Headers": "'Content-Type,X-Amz-Date,Authorization,X-Api-Key,X-Amz-Security-Token,X-Amz-User-Agent'",
+                    "method.response.header.Access-Control-Allow-Headers": "'Content-Type,X-Amz-Date,Authorization,X-Api-Key,X-Amz-Security-Token,X-Amz-User-Agent,Idempotency-Key'",
                     "method.response.header.Access-Control-Allow-Origin": "'*'",
                     # "method.response.header.Access-Control-Allow-Credentials": "'true'",
                     "method.response.header.Access-Control-Allow-Methods": "'OPTIONS,GET,PUT,POST,DELETE'",
@@ -86,6 +90,13 @@ class CddBase(core.Stack):
         admin_password: str,
         cloud9_instance_size: str,
         participant_limit: str,
+        cert_pool_size: str = "0",
+        cert_pool_refill_threshold: str = "0",
+        password_policy_mode: str = "stack",
+        event_ingestion_mode: str = "batched",
+        event_retention_days: str = "30",
+        credit_mode: str = "atomic",
+        dispense_mode: str = "shadow",
         **kwargs,
     ) -> None:
         super().__init__(scope, id, **kwargs)
@@ -171,16 +182,71 @@ class CddBase(core.Stack):
             billing_mode=dynamodb.BillingMode.PAY_PER_REQUEST,
             removal_policy=core.RemovalPolicy.DESTROY,
         )
+        dispenser_db.add_global_secondary_index(
+            # Sparse, only records with an in-flight request, see cdd_common/request_slots.py
+            index_name="InFlight",
+            partition_key={"name": "inFlight", "type": dynamodb.AttributeType.STRING},
+            sort_key={"name": "inFlightExpiresAt", "type": dynamodb.AttributeType.NUMBER},
+            projection_type=dynamodb.ProjectionType.INCLUDE,
+            non_key_attributes=["requests"],
+        )
         dispenser_events = dynamodb.Table(
-            # Recorded events from dispenser actions
+            # Recorded events from dispenser actions, schema in cdd_common/events.py
             self,
-            "DispenserEvents",
-            table_name=id + "-DispenserEvents",
+            "DispenserEventLog",
+            table_name=id + "-DispenserEventLog",
+            partition_key={"name": "pk", "type": dynamodb.AttributeType.STRING},
+            sort_key={"name": "ts", "type": dynamodb.AttributeType.NUMBER},
+            time_to_live_attribute="expiresAt",
+            billing_mode=dynamodb.BillingMode.PAY_PER_REQUEST,
+            removal_policy=core.RemovalPolicy.DESTROY,
+        )
+        dispenser_events.add_global_secondary_index(
+            # Events of all dispensers in time order, by day and shard
+            index_name="ByTime",
+            partition_key={"name": "timeBucket", "type": dynamodb.AttributeType.STRING},
+            sort_key={"name": "ts", "type": dynamodb.AttributeType.NUMBER},
+        )
+        dispenser_events.add_global_secondary_index(
+            # Sparse, the events of each dispense request by its id
+            index_name="ByRequest",
+            partition_key={"name": "requestId", "type": dynamodb.AttributeType.STRING},
+            sort_key={"name": "ts", "type": dynamodb.AttributeType.NUMBER},
+        )
+        # Environment of the functions writing the event log
+        event_log_environment = {
+            "EVENT_TABLE": dispenser_events.table_name,
+            "EVENT_TTL_DAYS": event_retention_days,
+        }
+
+        idempotency_db = dynamodb.Table(
+            # Idempotency-Key of API requests and their responses, see cdd_common/idempotency.py
+            self,
+            "IdempotencyTable",
+            table_name=id + "-IdempotencyTable",
+            partition_key={
+                "name": "idempotencyKey",
+                "type": dynamodb.AttributeType.STRING,
+            },
+            billing_mode=dynamodb.BillingMode.PAY_PER_REQUEST,
+            removal_policy=core.RemovalPolicy.DESTROY,
+            time_to_live_attribute="expiresAt",
+        )
+        # Environment of the API functions taking an Idempotency-Key
+        idempotency_environment = {
+            "IDEMPOTENCY_TABLE": idempotency_db.table_name,
+            # Seconds a key and its response are kept
+            "IDEMPOTENCY_TTL": "600",
+        }
+        cert_pool_db = dynamodb.Table(
+            # Pre-generated IoT certificates for the next dispenser ids
+            self,
+            "CertificatePool",
+            table_name=id + "-CertificatePool",
             partition_key={
                 "name": "dispenserId",
                 "type": dynamodb.AttributeType.STRING,
             },
-            sort_key={"name": "timestamp", "type": dynamodb.AttributeType.STRING},
             billing_mode=dynamodb.BillingMode.PAY_PER_REQUEST,
             removal_policy=core.RemovalPolicy.DESTROY,
         )
@@ -493,6 +559,8 @@ class CddBase(core.Stack):
                             resources=[
                                 f"arn:aws:dynamodb:{stack.region}:{stack.account}:table/{dispenser_db.table_name}",
                                 f"arn:aws:dynamodb:{stack.region}:{stack.account}:table/{dispenser_events.table_name}",
+                                f"arn:aws:dynamodb:{stack.region}:{stack.account}:table/{dispenser_events.table_name}/index/*",
+                                f"arn:aws:dynamodb:{stack.region}:{stack.account}:table/{idempotency_db.table_name}",
                                 f"arn:aws:dynamodb:{stack.region}:{stack.account}:table/{user_db.table_name}",
                             ],
                         ),
@@ -522,6 +590,7 @@ class CddBase(core.Stack):
                             resources=[
                                 f"arn:aws:dynamodb:{stack.region}:{stack.account}:table/{dispenser_db.table_name}",
                                 f"arn:aws:dynamodb:{stack.region}:{stack.account}:table/{dispenser_events.table_name}",
+                                f"arn:aws:dynamodb:{stack.region}:{stack.account}:table/{dispenser_events.table_name}/index/*",
                                 f"arn:aws:dynamodb:{stack.region}:{stack.account}:table/{user_db.table_name}",
                             ],
                         ),
@@ -565,7 +634,10 @@ class CddBase(core.Stack):
                             actions=["dynamodb:*"],
                             resources=[
                                 f"arn:aws:dynamodb:{stack.region}:{stack.account}:table/{dispenser_db.table_name}",
+                                f"arn:aws:dynamodb:{stack.region}:{stack.account}:table/{dispenser_db.table_name}/index/*",
                                 f"arn:aws:dynamodb:{stack.region}:{stack.account}:table/{dispenser_events.table_name}",
+                                f"arn:aws:dynamodb:{stack.region}:{stack.account}:table/{dispenser_events.table_name}/index/*",
+                                f"arn:aws:dynamodb:{stack.region}:{stack.account}:table/{idempotency_db.table_name}",
                             ],
                         ),
                         iam.PolicyStatement(actions=["iot:*"], resources=["*"]),
@@ -599,6 +671,7 @@ class CddBase(core.Stack):
                         "Resource": [
                             f"arn:aws:iot:{stack.region}:{stack.account}:topicfilter/$aws/things/${{iot:Certificate.Subject.CommonName}}/shadow/*",
                             f"arn:aws:iot:{stack.region}:{stack.account}:topicfilter/$aws/things/${{iot:Certificate.Subject.CommonName}}/cmd/${{iot:Certificate.Subject.CommonName}}",
+                            f"arn:aws:iot:{stack.region}:{stack.account}:topicfilter/cmd/${{iot:Certificate.Subject.CommonName}}",
                         ],
                     },
                     {
@@ -639,21 +712,80 @@ class CddBase(core.Stack):
         )
 
         ### Lambda Functions
+        # Layer with code shared by the functions (cdd_common package)
+        cdd_common_layer = lambda_.LayerVersion(
+            self,
+            "CddCommonLayer",
+            layer_version_name=id + "-CddCommon",
+            code=lambda_.AssetCode("./lambda_layers/cdd_common"),
+            compatible_runtimes=[lambda_.Runtime.PYTHON_3_7],
+            description="Shared clients, responses and helpers for CDD functions",
+        )
+        # Layer with cryptography (and dependencies) for IoT key and CSR generation
+        crypto_layer = lambda_.LayerVersion(
+            self,
+            "CryptoLayer",
+            layer_version_name=id + "-Crypto",
+            code=lambda_.AssetCode("./lambda_layers/crypto"),
+            compatible_runtimes=[lambda_.Runtime.PYTHON_3_7],
+            description="cryptography, cffi, asn1crypto, pycparser and six",
+        )
+
         # General Lambda Functions NOT associated with APIG
         lambda_process_events = lambda_.Function(
             self,
             "ProcessEvents",
             function_name=id + "-ProcessEvents",
             code=lambda_.AssetCode("./lambda_functions/process_events"),
+            layers=[cdd_common_layer],
             handler="process_events.handler",
             runtime=lambda_.Runtime.PYTHON_3_7,
             role=lambda_iot_full_access_role,
             timeout=core.Duration.seconds(20),
             environment={
-                "EVENT_TABLE": dispenser_events.table_name,
-                "STATUS_TABLE": dispenser_db.table_name,
+                **event_log_environment,
+                "DISPENSER_TABLE": dispenser_db.table_name,
             },
         )
+        if event_ingestion_mode == "batched":
+            # The logging IoT rules put messages on a stream, and process_events
+            # writes them to the event table in batches
+            event_stream = kinesis.Stream(
+                self, "DispenserEventStream", shard_count=1
+            )
+            iot_event_stream_role = iam.Role(
+                self,
+                "IoTEventStreamRole",
+                assumed_by=iam.ServicePrincipal("iot.amazonaws.com"),
+            )
+            event_stream.grant_write(iot_event_stream_role)
+            lambda_process_events.add_event_source(
+                event_sources.KinesisEventSource(
+                    event_stream,
+                    starting_position=lambda_.StartingPosition.LATEST,
+                    batch_size=500,
+                    # A batch that keeps failing is split to isolate the
+                    # failing records and then skipped, rather than holding
+                    # up the shard until its records expire
+                    bisect_batch_on_error=True,
+                    retry_attempts=5,
+                    max_record_age=core.Duration.hours(1),
+                )
+            )
+            # Partition by topic, so each dispenser's events stay in order
+            log_event_action = iot.CfnTopicRule.ActionProperty(
+                kinesis=iot.CfnTopicRule.KinesisActionProperty(
+                    role_arn=iot_event_stream_role.role_arn,
+                    stream_name=event_stream.stream_name,
+                    partition_key="${topic()}",
+                )
+            )
+        else:
+            log_event_action = iot.CfnTopicRule.ActionProperty(
+                lambda_=iot.CfnTopicRule.LambdaActionProperty(
+                    function_arn=lambda_process_events.function_arn
+                )
+            )
 
         ## API Lambda functions
         # Return credit for dispenser
@@ -662,6 +794,7 @@ class CddBase(core.Stack):
             "ApiCreditDispenserFunction",
             function_name=id + "-ApiCreditDispenserFunction",
             code=lambda_.AssetCode("./lambda_functions/api_credit_dispenser"),
+            layers=[cdd_common_layer],
             handler="credit_dispenser.handler",
             runtime=lambda_.Runtime.PYTHON_3_7,
             role=lambda_api_app_role,
@@ -669,7 +802,14 @@ class CddBase(core.Stack):
             memory_size=128,
             environment={
                 "DISPENSER_TABLE": dispenser_db.table_name,
-                "EVENT_TABLE": dispenser_events.table_name,
+                **event_log_environment,
+                "CREDIT_MODE": credit_mode,
+                # Per caller limits, see api_credit_dispenser/rate_limit.py
+                "CREDIT_RATE": "0.5",
+                "CREDIT_BURST": "5",
+                "CREDIT_PAIR_LIMIT": "4",
+                "CREDIT_PAIR_WINDOW": "60",
+                **idempotency_environment,
             },
         )
         # Command
@@ -678,6 +818,7 @@ class CddBase(core.Stack):
             "ApiCommandFunction",
             function_name=id + "-ApiCommandFunction",
             code=lambda_.AssetCode("./lambda_functions/api_command"),
+            layers=[cdd_common_layer],
             handler="command.handler",
             runtime=lambda_.Runtime.PYTHON_3_7,
             role=lambda_api_app_role,
@@ -686,6 +827,7 @@ class CddBase(core.Stack):
             environment={
                 "DispenserTable": dispenser_db.table_name,
                 "EventTable": dispenser_events.table_name,
+                "DISPENSER_TABLE": dispenser_db.table_name,
             },
         )
         # Request dispense operation (set shadow or command to dispense)
@@ -694,6 +836,7 @@ class CddBase(core.Stack):
             "ApiDispenseFunction",
             function_name=id + "-ApiDispenseFunction",
             code=lambda_.AssetCode("./lambda_functions/api_dispense"),
+            layers=[cdd_common_layer],
             handler="dispense.handler",
             runtime=lambda_.Runtime.PYTHON_3_7,
             role=lambda_api_dispense_role,
@@ -701,7 +844,11 @@ class CddBase(core.Stack):
             memory_size=128,
             environment={
                 "DISPENSER_TABLE": dispenser_db.table_name,
-                "EVENT_TABLE": dispenser_events.table_name,
+                **event_log_environment,
+                **idempotency_environment,
+                # See api_dispense/dispense.py
+                "DISPENSE_MODE": dispense_mode,
+                "METRIC_NAMESPACE": id,
             },
         )
         # Request dispense operation (set shadow or command to dispense)
@@ -710,42 +857,177 @@ class CddBase(core.Stack):
             "ApiDispenserStatusFunction",
             function_name=id + "-ApiDispenserStatusFunction",
             code=lambda_.AssetCode("./lambda_functions/api_dispenser_status"),
+            layers=[cdd_common_layer],
             handler="dispenser_status.handler",
             runtime=lambda_.Runtime.PYTHON_3_7,
             role=lambda_api_app_role,
             timeout=core.Duration.seconds(15),
             memory_size=128,
-            environment={"DISPENSER_TABLE": dispenser_db.table_name},
+            environment={
+                "DISPENSER_TABLE": dispenser_db.table_name,
+                # Seconds before the status projection is refreshed from the shadow
+                "STATUS_MAX_AGE": "3600",
+            },
+        )
+        # Return a page of dispenser event history
+        api_get_events_function = lambda_.Function(
+            self,
+            "ApiGetEventsFunction",
+            function_name=id + "-ApiGetEventsFunction",
+            code=lambda_.AssetCode("./lambda_functions/api_get_events"),
+            layers=[cdd_common_layer],
+            handler="get_events.handler",
+            runtime=lambda_.Runtime.PYTHON_3_7,
+            role=lambda_api_app_role,
+            timeout=core.Duration.seconds(15),
+            memory_size=128,
+            environment=event_log_environment,
         )
-        # Request user details from user table, create resources if needed
+        # Provisioning worker, creates the resources for a user as an asynchronous
+        # job started by /getResources, or for many users when invoked directly
         # NOTE: This uses an overley permissive policy to create the resources needed
-        api_get_resources_function = lambda_.Function(
+        provisioning_worker_function = lambda_.Function(
             self,
-            "ApiGetResourcesFunction",
-            function_name=id + "-ApiGetResourcesFunction",
+            "ProvisioningWorkerFunction",
+            function_name=id + "-ProvisioningWorkerFunction",
             code=lambda_.AssetCode("./lambda_functions/api_get_resources"),
-            handler="get_resources.handler",
+            layers=[cdd_common_layer, crypto_layer],
+            handler="provisioning_job.handler",
             runtime=lambda_.Runtime.PYTHON_3_7,
             role=lambda_full_access_role,
             # Timeout is for user creation: certain tasks such as Cloud9 may take longer
-            timeout=core.Duration.seconds(300),
-            memory_size=128,
+            timeout=core.Duration.seconds(900),
+            # Provisioning steps run on a worker pool, more memory is more CPU
+            # for concurrent key generation in bulk mode
+            memory_size=512,
+            # A failed job is restarted by the next call to /getResources
+            retry_attempts=0,
             environment={
                 "DISPENSER_TABLE": dispenser_db.table_name,
-                "EVENT_TABLE": dispenser_events.table_name,
+                **event_log_environment,
                 "USER_TABLE": user_db.table_name,
                 "USER_PERMISSIONS_GROUP": user_group.group_name,
                 "IOT_POLICY_DISPENSER_LIMITED": iot_policy_dispenser_limited.policy_name,
                 "IOT_POLICY_CLIENT": iot_policy_client.policy_name,
                 "CLOUD9_INSTANCE_SIZE": cloud9_instance_size,
+                "PROVISIONING_WORKERS": "8",
+                "CERT_POOL_TABLE": cert_pool_db.table_name,
+                "PASSWORD_POLICY_MODE": password_policy_mode,
+            },
+        )
+        # Request user details from user table, start provisioning job if needed
+        api_get_resources_function = lambda_.Function(
+            self,
+            "ApiGetResourcesFunction",
+            function_name=id + "-ApiGetResourcesFunction",
+            code=lambda_.AssetCode("./lambda_functions/api_get_resources"),
+            layers=[cdd_common_layer],
+            handler="get_resources.handler",
+            runtime=lambda_.Runtime.PYTHON_3_7,
+            role=lambda_full_access_role,
+            timeout=core.Duration.seconds(28),
+            memory_size=128,
+            environment={
+                "USER_TABLE": user_db.table_name,
+                "PROVISIONING_FUNCTION": provisioning_worker_function.function_name,
+            },
+        )
+        # Keep the certificate pool filled, the initial fill and the delete of
+        # unclaimed certificates on stack delete is by the custom resource below
+        cert_pool_environment = {
+            "CERT_POOL_TABLE": cert_pool_db.table_name,
+            "USER_TABLE": user_db.table_name,
+            "CERT_POOL_SIZE": cert_pool_size,
+            "CERT_POOL_REFILL_THRESHOLD": cert_pool_refill_threshold,
+        }
+        cert_pool_statements = [
+            iam.PolicyStatement(
+                actions=["dynamodb:*"],
+                resources=[
+                    f"arn:aws:dynamodb:{stack.region}:{stack.account}:table/{cert_pool_db.table_name}",
+                    f"arn:aws:dynamodb:{stack.region}:{stack.account}:table/{user_db.table_name}",
+                ],
+            ),
+            iam.PolicyStatement(
+                actions=[
+                    "iot:CreateCertificateFromCsr",
+                    "iot:UpdateCertificate",
+                    "iot:DeleteCertificate",
+                ],
+                resources=["*"],
+            ),
+        ]
+        lambda_cert_pool_role = iam.Role(
+            self,
+            "CertPoolRole",
+            assumed_by=iam.ServicePrincipal("lambda.amazonaws.com"),
+            inline_policies=[
+                iam.PolicyDocument(
+                    statements=[
+                        iam.PolicyStatement(
+                            actions=[
+                                "logs:CreateLogGroup",
+                                "logs:CreateLogStream",
+                                "logs:PutLogEvents",
+                            ],
+                            resources=["arn:aws:logs:*:*:*"],
+                        ),
+                        *cert_pool_statements,
+                    ]
+                )
+            ],
+        )
+        cert_pool_refill_function = lambda_.Function(
+            self,
+            "CertPoolRefillFunction",
+            function_name=id + "-CertPoolRefillFunction",
+            code=lambda_.AssetCode("./lambda_functions/cert_pool"),
+            layers=[cdd_common_layer, crypto_layer],
+            handler="cert_pool.handler",
+            runtime=lambda_.Runtime.PYTHON_3_7,
+            role=lambda_cert_pool_role,
+            timeout=core.Duration.seconds(300),
+            memory_size=512,
+            environment=cert_pool_environment,
+        )
+        events.Rule(
+            self,
+            "CertPoolRefillSchedule",
+            schedule=events.Schedule.rate(core.Duration.minutes(1)),
+            targets=[targets.LambdaFunction(cert_pool_refill_function)],
+            enabled=int(cert_pool_size) > 0,
+        )
+        # Clear dispense requests the dispensers did not respond to
+        sweep_requests_function = lambda_.Function(
+            self,
+            "SweepRequestsFunction",
+            function_name=id + "-SweepRequestsFunction",
+            code=lambda_.AssetCode("./lambda_functions/sweep_requests"),
+            layers=[cdd_common_layer],
+            handler="sweep_requests.handler",
+            runtime=lambda_.Runtime.PYTHON_3_7,
+            role=lambda_api_dispense_role,
+            timeout=core.Duration.seconds(60),
+            memory_size=128,
+            environment={
+                "DISPENSER_TABLE": dispenser_db.table_name,
+                **event_log_environment,
+                "METRIC_NAMESPACE": id,
             },
         )
+        events.Rule(
+            self,
+            "SweepRequestsSchedule",
+            schedule=events.Schedule.rate(core.Duration.minutes(1)),
+            targets=[targets.LambdaFunction(sweep_requests_function)],
+        )
         # Request user details from user table
         api_delete_user_function = lambda_.Function(
             self,
             "ApiDeleteUserFunction",
             function_name=id + "-ApiDeleteUserFunction",
             code=lambda_.AssetCode("./lambda_functions/api_delete_user"),
+            layers=[cdd_common_layer],
             handler="delete_user.handler",
             runtime=lambda_.Runtime.PYTHON_3_7,
             role=lambda_api_delete_user_role,
@@ -753,7 +1035,7 @@ class CddBase(core.Stack):
             memory_size=256,
             environment={
                 "DISPENSER_TABLE": dispenser_db.table_name,
-                "EVENT_TABLE": dispenser_events.table_name,
+                **event_log_environment,
                 "USER_TABLE": user_db.table_name,
                 "USER_POOL_ID": user_pool.user_pool_id,
             },
@@ -805,6 +1087,14 @@ class CddBase(core.Stack):
             authorization_type=apigateway.AuthorizationType.COGNITO,
             authorizer=cog_authorizer,
         )
+        # List of commands in the body, see api_command/command.py
+        add_resource_method(
+            api_command_resource,
+            http_method="POST",
+            integration=apigateway.LambdaIntegration(api_command_function),
+            authorization_type=apigateway.AuthorizationType.COGNITO,
+            authorizer=cog_authorizer,
+        )
         add_cors_options(api_command_resource)
         # Actuate dispenser
         api_dispense_resource = api.root.add_resource("dispense")
@@ -826,6 +1116,16 @@ class CddBase(core.Stack):
             authorizer=cog_authorizer,
         )
         add_cors_options(api_dispenser_status_resource)
+        # Return a page of dispenser event history (from DynamoDB)
+        api_events_resource = api.root.add_resource("events")
+        add_resource_method(
+            api_events_resource,
+            http_method="GET",
+            integration=apigateway.LambdaIntegration(api_get_events_function),
+            authorization_type=apigateway.AuthorizationType.COGNITO,
+            authorizer=cog_authorizer,
+        )
+        add_cors_options(api_events_resource)
         # Return user details from User Table
         api_get_resources_resource = api.root.add_resource("getResources")
         add_resource_method(
@@ -903,21 +1203,16 @@ class CddBase(core.Stack):
                 rule_disabled=False,
                 aws_iot_sql_version="2016-03-23",
                 sql="select *, topic() AS topic FROM '$aws/things/+/shadow/update/documents'",
-                actions=[
-                    iot.CfnTopicRule.ActionProperty(
-                        lambda_=iot.CfnTopicRule.LambdaActionProperty(
-                            function_arn=lambda_process_events.function_arn
-                        )
-                    )
-                ],
+                actions=[log_event_action],
             ),
         )
-        # Allow rule to invoke the logging function
-        lambda_process_events.add_permission(
-            "AllowIoTRule1",
-            principal=iam.ServicePrincipal("iot.amazonaws.com"),
-            source_arn=iot_rule_log_shadow_events.attr_arn,
-        )
+        if event_ingestion_mode != "batched":
+            # Allow rule to invoke the logging function
+            lambda_process_events.add_permission(
+                "AllowIoTRule1",
+                principal=iam.ServicePrincipal("iot.amazonaws.com"),
+                source_arn=iot_rule_log_shadow_events.attr_arn,
+            )
         # Rule to process generic events and send to logging
         iot_rule_log_generic_events = iot.CfnTopicRule(
             self,
@@ -928,21 +1223,16 @@ class CddBase(core.Stack):
                 rule_disabled=False,
                 aws_iot_sql_version="2016-03-23",
                 sql="select *, timestamp() AS ts, topic() AS topic FROM 'events'",
-                actions=[
-                    iot.CfnTopicRule.ActionProperty(
-                        lambda_=iot.CfnTopicRule.LambdaActionProperty(
-                            function_arn=lambda_process_events.function_arn
-                        )
-                    )
-                ],
+                actions=[log_event_action],
             ),
         )
-        # Allow generic_events rule to Invoke the process_events function
-        lambda_process_events.add_permission(
-            "AllowIoTRule2",
-            principal=iam.ServicePrincipal("iot.amazonaws.com"),
-            source_arn=iot_rule_log_generic_events.attr_arn,
-        )
+        if event_ingestion_mode != "batched":
+            # Allow generic_events rule to Invoke the process_events function
+            lambda_process_events.add_permission(
+                "AllowIoTRule2",
+                principal=iam.ServicePrincipal("iot.amazonaws.com"),
+                source_arn=iot_rule_log_generic_events.attr_arn,
+            )
         # Rule to process dispenser specific events and send to logging
         iot_rule_log_dispenser_events = iot.CfnTopicRule(
             self,
@@ -953,21 +1243,16 @@ class CddBase(core.Stack):
                 rule_disabled=False,
                 aws_iot_sql_version="2016-03-23",
                 sql="select *, timestamp() AS ts, topic() AS topic FROM 'events/+'",
-                actions=[
-                    iot.CfnTopicRule.ActionProperty(
-                        lambda_=iot.CfnTopicRule.LambdaActionProperty(
-                            function_arn=lambda_process_events.function_arn
-                        )
-                    )
-                ],
+                actions=[log_event_action],
             ),
         )
-        # Allow log_dispenser_events rule to Invoke the process_events function
-        lambda_process_events.add_permission(
-            "AllowIoTRule3",
-            principal=iam.ServicePrincipal("iot.amazonaws.com"),
-            source_arn=iot_rule_log_dispenser_events.attr_arn,
-        )
+        if event_ingestion_mode != "batched":
+            # Allow log_dispenser_events rule to Invoke the process_events function
+            lambda_process_events.add_permission(
+                "AllowIoTRule3",
+                principal=iam.ServicePrincipal("iot.amazonaws.com"),
+                source_arn=iot_rule_log_dispenser_events.attr_arn,
+            )
         # Rule to process cmd/NNN/response WHERE "command=dispense"
         iot_rule_command_response_dispense = iot.CfnTopicRule(
             self,
@@ -977,7 +1262,7 @@ class CddBase(core.Stack):
                 description="Invoke Lambda to process dispense commands from dispenser",
                 rule_disabled=False,
                 aws_iot_sql_version="2016-03-23",
-                sql="select *, topic() AS topic FROM '$aws/things/+/shadow/update/accepted' WHERE isUndefined(state.reported.response) = False",
+                sql="select *, topic() AS topic, timestamp() AS receivedAt FROM '$aws/things/+/shadow/update/accepted' WHERE isUndefined(state.reported.response) = False",
                 actions=[
                     iot.CfnTopicRule.ActionProperty(
                         lambda_=iot.CfnTopicRule.LambdaActionProperty(
@@ -993,6 +1278,71 @@ class CddBase(core.Stack):
             principal=iam.ServicePrincipal("iot.amazonaws.com"),
             source_arn=iot_rule_command_response_dispense.attr_arn,
         )
+        # Rule to process cmd/NNN/response, the responses in "command" dispense mode
+        iot_rule_command_topic_response_dispense = iot.CfnTopicRule(
+            self,
+            "DispenseCommandTopicResponseRule",
+            rule_name=id.replace("-", "") + "_DispenseCommandTopicResponse",
+            topic_rule_payload=iot.CfnTopicRule.TopicRulePayloadProperty(
+                description="Invoke Lambda to process dispense command responses published by dispenser",
+                rule_disabled=False,
+                aws_iot_sql_version="2016-03-23",
+                sql="select *, topic() AS topic, timestamp() AS receivedAt FROM 'cmd/+/response' WHERE command = 'dispense'",
+                actions=[
+                    iot.CfnTopicRule.ActionProperty(
+                        lambda_=iot.CfnTopicRule.LambdaActionProperty(
+                            function_arn=api_dispense_function.function_arn
+                        )
+                    )
+                ],
+            ),
+        )
+        api_dispense_function.add_permission(
+            "AllowIoTCommandTopicResponseRule",
+            principal=iam.ServicePrincipal("iot.amazonaws.com"),
+            source_arn=iot_rule_command_topic_response_dispense.attr_arn,
+        )
+
+        # Custom resource to fill the certificate pool on deploy and delete the
+        # unclaimed certificates on stack delete
+        props: CustomResourceProps = CustomResourceProps(
+            name=id + "-CR-CertificatePool",
+            lambda_directory="./lambda_functions/cert_pool",
+            handler="cert_pool.main",
+            timeout=900,
+            runtime=lambda_.Runtime.PYTHON_3_7,
+            environment=cert_pool_environment,
+            layers=[cdd_common_layer, crypto_layer],
+        )
+        cert_pool_cr = CustomResourceConstruct(self, "CertificatePoolFill", props)
+        cert_pool_cr.resource.node.add_dependency(cert_pool_db)
+        cert_pool_cr.resource.node.add_dependency(user_db)
+        for statement in cert_pool_statements:
+            cert_pool_cr.add_policy_to_role(statement)
+
+        # Custom resource to apply the workshop IAM password policy for the life
+        # of the stack, and restore the account's policy on stack delete. Otherwise
+        # provisioning relaxes the policy around each IAM user's creation.
+        if password_policy_mode == "stack":
+            props: CustomResourceProps = CustomResourceProps(
+                name=id + "-CR-WorkshopPasswordPolicy",
+                lambda_directory="./lambda_functions/cr_password_policy",
+                handler="index.main",
+                timeout=60,
+                runtime=lambda_.Runtime.PYTHON_3_7,
+                layers=[cdd_common_layer],
+            )
+            password_policy_cr = CustomResourceConstruct(
+                self, "WorkshopPasswordPolicy", props
+            )
+            policy_statement = iam.PolicyStatement()
+            policy_statement.add_actions(
+                "iam:GetAccountPasswordPolicy",
+                "iam:UpdateAccountPasswordPolicy",
+                "iam:DeleteAccountPasswordPolicy",
+            )
+            policy_statement.add_resources("*")
+            password_policy_cr.add_policy_to_role(policy_statement)
 
         # Custom resource to delete workshop users - run to clean up any lingering ones
         # if the admin user didn't clean up. A lot of dependsOn as users are created with bindings
@@ -19,7 +19,8 @@ class MyStack(core.Stack):
             timeout=30,                         # max execution in seconds
             runtime=lambda_.Runtime.PYTHON_3_7, # Runtime value from aws_lambda
             resource_properties={"foo": "bar"}, # ?Dictionary of resourceproperties as part of Properties object
-            environment={"FOO": "bar"}          # ?Dictionary of environment variables passed to Lambda
+            environment={"FOO": "bar"},         # ?Dictionary of environment variables passed to Lambda
+            layers=[my_layer]                   # ?List of Lambda layers for the function
         )
         resource = CustomResourceConstruct(self, "MyCustomResourceConstruct", props)
         resource.add_policy_to_role(aws_cdk.iam.PolicyStatement())
@@ -49,6 +50,7 @@ class CustomResourceProps(object):
         policy: iam.PolicyStatement = None,
         resource_properties: dict = None,
         environment: dict = None,
+        layers: list = None,
     ):
         self._name = name
         self._lambda_directory = lambda_directory
@@ -57,6 +59,7 @@ class CustomResourceProps(object):
         self._runtime = runtime
         self._resource_properties = resource_properties
         self._environment = environment
+        self._layers = layers
 
     @property
     def name(self) -> str:
@@ -86,6 +89,10 @@ class CustomResourceProps(object):
     def environment(self) -> dict:
         return self._environment
 
+    @property
+    def layers(self) -> list:
+        return self._layers
+
 
 class CustomResourceConstruct(core.Construct):
     def __init__(
@@ -100,6 +107,7 @@ class CustomResourceConstruct(core.Construct):
         runtime = props.runtime
         environment = props.environment
         resource_properties = props.resource_properties
+        layers = props.layers
         lambda_uuid = str(uuid.uuid5(uuid.NAMESPACE_DNS, name + handler))
 
         resource = cfn.CustomResource(
@@ -113,6 +121,7 @@ class CustomResourceConstruct(core.Construct):
                     function_name=name,
                     uuid=lambda_uuid,
                     code=lambda_.AssetCode(lambda_directory),
+                    layers=layers,
                     handler=handler,
                     timeout=core.Duration.seconds(timeout),
                     runtime=runtime,
@@ -132,6 +132,53 @@ if __name__ == "__main__":
         )
         sys.exit(1)
 
+    # Optional certificate pool settings, a pool size of 0 disables the pool
+    cert_pool_size = config.get("CertificatePoolSize", "0")
+    cert_pool_refill_threshold = config.get("CertificatePoolRefillThreshold", "0")
+    if not (
+        cert_pool_size.isdigit()
+        and cert_pool_refill_threshold.isdigit()
+        and int(cert_pool_refill_threshold) <= int(cert_pool_size)
+    ):
+        print(
+            f"CertificatePoolSize and CertificatePoolRefillThreshold must be whole numbers with the threshold no larger than the pool size"
+        )
+        sys.exit(1)
+
+    # Optional password policy mode, "stack" applies the workshop password policy
+    # for the life of the stack, "per_user" while each participant is created
+    password_policy_mode = config.get("PasswordPolicyMode", "stack")
+    if password_policy_mode not in ("stack", "per_user"):
+        print(f"PasswordPolicyMode must be either stack or per_user")
+        sys.exit(1)
+
+    # Optional event ingestion mode, "batched" buffers dispenser events on a
+    # Kinesis stream and writes them in batches, "direct" writes each on arrival
+    event_ingestion_mode = config.get("EventIngestionMode", "batched")
+    if event_ingestion_mode not in ("batched", "direct"):
+        print(f"EventIngestionMode must be either batched or direct")
+        sys.exit(1)
+
+    # Optional days dispenser events are kept in the event log
+    event_retention_days = config.get("EventRetentionDays", "30")
+    if not event_retention_days.isdigit() or int(event_retention_days) < 1:
+        print(f"EventRetentionDays must be a whole number of days")
+        sys.exit(1)
+
+    # Optional credit mode, "atomic" adds each credit with a single update,
+    # "ledger" also logs it to the event log in the same transaction
+    credit_mode = config.get("CreditMode", "atomic")
+    if credit_mode not in ("atomic", "ledger"):
+        print(f"CreditMode must be either atomic or ledger")
+        sys.exit(1)
+
+    # Optional dispense mode, "shadow" sends dispense requests through the
+    # device shadow, "command" publishes them to the dispenser's command topic
+    dispense_mode = config.get("DispenseMode", "shadow")
+    if dispense_mode not in ("shadow", "command"):
+        print(f"DispenseMode must be either shadow or command")
+        sys.exit(1)
+
     # Create app and resources
     app = core.App()
     base = CddBase(
@@ -144,6 +191,13 @@ if __name__ == "__main__":
         admin_password=config["AdminPassword"],
         cloud9_instance_size=config["Cloud9InstanceSize"],
         participant_limit=config["ParticipantLimit"],
+        cert_pool_size=cert_pool_size,
+        cert_pool_refill_threshold=cert_pool_refill_threshold,
+        password_policy_mode=password_policy_mode,
+        event_ingestion_mode=event_ingestion_mode,
+        event_retention_days=event_retention_days,
+        credit_mode=credit_mode,
+        dispense_mode=dispense_mode,
     )
 
     app.synth()
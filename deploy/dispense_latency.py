@@ -0,0 +1,212 @@
+#!/usr/bin/env python3
+"""
+Percentiles of the dispense stage durations from exported logs
+
+Reads the embedded metric format records the dispense function logs (see
+lambda_functions/api_dispense/dispense.py for the stages) from CloudWatch
+Logs exported to S3 (the .gz files), saved "aws logs filter-log-events"
+output, or any text with one record per line, and prints the percentiles of
+each stage per dispense mode:
+
+    $ aws s3 cp --recursive s3://my-bucket/exported-logs logs/
+    $ python3 dispense_latency.py logs/ --slowest 10
+
+The records of the API request and of the dispenser's response are joined
+by requestId, for the stages between them (DeviceReport, from the sentAt
+property of one to the receivedAt property of the other) and with
+--slowest to list the slowest dispenses with their stages.
+"""
+
+import argparse
+import gzip
+import json
+import math
+import sys
+from collections import defaultdict
+from pathlib import Path
+
+__copyright__ = (
+    "Copyright 2019 Amazon.com, Inc. or its affiliates. All Rights Reserved."
+)
+__license__ = "MIT-0"
+
+# Consecutive, in the order they happen
+STAGES = [
+    "ApiReceive",
+    "Reservation",
+    "RequestSend",
+    "DeviceReport",
+    "RuleDelivery",
+    "Reconciliation",
+    "Completion",
+]
+# Spanning several stages, listed after them
+TOTALS = ["ApiHandler", "DispenseLatency"]
+# Measured between the records of a request: stage: (start mark, end mark)
+JOINED_STAGES = {"DeviceReport": ("sentAt", "receivedAt")}
+
+
+def read_text(path):
+    if path.suffix == ".gz":
+        with gzip.open(path, "rt", encoding="utf-8") as f:
+            return f.read()
+    return path.read_text(encoding="utf-8")
+
+
+def messages(text):
+    """Log messages in text, the messages of filter-log-events output or
+    the lines"""
+
+    try:
+        document = json.loads(text)
+    except ValueError:
+        return text.splitlines()
+    if isinstance(document, dict) and "events" in document:
+        return [event["message"] for event in document["events"]]
+    return text.splitlines()
+
+
+def records(lines):
+    """Embedded metric format records in log lines, a line may start with a
+    timestamp or other prefix"""
+
+    decoder = json.JSONDecoder()
+    for line in lines:
+        start = line.find("{")
+        if start < 0:
+            continue
+        try:
+            record, _ = decoder.raw_decode(line, start)
+        except ValueError:
+            continue
+        if isinstance(record, dict) and "_aws" in record:
+            yield record
+
+
+def stage_values(record):
+    """(stage, milliseconds) of the metrics in a record"""
+    for directive in record["_aws"].get("CloudWatchMetrics", []):
+        for metric in directive.get("Metrics", []):
+            if metric.get("Unit") == "Milliseconds" and metric["Name"] in record:
+                yield metric["Name"], float(record[metric["Name"]])
+
+
+def joined_values(request_records):
+    """(stage, milliseconds) of JOINED_STAGES between the marks (epoch
+    milliseconds) of the records of one request"""
+
+    marks = {}
+    for record in request_records:
+        for start, end in JOINED_STAGES.values():
+            marks.update((name, float(record[name])) for name in (start, end) if name in record)
+    for stage, (start, end) in JOINED_STAGES.items():
+        if start in marks and end in marks:
+            yield stage, marks[end] - marks[start]
+
+
+def grouped(all_records):
+    """{requestId: [records]}"""
+    requests = defaultdict(list)
+    for record in all_records:
+        if "requestId" in record:
+            requests[record["requestId"]].append(record)
+    return requests
+
+
+def percentile(values, p):
+    """Nearest-rank percentile of sorted values"""
+    return values[max(0, math.ceil(p / 100 * len(values)) - 1)]
+
+
+def summarise(all_records):
+    """{mode: {stage: sorted milliseconds}}"""
+    durations = defaultdict(lambda: defaultdict(list))
+    for record in all_records:
+        for stage, value in stage_values(record):
+            durations[record.get("Mode", "-")][stage].append(value)
+    for request_records in grouped(all_records).values():
+        for stage, value in joined_values(request_records):
+            durations[request_records[0].get("Mode", "-")][stage].append(value)
+    for stages in durations.values():
+        for values in stages.values():
+            values.sort()
+    return durations
+
+
+def by_request(all_records):
+    """{requestId: {stage: milliseconds}} of the records of each request"""
+    requests = {}
+    for request_id, request_records in grouped(all_records).items():
+        stages = requests[request_id] = {}
+        for record in request_records:
+            stages.update(stage_values(record))
+        stages.update(joined_values(request_records))
+    return requests
+
+
+def stage_order(names):
+    known = [stage for stage in STAGES + TOTALS if stage in names]
+    return known + sorted(set(names) - set(known))
+
+
+def print_percentiles(durations, percentiles):
+    header = "".join(f"{f'p{p:g}':>10}" for p in percentiles)
+    for mode, stages in sorted(durations.items()):
+        print(f"Mode: {mode} (milliseconds)")
+        print(f"  {'stage':16}{'count':>8}{header}{'max':>10}")
+        for stage in stage_order(stages):
+            values = stages[stage]
+            columns = "".join(f"{percentile(values, p):10.1f}" for p in percentiles)
+            print(f"  {stage:16}{len(values):8}{columns}{values[-1]:10.1f}")
+
+
+def print_slowest(requests, count):
+    slowest = sorted(
+        (item for item in requests.items() if "DispenseLatency" in item[1]),
+        key=lambda item: item[1]["DispenseLatency"],
+        reverse=True,
+    )[:count]
+    print(f"Slowest {len(slowest)} dispenses (milliseconds)")
+    for request_id, stages in slowest:
+        parts = ", ".join(f"{stage} {stages[stage]:.1f}" for stage in stage_order(stages))
+        print(f"  {request_id}: {parts}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument(
+        "paths", nargs="*", type=Path, help="exported log files or directories (default stdin)"
+    )
+    parser.add_argument(
+        "--percentiles",
+        default="50,90,99",
+        help="comma separated percentiles (default 50,90,99)",
+    )
+    parser.add_argument(
+        "--slowest", type=int, default=0, help="list the N slowest dispenses"
+    )
+    args = parser.parse_args()
+
+    files = []
+    for path in args.paths:
+        files.extend(sorted(p for p in path.rglob("*") if p.is_file()) if path.is_dir() else [path])
+    lines = []
+    if files:
+        for path in files:
+            lines.extend(messages(read_text(path)))
+    else:
+        lines = messages(sys.stdin.read())
+
+    all_records = list(records(lines))
+    if not all_records:
+        print("No metric records found")
+        sys.exit(1)
+    print_percentiles(
+        summarise(all_records), [float(p) for p in args.percentiles.split(",")]
+    )
+    if args.slowest:
+        print_slowest(by_request(all_records), args.slowest)
+
+
+if __name__ == "__main__":
+    main()
@@ -1,5 +1,21 @@
 """
     Issue commands from application to interact with dispenser as an API call
+
+    POST a list of commands, which are validated against COMMAND_SCHEMA,
+    merged into one desired state document and written with a single
+    shadow update:
+
+        {"commands": [
+            {"command": "setLed", "value": "toggle"},
+            {"command": "setLedRing", "count": 4, "color": "#0000FF"},
+            {"command": "setDispenseTime", "value": 2500}
+        ]}
+
+    GET ?setLed=on|off|toggle is a single setLed command.
+
+    A toggle reads the shadow and makes the update conditional on the
+    shadow version read, retrying if another update got in between, so
+    concurrent toggles each flip the LED.
 """
 
 __copyright__ = (
@@ -7,91 +23,219 @@ __copyright__ = (
 )
 __license__ = "MIT-0"
 
-import boto3
 from botocore.exceptions import ClientError
+from decimal import Decimal
 import json
 import os
 import logging
+import re
+import time
+
+from cdd_common import clients, fanout
+from cdd_common.responses import http_response
 
 logger = logging.getLogger()
 logger.setLevel(logging.INFO)
 
 # Global Variables
 http_headers = {"Access-Control-Allow-Origin": "*"}
-valid_commands = ["setLed"]
-
-iot_data_client = boto3.client("iot-data")
-
-
-def http_response(headers, status_code, body):
-    """Create response dict for returning query"""
-    if type(body) != str:
-        if type(body) == dict:
-            body = json.dumps(body)
-        else:
-            body = "ERROR, invalid type of {} for body of return".format(type(body))
-            status_code = 500
-    return {"body": body, "headers": headers, "statusCode": status_code}
-
-
-def set_led(thing, state):
-    """Toggle or force on/off the led"""
-
-    # Read state value and set new state
-    if state == "toggle":
-        response = iot_data_client.get_thing_shadow(thingName=thing)
-        shadow = json.loads(response["payload"].read().decode("utf-8"))
-        led_current_state = "off"
-        if "reported" in shadow["state"]:
-            if "led" in shadow["state"]["reported"]:
-                led_current_state = shadow["state"]["reported"]["led"]
-        if led_current_state == "off":
-            led_new_state = "on"
-        else:
-            led_new_state = "off"
-    elif (state == "on") or (state == "off"):
-        led_new_state = state
-    else:
-        return http_response(
-            http_headers,
-            500,
-            'Command "setLed" must be set to "on", "off", or "toggle"',
+# Shadow updates lost to concurrent updates before a toggle gives up
+MAX_TOGGLE_ATTEMPTS = 5
+
+
+def one_of(*values):
+    def check(value):
+        return value in values, f"must be one of {', '.join(values)}"
+
+    return check
+
+
+def integer(minimum, maximum):
+    def check(value):
+        return (
+            isinstance(value, int)
+            and not isinstance(value, bool)
+            and minimum <= value <= maximum,
+            f"must be a whole number from {minimum} to {maximum}",
         )
 
-    shadow_payload = {"state": {"desired": {"led": led_new_state}}}
-    response = iot_data_client.update_thing_shadow(
-        thingName=thing, payload=json.dumps(shadow_payload)
+    return check
+
+
+def color(value):
+    return (
+        isinstance(value, str) and re.fullmatch(r"#[0-9A-Fa-f]{6}", value) is not None,
+        'must be a color such as "#00FF00"',
     )
-    return http_response(
-        http_headers,
-        200,
-        f'Led state "{led_new_state}" successfully put into device shadow',
+
+
+# Attributes of each command and their checks
+COMMAND_SCHEMA = {
+    "setLed": {"value": one_of("on", "off", "toggle")},
+    "setLedRing": {"count": integer(0, 8), "color": color},
+    "setDispenseTime": {"value": integer(500, 10000)},
+}
+valid_commands = list(COMMAND_SCHEMA)
+
+
+def validate(commands):
+    """Return the errors in a list of commands, empty if valid"""
+
+    if not isinstance(commands, list) or not commands:
+        return ['"commands" must be a non-empty list']
+    errors = []
+    for i, command in enumerate(commands):
+        name = command.get("command") if isinstance(command, dict) else None
+        if name not in COMMAND_SCHEMA:
+            errors.append(f"commands[{i}]: command must be one of {', '.join(valid_commands)}")
+            continue
+        schema = COMMAND_SCHEMA[name]
+        unknown = set(command) - set(schema) - {"command"}
+        if unknown:
+            errors.append(f"commands[{i}]: unknown attributes {', '.join(sorted(unknown))}")
+        for attribute, check in schema.items():
+            if attribute not in command:
+                errors.append(f"commands[{i}]: {name} requires {attribute}")
+                continue
+            valid, message = check(command[attribute])
+            if not valid:
+                errors.append(f"commands[{i}]: {name} {attribute} {message}")
+    return errors
+
+
+def desired_state(commands):
+    """Merge valid commands (later commands win) into a desired state
+    document, with "led": "toggle" if the LED is to be toggled"""
+
+    desired = {}
+    for command in commands:
+        if command["command"] == "setLed":
+            desired["led"] = command["value"]
+        elif command["command"] == "setLedRing":
+            desired["led_ring"] = {"count": command["count"], "color": command["color"]}
+        elif command["command"] == "setDispenseTime":
+            desired["dispense_time_ms"] = command["value"]
+    return desired
+
+
+def read_shadow(thing):
+    """The thing's shadow document, empty if it has no shadow yet"""
+    try:
+        response = clients.client("iot-data").get_thing_shadow(thingName=thing)
+    except ClientError as e:
+        if e.response["Error"]["Code"] != "ResourceNotFoundException":
+            raise
+        return {}
+    return json.loads(response["payload"].read().decode("utf-8"))
+
+
+def toggled(shadow):
+    """LED state opposite to the one last asked for (or reported)"""
+    state = shadow.get("state", {})
+    led_current_state = (
+        state.get("desired", {}).get("led") or state.get("reported", {}).get("led") or "off"
     )
+    return "on" if led_current_state == "off" else "off"
+
+
+def write_shadow(thing, desired):
+    """Write desired state in one shadow update, returns the desired state
+    written"""
+
+    if desired.get("led") != "toggle":
+        clients.client("iot-data").update_thing_shadow(
+            thingName=thing, payload=json.dumps({"state": {"desired": desired}})
+        )
+        return desired
+    for attempt in range(MAX_TOGGLE_ATTEMPTS):
+        shadow = read_shadow(thing)
+        written = {**desired, "led": toggled(shadow)}
+        payload = {"state": {"desired": written}}
+        if "version" in shadow:
+            payload["version"] = shadow["version"]
+        try:
+            clients.client("iot-data").update_thing_shadow(
+                thingName=thing, payload=json.dumps(payload)
+            )
+            return written
+        except ClientError as e:
+            if e.response["Error"]["Code"] != "ConflictException":
+                raise
+            logger.info(f"Shadow of {thing} updated since read, toggle attempt {attempt + 1}")
+    raise RuntimeError(f"Shadow of {thing} changing too often to toggle the LED")
+
+
+def record_led_ring(thing, led_ring):
+    """Keep the LED ring set by a command as the last written on the
+    dispenser record, so the next credit change restores the ring for the
+    credits (see cdd_common/led.py). Left alone while a credit change is
+    pending, that update writes the ring for the credits anyway."""
+
+    try:
+        clients.table(os.environ["DISPENSER_TABLE"]).update_item(
+            Key={"dispenserId": thing},
+            UpdateExpression="SET ledRing = :ring",
+            ConditionExpression=(
+                "attribute_exists(dispenserId) AND attribute_not_exists(ledRing.pendingUntil)"
+            ),
+            ExpressionAttributeValues={
+                ":ring": {**led_ring, "updatedAt": Decimal(str(round(time.time(), 6)))}
+            },
+        )
+    except ClientError as e:
+        if e.response["Error"]["Code"] != "ConditionalCheckFailedException":
+            raise
+
+
+def run_commands(thing, commands):
+    """Validate and apply commands, returns the API response"""
+
+    errors = validate(commands)
+    if errors:
+        return http_response(http_headers, 400, "; ".join(errors))
+    desired = desired_state(commands)
+    calls = [lambda: write_shadow(thing, desired)]
+    if "led_ring" in desired:
+        calls.append(lambda: record_led_ring(thing, desired["led_ring"]))
+    written = fanout.gather(*calls)[0]
+
+    messages = []
+    if "led" in written:
+        messages.append(f'Led state "{written["led"]}" successfully put into device shadow')
+    if "led_ring" in written:
+        messages.append(
+            f'Led ring set to {written["led_ring"]["count"]} "{written["led_ring"]["color"]}"'
+        )
+    if "dispense_time_ms" in written:
+        messages.append(f'Dispense time set to {written["dispense_time_ms"]} ms')
+    return http_response(http_headers, 200, "; ".join(messages))
 
 
 def handler(event, context):
     """Process entry point for lambda."""
     logger.info(f"Received event: {json.dumps(event)}")
-    if "queryStringParameters" in event:
-        params = event["queryStringParameters"]
-    else:
-        return http_response(http_headers, 500, "No parameters provided")
 
     # thing/dispenser
     dispenser = str(event["requestContext"]["authorizer"]["claims"]["custom:dispenserId"])
-    try:
-        # Verify command provided and execute
-        if "setLed" in params:
-            # value is off, on, or toggle
-            response = set_led(dispenser, params["setLed"])
-        else:
-            response = http_response(
+    if event.get("httpMethod") == "POST":
+        try:
+            commands = json.loads(event.get("body") or "")["commands"]
+        except (ValueError, TypeError, KeyError):
+            return http_response(
+                http_headers, 400, 'Body must be a JSON object with a "commands" list'
+            )
+    else:
+        params = event.get("queryStringParameters") or {}
+        if "setLed" not in params:
+            return http_response(
                 http_headers,
-                500,
+                400,
                 f"Invalid command provided, valid commands are: {valid_commands}",
             )
-        # options process (missing, good or bad 200/500)
-        return response
-    except KeyError as e:
+        # value is off, on, or toggle
+        commands = [{"command": "setLed", "value": params["setLed"]}]
+    try:
+        return run_commands(dispenser, commands)
+    except (ClientError, RuntimeError) as e:
         logger.error("Error: %s", e)
-        return http_response(http_headers, 500, e)
+        return http_response(http_headers, 500, f"ERROR: Commands not applied: {e}")
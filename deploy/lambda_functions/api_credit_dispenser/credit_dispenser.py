@@ -1,11 +1,32 @@
-import boto3
-from boto3.dynamodb.conditions import Key, Attr
+"""
+Credits another participant's dispenser with $0.25
+
+The credit is a single atomic UpdateItem (ADD credits) on the dispenser
+record, so concurrent credits to the same dispenser are all counted.
+
+Environment Variables:
+  DISPENSER_TABLE - DDB table of dispenser records
+  EVENT_TABLE - DDB table of dispenser events
+  CREDIT_MODE - "atomic" (default) updates the credits only, "ledger" also
+                writes a ledger entry to the event log in the same
+                transaction, which is then the credit's only log entry
+  CREDIT_RATE, CREDIT_BURST, CREDIT_PAIR_LIMIT, CREDIT_PAIR_WINDOW - limits of
+                each caller's credits, see rate_limit.py
+  IDEMPOTENCY_TABLE, IDEMPOTENCY_TTL - retries with the same Idempotency-Key
+                header get the first response, see cdd_common/idempotency.py
+"""
+
 from botocore.exceptions import ClientError
 from decimal import Decimal
 import json
 import os
 import logging
 
+from cdd_common import batch, clients, events, fanout, idempotency
+from cdd_common.led import update_led_ring
+from cdd_common.responses import http_response
+import rate_limit
+
 __copyright__ = (
     "Copyright 2019 Amazon.com, Inc. or its affiliates. All Rights Reserved."
 )
@@ -16,122 +37,147 @@ logger.setLevel(logging.INFO)
 
 # Global Variables
 httpHeaders = {"Access-Control-Allow-Origin": "*"}
+CREDIT_AMOUNT = Decimal("0.25")
 
-ddb = boto3.resource("dynamodb")
-iot_client = boto3.client("iot-data")
-
-# Helper class to convert a DynamoDB item to JSON.
-class DecimalEncoder(json.JSONEncoder):
-    def default(self, o):  # pylint: disable=E0202
-        if isinstance(o, decimal.Decimal):  # pylint: disable=E0602
-            if o % 1 > 0:
-                return float(o)
-            else:
-                return int(o)
-        return super(DecimalEncoder, self).default(o)
 
+def add_credit(dispenser):
+    """Add CREDIT_AMOUNT to the dispenser's credits, returns the updated
+    record, None if the dispenser does not exist"""
 
-def http_response(headers, status_code, body):
-    """Create response dict for returning query"""
-    if type(body) != str:
-        if type(body) == dict:
-            body = json.dumps(body)
-        else:
-            body = f"ERROR, invalid type of {type(body)} for body of return"
-            status_code = 500
-    return {"body": body, "headers": headers, "statusCode": status_code}
-
-
-def set_led_ring(amount: float):
-    """Return count and color based on credit float amount
-
-    the ring LED has 8 elements and are set based on credit amounts:
-
-    credits         LEDs lit            Color
-    =============== =================== ===========================
-    0 - 0.24        8                    red (#FF0000)
-    0.25 - 0.49     2                    white (#F0F0F0)
-    0.50 - 0.74     4                    white (#F0F0F0)
-    0.75 - 0.99     6                    white (#F0F0F0)
-    1.00 - 1.99     1                    darkest green (#006600)
-    2.00 - 2.99     2                    dark green (#009900)
-    3.00 - 3.99     3                    green (#00E600)
-    4.00 - 4.99     4                    bright green(#00FF00)
-    5.00 - 5.99     5                    bright green(#00FF00)
-    6.00 - 6.99     6                    bright green(#00FF00)
-    7.00 - 7.99     7                    bright green(#00FF00)
-    8.00 >          8                    bright green(#00FF00)
-    """
-
-    # Green colors for 1, 2, 3, and greater
-    color_scale = ["#006600", "#009900", "#00E600", "#00FF00"]
-    # Cast to float, most likely Decimal coming in
-    amount = float(amount)
-    if amount == 0.0:
-        # No credits all lit up red
-        count = 8
-        color = "#FF0000"
-    elif amount < 1.00:
-        # 0.01 - 0.99 - 2 per .25, white
-        count = int(amount / 0.25) * 2
-        color = "#F0F0F0"
-    else:
-        # At least 1.00 or more, set count to 1-8 per 1.00
-        count = int(amount / 1.00) if amount < 8.00 else 8
-        if count < 4:
-            color = color_scale[count - 1]
-        else:
-            color = color_scale[3]
-    return count, color
+    try:
+        response = clients.table(os.environ["DISPENSER_TABLE"]).update_item(
+            Key={"dispenserId": dispenser},
+            UpdateExpression="ADD credits :amount",
+            ConditionExpression="attribute_exists(dispenserId)",
+            ExpressionAttributeValues={":amount": CREDIT_AMOUNT},
+            ReturnValues="ALL_NEW",
+        )
+    except ClientError as e:
+        if e.response["Error"]["Code"] == "ConditionalCheckFailedException":
+            return None
+        raise
+    return response["Attributes"]
+
+
+def add_credit_with_ledger(dispenser, crediting_dispenser):
+    """Add CREDIT_AMOUNT to the dispenser's credits and log the credit as
+    one transaction, returns the updated record, None if the dispenser does
+    not exist"""
+
+    entry = events.entry(
+        dispenser,
+        f"Credit: Received ${CREDIT_AMOUNT} credit from dispenser: {crediting_dispenser}",
+        credit=CREDIT_AMOUNT,
+        fromDispenserId=crediting_dispenser,
+    )
+    while True:
+        try:
+            clients.client("dynamodb").transact_write_items(
+                TransactItems=[
+                    {
+                        "Update": {
+                            "TableName": os.environ["DISPENSER_TABLE"],
+                            "Key": batch.serialize({"dispenserId": dispenser}),
+                            "UpdateExpression": "ADD credits :amount",
+                            "ConditionExpression": "attribute_exists(dispenserId)",
+                            "ExpressionAttributeValues": batch.serialize(
+                                {":amount": CREDIT_AMOUNT}
+                            ),
+                        }
+                    },
+                    {
+                        "Put": {
+                            "TableName": os.environ["EVENT_TABLE"],
+                            "Item": batch.serialize(entry),
+                            "ConditionExpression": "attribute_not_exists(pk)",
+                        }
+                    },
+                ]
+            )
+            break
+        except ClientError as e:
+            codes = [
+                reason.get("Code")
+                for reason in e.response.get("CancellationReasons", [])
+            ]
+            if codes[:1] == ["ConditionalCheckFailed"]:
+                return None
+            if codes[1:] != ["ConditionalCheckFailed"]:
+                raise
+            # Another entry was logged in the same microsecond
+            entry["ts"] += events.MICROSECOND
+            entry["timestamp"] = events.iso_timestamp(entry["ts"])
+    # Transactions do not return values, read back the committed credits
+    response = clients.table(os.environ["DISPENSER_TABLE"]).get_item(
+        Key={"dispenserId": dispenser},
+        ProjectionExpression="credits, ledRing",
+        ConsistentRead=True,
+    )
+    return response["Item"]
 
 
 def credit_dispenser(dispenser, crediting_dispenser):
     """Credit target dispenser with $0.25"""
     dispenser = str(dispenser)
-    dispenser_table = ddb.Table(os.environ["DISPENSER_TABLE"])
 
-    # Query dispenser
-    response = dispenser_table.query(
-        KeyConditionExpression=Key("dispenserId").eq(dispenser)
-    )
-
-    # If count is zero, this is a non-existent dispenser
-    if response["Count"] == 0:
+    ledger = os.environ.get("CREDIT_MODE", "atomic") == "ledger"
+    if ledger:
+        record = add_credit_with_ledger(dispenser, crediting_dispenser)
+    else:
+        record = add_credit(dispenser)
+    # None is a non-existent dispenser
+    if record is None:
         return http_response(
             httpHeaders,
             200,
             f"ERROR: Credit not issued, dispenser {dispenser} does not exist",
         )
-    else:
-        user_db_record = response["Items"][0]
-
-    # We have a valid dispenser, add $0.25 to it and put updated record
-    user_db_record["credits"] = user_db_record["credits"] + Decimal(0.25)
-    dispenser_table.put_item(Item=user_db_record)
-
-    # Update led_ring desired state
-    # For less than $1.00, count 1 to 3, greater than $1.00, count = 5
-    count, color = set_led_ring(user_db_record["credits"])
-    desired_state = {
-        "state": {"desired": {"led_ring": {"count": count, "color": color}}}
-    }
-    iot_client.update_thing_shadow(
-        thingName=dispenser, payload=json.dumps(desired_state)
-    )
 
-    # Publish IoT event to receiving dispenser
-    publish_event(
-        topic=f"events/{dispenser}",
-        payload=f"Received $0.25 credit from dispenser: {crediting_dispenser}",
+    # Update led_ring desired state, if the credits change what it shows, and
+    # publish IoT event to receiving dispenser
+    fanout.gather(
+        lambda: update_led_ring(
+            clients.table(os.environ["DISPENSER_TABLE"]),
+            dispenser,
+            record["credits"],
+            record,
+        ),
+        lambda: publish_event(
+            topic=f"events/{dispenser}",
+            payload=f"Received $0.25 credit from dispenser: {crediting_dispenser}",
+            logged=ledger,
+        ),
     )
     return http_response(httpHeaders, 200, f"Dispenser: {dispenser} credited $0.25")
 
 
-def publish_event(topic, payload):
-    """Publish payload to IoT topic as JSON attribute message"""
-    iot_client.publish(topic=topic, qos=0, payload=f'{{"message": "{payload}"}}')
+def publish_event(topic, payload, logged=False):
+    """Publish payload to IoT topic as JSON attribute message. If logged (by
+    the ledger entry), process_events does not log it again."""
+
+    message = {"message": payload}
+    if logged:
+        message["logged"] = True
+    clients.client("iot-data").publish(topic=topic, qos=0, payload=json.dumps(message))
+
+
+def rejected(rejection):
+    """Response to a credit refused by the rate limits"""
+    if rejection.reason == "unknown":
+        return http_response(
+            httpHeaders, 403, "ERROR: Credit not issued, your dispenser does not exist"
+        )
+    retry_after = max(1, round(rejection.retry_after))
+    if rejection.reason == "cooldown":
+        message = f"ERROR: Credit not issued, too many credits to this dispenser, try again in {retry_after} seconds"
+    else:
+        message = f"ERROR: Credit not issued, too many credits, try again in {retry_after} seconds"
+    return http_response(
+        {**httpHeaders, "Retry-After": str(retry_after)}, 429, message
+    )
 
 
+@idempotency.idempotent("credit")
 def handler(event, context):
     """Credit dispenser as long as calling entity is not the same"""
     logger.info("Received event: %s", json.dumps(event))
@@ -151,6 +197,14 @@ def handler(event, context):
         )
         if "dispenserId" in params:
             if params["dispenserId"] != crediting_dispenser:
+                # Refuse over limit callers before touching the target or IoT
+                rejection = rate_limit.acquire(
+                    clients.table(os.environ["DISPENSER_TABLE"]),
+                    crediting_dispenser,
+                    str(params["dispenserId"]),
+                )
+                if rejection:
+                    return rejected(rejection)
                 return credit_dispenser(
                     dispenser=params["dispenserId"],
                     crediting_dispenser=crediting_dispenser,
@@ -0,0 +1,137 @@
+"""
+Rate limits for crediting other dispensers
+
+Each crediting dispenser's record holds its limiter state in the
+"creditLimit" map attribute:
+
+    "creditLimit": {
+        "tokens": 3.5,
+        "updatedAt": 1576000000.123,
+        "recent": {"105": [1575999990.5, 1576000000.123]}
+    }
+
+tokens is a token bucket refilled at CREDIT_RATE tokens a second up to
+CREDIT_BURST, each credit takes a token. recent holds the times of the
+credits to each target dispenser within the last CREDIT_PAIR_WINDOW seconds,
+at most CREDIT_PAIR_LIMIT credits to the same dispenser are allowed in any
+such window.
+
+The state is read, checked and written back with a conditional update on
+updatedAt, so concurrent requests from the same caller cannot both spend
+the last token. Rejected requests only read the caller's record.
+"""
+
+import os
+import time
+from decimal import Decimal
+from typing import NamedTuple, Optional
+from botocore.exceptions import ClientError
+
+__copyright__ = (
+    "Copyright 2019 Amazon.com, Inc. or its affiliates. All Rights Reserved."
+)
+__license__ = "MIT-0"
+
+# Conditional updates lost to concurrent requests before giving up
+MAX_ATTEMPTS = 5
+
+
+class Limits(NamedTuple):
+    """Credit rate limits of a caller"""
+
+    rate: float
+    burst: float
+    pair_limit: int
+    pair_window: float
+
+    @classmethod
+    def from_environment(cls):
+        return cls(
+            rate=float(os.environ.get("CREDIT_RATE", "0.5")),
+            burst=float(os.environ.get("CREDIT_BURST", "5")),
+            pair_limit=int(os.environ.get("CREDIT_PAIR_LIMIT", "4")),
+            pair_window=float(os.environ.get("CREDIT_PAIR_WINDOW", "60")),
+        )
+
+
+class Rejection(NamedTuple):
+    """Why a credit was refused and the seconds until it may be retried"""
+
+    reason: str
+    retry_after: Optional[float]
+
+
+def to_decimal(value):
+    return Decimal(str(round(value, 6)))
+
+
+def next_state(state, target, limits, now):
+    """Limiter state after a credit to target now, or the Rejection"""
+
+    if state is None:
+        tokens = limits.burst
+        recent = {}
+    else:
+        elapsed = max(0.0, now - float(state["updatedAt"]))
+        tokens = min(limits.burst, float(state["tokens"]) + elapsed * limits.rate)
+        recent = state.get("recent", {})
+    if tokens < 1:
+        return Rejection("rate", (1 - tokens) / limits.rate)
+
+    # Credits within the window, for every target so the map stays small
+    window_start = now - limits.pair_window
+    recent = {
+        dispenser: [t for t in times if float(t) > window_start]
+        for dispenser, times in recent.items()
+    }
+    to_target = recent.get(target, [])
+    if len(to_target) >= limits.pair_limit:
+        return Rejection("cooldown", float(to_target[0]) - window_start)
+    recent[target] = to_target + [to_decimal(now)]
+    return {
+        "tokens": to_decimal(tokens - 1),
+        "updatedAt": to_decimal(now),
+        "recent": {dispenser: times for dispenser, times in recent.items() if times},
+    }
+
+
+def acquire(table, caller, target, limits=None, now=None):
+    """Take a credit from caller to target from the caller's limits
+
+    Returns None if the credit is allowed, otherwise a Rejection. A caller
+    without a dispenser record is rejected (reason "unknown").
+    """
+
+    limits = limits or Limits.from_environment()
+    for _ in range(MAX_ATTEMPTS):
+        at = time.time() if now is None else now
+        response = table.get_item(
+            Key={"dispenserId": caller},
+            ProjectionExpression="dispenserId, creditLimit",
+            ConsistentRead=True,
+        )
+        if "Item" not in response:
+            return Rejection("unknown", None)
+        state = response["Item"].get("creditLimit")
+        new_state = next_state(state, target, limits, at)
+        if isinstance(new_state, Rejection):
+            return new_state
+        if state is None:
+            condition = "attribute_exists(dispenserId) AND attribute_not_exists(creditLimit)"
+            values = {":state": new_state}
+        else:
+            condition = "creditLimit.updatedAt = :previous"
+            values = {":state": new_state, ":previous": state["updatedAt"]}
+        try:
+            table.update_item(
+                Key={"dispenserId": caller},
+                UpdateExpression="SET creditLimit = :state",
+                ConditionExpression=condition,
+                ExpressionAttributeValues=values,
+            )
+            return None
+        except ClientError as e:
+            if e.response["Error"]["Code"] != "ConditionalCheckFailedException":
+                raise
+            # Updated by a concurrent request from the same caller, try again
+    return Rejection("rate", 1 / limits.rate)
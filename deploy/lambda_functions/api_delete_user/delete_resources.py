@@ -10,10 +10,10 @@ iam_user - IAM user deleted from account
 import os
 import json
 import logging
-import boto3
-from datetime import datetime
 from botocore.exceptions import ClientError
 
+from cdd_common import clients, events, retry
+
 __copyright__ = (
     "Copyright 2019 Amazon.com, Inc. or its affiliates. All Rights Reserved."
 )
@@ -22,17 +22,29 @@ __license__ = "MIT-0"
 logger = logging.getLogger()
 logger.setLevel(logging.INFO)
 
+# Seconds to retry each call, the API Gateway integration times out after 29
+RETRY_DEADLINE = 8
+
 
 def iam_user(username):
     """Delete the user from IAM"""
 
-    client = boto3.client("iam")
     try:
-        client.delete_login_profile(UserName=username)
-        response = client.list_groups_for_user(UserName=username)
+        retry.call(
+            "iam", "delete_login_profile", deadline=RETRY_DEADLINE, UserName=username
+        )
+        response = retry.call(
+            "iam", "list_groups_for_user", deadline=RETRY_DEADLINE, UserName=username
+        )
         for i in response["Groups"]:
-            client.remove_user_from_group(UserName=username, GroupName=i["GroupName"])
-        client.delete_user(UserName=username)
+            retry.call(
+                "iam",
+                "remove_user_from_group",
+                deadline=RETRY_DEADLINE,
+                UserName=username,
+                GroupName=i["GroupName"],
+            )
+        retry.call("iam", "delete_user", deadline=RETRY_DEADLINE, UserName=username)
         return True
     except ClientError as e:
         logger.error(f"Error deleting IAM user: {username}, error: {e}")
@@ -42,9 +54,14 @@ def iam_user(username):
 def cognito_user(username, user_pool_id):
     """Delete the user from Cognito User Pool"""
 
-    client = boto3.client("cognito-idp")
     try:
-        client.admin_delete_user(UserPoolId=user_pool_id, Username=username)
+        retry.call(
+            "cognito-idp",
+            "admin_delete_user",
+            deadline=RETRY_DEADLINE,
+            UserPoolId=user_pool_id,
+            Username=username,
+        )
         return True
     except ClientError as e:
         logger.error(f"Error deleting Cognito user: {username}, error: {e}")
@@ -54,54 +71,71 @@ def cognito_user(username, user_pool_id):
 def iot_thing_certificate(certificate_arn, thing_name):
     """Detach any policies from principal, then delete certificate and thing"""
 
-    iot_client = boto3.client("iot")
-    iot_data_client = boto3.client("iot-data")
+    certificate_id = certificate_arn.split("/")[-1]
 
     # Certificates must be disassociated with policies and things before being deleted
     # Detach policies from certificate
     try:
-        response = iot_client.list_attached_policies(target=certificate_arn)
+        response = retry.call(
+            "iot", "list_attached_policies", deadline=RETRY_DEADLINE, target=certificate_arn
+        )
         for policy in response["policies"]:
-            response = iot_client.detach_principal_policy(
-                policyName=policy["policyName"], principal=certificate_arn
+            retry.call(
+                "iot",
+                "detach_principal_policy",
+                deadline=RETRY_DEADLINE,
+                policyName=policy["policyName"],
+                principal=certificate_arn,
             )
         # Detach things from certificate
-        response = iot_client.list_principal_things(principal=certificate_arn)
+        response = retry.call(
+            "iot", "list_principal_things", deadline=RETRY_DEADLINE, principal=certificate_arn
+        )
         for thing in response["things"]:
-            response = iot_client.detach_thing_principal(
-                thingName=thing, principal=certificate_arn
+            retry.call(
+                "iot",
+                "detach_thing_principal",
+                deadline=RETRY_DEADLINE,
+                thingName=thing,
+                principal=certificate_arn,
             )
         # Revoke and delete certificate
-        response = iot_client.update_certificate(
-            certificateId=certificate_arn.split("/")[-1], newStatus="REVOKED"
+        retry.call(
+            "iot",
+            "update_certificate",
+            deadline=RETRY_DEADLINE,
+            certificateId=certificate_id,
+            newStatus="REVOKED",
         )
-        response = iot_client.delete_certificate(
-            certificateId=certificate_arn.split("/")[-1], forceDelete=False
+        retry.call(
+            "iot",
+            "delete_certificate",
+            deadline=RETRY_DEADLINE,
+            certificateId=certificate_id,
+            forceDelete=False,
         )
     except ClientError as e:
         logger.error(f"ERROR deleting IoT certificate, error: {e}")
         return False
 
     # With certificate deleted, delete thing shadown and thing
-    response = iot_data_client.delete_thing_shadow(thingName=thing_name)
-    response = iot_client.delete_thing(thingName=thing_name)
+    retry.call(
+        "iot-data", "delete_thing_shadow", deadline=RETRY_DEADLINE, thingName=thing_name
+    )
+    retry.call("iot", "delete_thing", deadline=RETRY_DEADLINE, thingName=thing_name)
 
 
 def clean_dispenser_tables(dispenser_id):
     """Remove entry from dispenser table and log to event table"""
 
     try:
-        ddb = boto3.resource("dynamodb")
         log_entry = f"Account: Deleted record for dispenser: {dispenser_id}"
-        ts = datetime.utcnow().isoformat() + "Z"
 
         # Delete dispenser entry
-        dispenser_table = ddb.Table(os.environ["DISPENSER_TABLE"])
+        dispenser_table = clients.table(os.environ["DISPENSER_TABLE"])
         dispenser_table.delete_item(Key={"dispenserId": dispenser_id})
 
-        event_table = ddb.Table(os.environ["EVENT_TABLE"])
-        item = {"dispenserId": dispenser_id, "timestamp": ts, "log": log_entry}
-        event_table.put_item(Item=item)
+        events.put(dispenser_id, log_entry)
         return True
     except ClientError as e:
         logger.error(f"ERROR: Could not delete dispenser {dispenser_id}, error: {e}")
@@ -113,10 +147,12 @@ def cognito_identity_iot_policy(cognito_identity_id, iot_policy):
 
     print(f"Attempting to detach identity: {cognito_identity_id} from policy: {iot_policy}")
     try:
-        client = boto3.client("iot")
-        client.detach_policy(
+        retry.call(
+            "iot",
+            "detach_policy",
+            deadline=RETRY_DEADLINE,
             policyName=iot_policy,
-            target=cognito_identity_id
+            target=cognito_identity_id,
         )
         return True
     except ClientError as e:
@@ -130,8 +166,12 @@ def cloud9(environment_id):
     """Delete Cloud9 instance and environment"""
 
     try:
-        client = boto3.client("cloud9")
-        client.delete_environment(environmentId=environment_id)
+        retry.call(
+            "cloud9",
+            "delete_environment",
+            deadline=RETRY_DEADLINE,
+            environmentId=environment_id,
+        )
         return True
     except ClientError as e:
         logger.error(
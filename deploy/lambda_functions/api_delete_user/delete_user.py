@@ -7,10 +7,10 @@ import json
 import os
 import logging
 from decimal import Decimal
-import boto3
 from boto3.dynamodb.conditions import Key, Attr
 from botocore.exceptions import ClientError
 
+from cdd_common import clients, retry
 
 import delete_resources as AWS_delete
 
@@ -25,7 +25,6 @@ logger.setLevel(logging.INFO)
 
 # Global Variables - Lambda manages CORS
 httpHeaders = {"Access-Control-Allow-Origin": "*"}
-ddb = boto3.resource("dynamodb")
 
 
 def handler(event, context):
@@ -53,7 +52,7 @@ def handler(event, context):
 
     username = json.loads(event["body"])["username"]
     user_pool_id = os.environ["USER_POOL_ID"]
-    table = ddb.Table(os.environ["USER_TABLE"])
+    table = clients.table(os.environ["USER_TABLE"])
 
     # Query user and return contents of assets
     response = table.query(KeyConditionExpression=Key("userName").eq(username))
@@ -88,6 +87,7 @@ def handler(event, context):
                 print(e.response["Error"]["Message"])
             else:
                 raise
+        retry.log_metrics()
         logger.info(f"INFO: User: {username} assets and entry deleted")
         retval = {
             "body": f"INFO: User: {username} assets and entry deleted",
@@ -1,4 +1,43 @@
-"""Actuates the dispenser by setting the desired state of the shadow"""
+"""Actuates the dispenser and reconciles its responses
+
+How the request reaches the dispenser depends on DISPENSE_MODE:
+
+shadow - (default) the request is set as the desired state of the shadow,
+         the dispenser gets it as a delta and reports its response in the
+         shadow, which the DispenseCommandResponse rule passes back here
+command - the request is published (QoS 1) to the dispenser's cmd/NNN topic
+          and the dispenser publishes its response to cmd/NNN/response,
+          without the shadow round trips. The dispenser still reports its
+          state to the shadow, and the LED ring is still set through it.
+
+The time from request to response is published as the DispenseLatency
+metric, with the mode as a dimension, to compare the two. It is broken down
+into the durations (milliseconds) of the consecutive stages of the
+dispense, published with the same dimension and with the requestId and
+dispenserId properties:
+
+ApiReceive     - API Gateway receiving the request to this function running
+Reservation    - reserving the request slot (DynamoDB)
+RequestSend    - setting the shadow or publishing the command (IoT)
+DeviceReport   - the request having been sent to the response reaching IoT
+                 Core: delivery to, dispensing on, and report by the
+                 dispenser. From the sentAt property of the API request's
+                 record to the receivedAt property of the response's
+                 record (epoch milliseconds), computed by
+                 dispense_latency.py when it joins the two
+RuleDelivery   - the IoT rule invoking this function with the response
+Reconciliation - matching the response to the request and deducting the
+                 credits, one conditional update (DynamoDB)
+Completion     - setting the LED ring for the new credits and publishing
+                 the event, or clearing the failed request (IoT, DynamoDB)
+
+ApiHandler (the function handling the API request, including the logging
+alongside RequestSend) and DispenseLatency (from Reservation to
+Reconciliation) are totals, not stages.
+
+The records can be exported from CloudWatch Logs and summarised with
+dispense_latency.py.
+"""
 
 # TODO: Add error handling to return 500 with CORS set
 
@@ -6,13 +45,14 @@ import json
 import os
 import logging
 import time
-import boto3
-from datetime import datetime as dt
 from decimal import Decimal
-from random import randint
-from boto3.dynamodb.conditions import Key, Attr
+from boto3.dynamodb.types import TypeDeserializer
 from botocore.exceptions import ClientError
 
+from cdd_common import clients, events, fanout, idempotency, ids, metrics, request_slots
+from cdd_common.led import update_led_ring
+from cdd_common.responses import http_response
+
 __copyright__ = (
     "Copyright 2019 Amazon.com, Inc. or its affiliates. All Rights Reserved."
 )
@@ -23,146 +63,235 @@ logger.setLevel(logging.INFO)
 
 # Global Variables
 httpHeaders = {"Access-Control-Allow-Origin": "*"}
-
-ddb = boto3.resource("dynamodb")
-dispenser_table = ddb.Table(os.environ["DISPENSER_TABLE"])
-event_table = ddb.Table(os.environ["EVENT_TABLE"])
-iot_client = boto3.client("iot-data")
+# Cost of a single dispense and seconds before an in-flight request is stale
+DISPENSE_COST = Decimal("1.00")
+REQUEST_TIMEOUT = 5
+deserializer = TypeDeserializer()
 
 
-def http_response(headers, status_code, body):
-    """Create response dict for returning query"""
-    if type(body) != str:
-        if type(body) == dict:
-            body = json.dumps(body)
-        else:
-            body = "ERROR, invalid type of {} for body of return".format(type(body))
-            status_code = 500
-    return {"body": body, "headers": headers, "statusCode": status_code}
-
-
-def set_led_ring(amount: float):
-    """Return count and color based on credit float amount
-
-    the ring LED has 8 elements and are set based on credit amounts:
-
-    credits         LEDs lit            Color
-    =============== =================== ===========================
-    0 - 0.24        8                    red (#FF0000)
-    0.25 - 0.49     2                    white (#F0F0F0)
-    0.50 - 0.74     4                    white (#F0F0F0)
-    0.75 - 0.99     6                    white (#F0F0F0)
-    1.00 - 1.99     1                    darkest green (#006600)
-    2.00 - 2.99     2                    dark green (#009900)
-    3.00 - 3.99     3                    green (#00E600)
-    4.00 - 4.99     4                    bright green(#00FF00)
-    5.00 - 5.99     5                    bright green(#00FF00)
-    6.00 - 6.99     6                    bright green(#00FF00)
-    7.00 - 7.99     7                    bright green(#00FF00)
-    8.00 >          8                    bright green(#00FF00)
-    """
-
-    # Green colors for 1, 2, 3, and greater
-    color_scale = ["#006600", "#009900", "#00E600", "#00FF00"]
-    # Cast to float, most likely Decimal coming in
-    amount = float(amount)
-    if amount == 0.0:
-        # No credits all lit up red
-        count = 8
-        color = "#FF0000"
-    elif amount < 1.00:
-        # 0.01 - 0.99 - 2 per .25, white
-        count = int(amount / 0.25) * 2
-        color = "#F0F0F0"
-    else:
-        # At least 1.00 or more, set count to 1-8 per 1.00
-        count = int(amount / 1.00) if amount < 8.00 else 8
-        if count < 4:
-            color = color_scale[count - 1]
-        else:
-            color = color_scale[3]
-    return count, color
+def dispense_mode():
+    return os.environ.get("DISPENSE_MODE", "shadow")
 
 
-def log_event(table, dispenser_id, message):
-    """Put log entry into DynamoDB table"""
+def log_event(table, dispenser_id, message, request_id=None):
+    """Put log entry into DynamoDB table, with the id of the request it is
+    about if any"""
 
-    log_entry = {
-        "dispenserId": dispenser_id,
-        "timestamp": dt.utcnow().isoformat() + "Z",
-        "log": message,
-    }
+    attributes = {"requestId": request_id} if request_id else {}
     try:
         # Write to events table
-        table.put_item(Item=log_entry)
+        table.put_item(Item=events.entry(dispenser_id, message, **attributes))
     except ClientError as e:
         logging.error("An error has occurred:, {}".format(e))
 
 
 def read_dispenser(dispenser, table):
-    """Read, parse, and return dispenser record"""
+    """Read and return dispenser record, None if the dispenser does not exist"""
+
+    response = table.get_item(Key={"dispenserId": dispenser}, ConsistentRead=True)
+    return response.get("Item")
+
+
+def is_condition_failure(error):
+    """True if the ClientError is a failed condition expression"""
+    return error.response["Error"]["Code"] == "ConditionalCheckFailedException"
+
+
+def failed_record(error):
+    """The record as it was when the condition failed (the update asked for
+    it with ReturnValuesOnConditionCheckFailure), None if it does not exist"""
+
+    item = error.response.get("Item")
+    if item is None:
+        return None
+    return {name: deserializer.deserialize(value) for name, value in item.items()}
+
+
+def update_slot(dispenser, table, ConditionExpression, **kwargs):
+    """Conditional UpdateItem on the request slot map of the dispenser record
+
+    The condition also requires the requests attribute to be a map. If it is
+    missing or still a legacy list the record is migrated and the update
+    retried once. A failed condition returns the record (see failed_record()),
+    so whether it needs migrating, and why the condition failed otherwise,
+    is known without reading it again.
+    """
+
+    kwargs["ExpressionAttributeValues"] = {
+        **kwargs.get("ExpressionAttributeValues", {}),
+        ":map": "M",
+    }
+    condition = f"attribute_type(requests, :map) AND ({ConditionExpression})"
+    try:
+        return table.update_item(
+            Key={"dispenserId": dispenser},
+            ConditionExpression=condition,
+            ReturnValuesOnConditionCheckFailure="ALL_OLD",
+            **kwargs,
+        )
+    except ClientError as e:
+        if request_slots.is_invalid_path(e):
+            record = None
+        elif is_condition_failure(e):
+            record = failed_record(e)
+            if record is None or isinstance(record.get("requests"), dict):
+                raise
+        else:
+            raise
+        if not request_slots.migrate_record(dispenser, table, record):
+            raise
+    return table.update_item(
+        Key={"dispenserId": dispenser},
+        ConditionExpression=condition,
+        ReturnValuesOnConditionCheckFailure="ALL_OLD",
+        **kwargs,
+    )
+
+
+def reserve_dispense(dispenser, request_id, table):
+    """Atomically verify credits and reserve the dispense request slot
+
+    The credit check, the check for an in-flight (non-expired) request and
+    setting of the request slot are evaluated server-side in a single
+    UpdateItem, so two concurrent callers cannot both pass the "in progress"
+    check. When the condition fails the update returns the record, to
+    determine the reason.
+
+    Returns a tuple of (slot, dispenser_record), where slot is the reserved
+    RequestSlot or None, and dispenser_record is only populated when the
+    reservation was not made.
+    """
+
+    slot = request_slots.RequestSlot.new(request_id, "dispense")
+    try:
+        update_slot(
+            dispenser,
+            table,
+            UpdateExpression=f"SET requests.#command = :slot, {request_slots.IN_FLIGHT_SET}",
+            ConditionExpression=(
+                "attribute_exists(dispenserId) AND credits >= :cost AND "
+                "(attribute_not_exists(requests.#command) OR requests.#command.expiresAt <= :now)"
+            ),
+            ExpressionAttributeNames={"#command": slot.command},
+            ExpressionAttributeValues={
+                ":slot": slot.to_item(),
+                ":cost": DISPENSE_COST,
+                ":now": Decimal(str(slot.timestamp)),
+                **request_slots.in_flight_values(slot),
+            },
+        )
+        return slot, None
+    except ClientError as e:
+        if not is_condition_failure(e):
+            raise
+        return None, failed_record(e)
+
 
-    response = table.query(KeyConditionExpression=Key("dispenserId").eq(dispenser))
-    # If count is zero, this is a non-existent dispenser
-    if response["Count"] == 0:
-        return http_response(
-            httpHeaders, 200, f"ERROR: Dispenser {dispenser} does not exist"
+def complete_dispense(dispenser, request_id, deduct, table):
+    """Atomically remove the dispense request slot if it matches request_id
+    and, if deduct is True, deduct the cost of a dispense from the credits
+
+    Returns the record as it was *before* the update, or None if the stored
+    request does not match request_id.
+    """
+
+    if deduct:
+        update_expression = (
+            "SET credits = credits - :cost "
+            f"REMOVE requests.#command, {request_slots.IN_FLIGHT_REMOVE}"
         )
+        values = {":request_id": request_id, ":cost": DISPENSE_COST}
     else:
-        return response["Items"][0]
+        update_expression = f"REMOVE requests.#command, {request_slots.IN_FLIGHT_REMOVE}"
+        values = {":request_id": request_id}
+    try:
+        response = update_slot(
+            dispenser,
+            table,
+            UpdateExpression=update_expression,
+            ConditionExpression="requests.#command.requestId = :request_id",
+            ExpressionAttributeNames={"#command": "dispense"},
+            ExpressionAttributeValues=values,
+            ReturnValues="ALL_OLD",
+        )
+        return response["Attributes"]
+    except ClientError as e:
+        if not is_condition_failure(e):
+            raise
+        return None
 
 
-def write_dispenser_record(dispenser_record, dispenser_table):
-    """Replace existing dispenser record"""
+def discard_dispense(dispenser, table):
+    """Remove any dispense request slot from the record, returns the removed
+    RequestSlot or None if no dispense request was found"""
 
     try:
-        # Write to dispenser table
-        dispenser_table.put_item(Item=dispenser_record)
+        response = update_slot(
+            dispenser,
+            table,
+            UpdateExpression=f"REMOVE requests.#command, {request_slots.IN_FLIGHT_REMOVE}",
+            ConditionExpression="attribute_exists(requests.#command)",
+            ExpressionAttributeNames={"#command": "dispense"},
+            ReturnValues="ALL_OLD",
+        )
     except ClientError as e:
-        logging.error("An error has occurred:, {}".format(e))
+        if not is_condition_failure(e):
+            raise
+        return None
+    return request_slots.get_slot(response["Attributes"], "dispense")
 
 
 def get_request_id():
-    """Generates nnnn-nnnn random string, zero padded"""
-    return f"{randint(0,9999):04d}-{randint(0,9999):04d}"
+    """New request id, sortable by time, see cdd_common/ids.py"""
+    return ids.ulid()
 
 
-def request_details(requests, command):
-    """Return details for command in requests"""
+def iot_publish_event(topic, message, request_id=None):
+    """Publish message to events topic, with the id of the request it is
+    about if any (logged with the message by process_events)"""
 
-    for request in requests:
-        # Parse record format of "requestId|command|timestamp|target"
-        record = request.split("|")
-        if record[1] == command:
-            return {
-                "requestId": record[0],
-                "command": record[1],
-                "timestamp": float(record[2]),
-            }
-    # No matching requestId for command found
-    return None
+    payload = {"message": message}
+    if request_id:
+        payload["requestId"] = request_id
+    clients.client("iot-data").publish(topic=topic, payload=json.dumps(payload))
 
 
-def remove_request(record, command):
-    """Return record with request for "command" removed"""
+def send_request(dispenser, slot):
+    """Send the dispense request to the dispenser, as set by DISPENSE_MODE"""
 
-    requests = record["requests"]
-    new_requests = []
-    for i in requests:
-        if i.split("|")[1] != command:
-            new_requests.append(i)
-    record["requests"] = new_requests
-    return record
+    request = {
+        "command": "dispense",
+        "requestId": slot.request_id,
+        "timestamp": slot.timestamp,
+    }
+    if dispense_mode() == "command":
+        clients.client("iot-data").publish(
+            topic=f"cmd/{dispenser}", qos=1, payload=json.dumps(request)
+        )
+    else:
+        # Add/replace request in desired state
+        clients.client("iot-data").update_thing_shadow(
+            thingName=dispenser,
+            payload=json.dumps({"state": {"desired": {"request": request}}}),
+        )
 
 
-def iot_publish_event(topic, message):
-    """Publish message to events topic"""
+def received_at(event):
+    """Time (seconds) the API request or the dispenser's response reached
+    API Gateway or IoT Core, None if not in the event"""
 
-    iot_client.publish(topic=topic, payload=json.dumps({"message": message}))
+    if "requestContext" in event:
+        ms = event["requestContext"].get("requestTimeEpoch")
+    else:
+        # Added by the response rules, see cdd/base_services.py
+        ms = event.get("receivedAt")
+    return None if ms is None else ms / 1000
 
 
 def process_api_event(event, dispenser_table, event_table):
     """Process dispense REQUEST based on API Gateway claims and query parameters"""
+    start = time.perf_counter()
+    started_at = time.time()
     try:
         # Id of dispenser (app) that invoked the Lambda
         dispenser = str(
@@ -172,76 +301,71 @@ def process_api_event(event, dispenser_table, event_table):
         print(f"Params: {params}, dispenser: {dispenser}")
         if "dispenserId" in params:
             if params["dispenserId"] == dispenser:
-                # Get current dispenser record and validate credits and request status
-                dispenser_record = read_dispenser(dispenser, dispenser_table)
-                if dispenser_record["credits"] < 1.00:
-                    # Not enough to dispense
-                    log_event(
-                        event_table,
-                        dispenser,
-                        f"Dispense: ERROR: dispenser: {dispenser} only has "
-                        f'${dispenser_record["credits"]:0.2f} credits, at '
-                        f"least $1.00 required to activate dispenser",
-                    )
-                    return http_response(
-                        httpHeaders,
-                        200,
-                        f'Dispenser: {dispenser} only has ${dispenser_record["credits"]:0.2f} '
-                        f"credits, at least $1.00 required to activate dispenser",
+                # Validate credits and reserve the request slot in a single call
+                request_id = get_request_id()
+                spans = metrics.Spans(requestId=request_id, dispenserId=dispenser)
+                if received_at(event) is not None:
+                    spans.add("ApiReceive", started_at - received_at(event))
+                with spans.time("Reservation"):
+                    slot, dispenser_record = reserve_dispense(
+                        dispenser, request_id, dispenser_table
                     )
-                dispense_request = request_details(
-                    requests=dispenser_record["requests"], command="dispense"
-                )
-                if dispense_request is not None:
-                    if (time.time() - dispense_request["timestamp"]) < 5:
-                        # request still current
+                if slot is None:
+                    if dispenser_record is None:
+                        return http_response(
+                            httpHeaders,
+                            200,
+                            f"ERROR: Dispenser {dispenser} does not exist",
+                        )
+                    if dispenser_record["credits"] < DISPENSE_COST:
+                        # Not enough to dispense
                         log_event(
                             event_table,
                             dispenser,
-                            f'Dispense: ERROR: request {dispense_request["requestId"]} already in progress',
+                            f"Dispense: ERROR: dispenser: {dispenser} only has "
+                            f'${dispenser_record["credits"]:0.2f} credits, at '
+                            f"least $1.00 required to activate dispenser",
                         )
                         return http_response(
                             httpHeaders,
                             200,
-                            "Dispense operation already in progress, no action taken",
+                            f'Dispenser: {dispenser} only has ${dispenser_record["credits"]:0.2f} '
+                            f"credits, at least $1.00 required to activate dispenser",
                         )
-                    else:
-                        # Stale request, remove from request list and continue
-                        dispenser_record = remove_request(
-                            record=dispenser_record, command="dispense"
-                        )
-                # All request checks completed
-                # No in-flight requests, create new one and append to requests
-                request_id = get_request_id()
-                dispenser_record["requests"].append(
-                    f"{request_id}|dispense|{time.time()}|dispenser"
-                )
-                write_dispenser_record(dispenser_record, dispenser_table)
-                message = {
-                    "state": {
-                        "desired": {
-                            "request": {
-                                "command": "dispense",
-                                "requestId": request_id,
-                                "timestamp": time.time(),
-                            }
-                        }
-                    }
-                }
-
-                # Read shadow and add/replace request to desired state
-                iot_client.update_thing_shadow(
-                    thingName=dispenser, payload=json.dumps(message)
-                )
-
-                # iot_client.publish(
-                #     topic=f"cmd/{dispenser}", qos=0, payload=json.dumps(message)
-                # )
-                log_event(
-                    event_table,
-                    dispenser,
-                    f"Dispense: Successful request to dispense initiated, requestId: {request_id}",
+                    # request still current
+                    dispense_request = request_slots.get_slot(
+                        dispenser_record, "dispense"
+                    )
+                    log_event(
+                        event_table,
+                        dispenser,
+                        f"Dispense: ERROR: request "
+                        f'{dispense_request.request_id if dispense_request else "unknown"} '
+                        f"already in progress",
+                        request_id=dispense_request.request_id if dispense_request else None,
+                    )
+                    return http_response(
+                        httpHeaders,
+                        200,
+                        "Dispense operation already in progress, no action taken",
+                    )
+                # Request slot reserved, send the request and log, concurrently
+                def send():
+                    with spans.time("RequestSend"):
+                        send_request(dispenser, slot)
+                    spans.mark("sentAt")
+
+                fanout.gather(
+                    send,
+                    lambda: log_event(
+                        event_table,
+                        dispenser,
+                        f"Dispense: Successful request to dispense initiated, requestId: {request_id}",
+                        request_id=request_id,
+                    ),
                 )
+                spans.add("ApiHandler", time.perf_counter() - start)
+                spans.emit(Mode=dispense_mode())
                 return http_response(
                     httpHeaders, 200, f"Dispenser {dispenser} requested to be activated"
                 )
@@ -260,19 +384,31 @@ def process_api_event(event, dispenser_table, event_table):
         return http_response(httpHeaders, 500, e)
 
 
+def dispenser_response(event):
+    """(dispenser, response, mode) of a message from the dispenser, from its
+    shadow ($aws/things/NNN/shadow/update/accepted, the response is in
+    state.reported.response) or the command response topic (cmd/NNN/response,
+    the message is the response). KeyError if there is no response object."""
+
+    topic = event["topic"]
+    if topic.startswith("cmd/"):
+        return topic.split("/")[1], event, "command"
+    return topic.split("/")[2], event["state"]["reported"]["response"], "shadow"
+
+
 def process_iot_event(event, dispenser_table, event_table):
     """Process event sent via IoT Rules Engine action, this originates from the dispenser,
        and the event comes from the topic $aws/things/NNN/shadow/update/accepted
+       or cmd/NNN/response (see dispenser_response())
 
-        If the value state.reported.response is found in the shadow event, reconcile
-        and clear the value out.
+        If a response is found in the event, reconcile it and clear the value out.
     """
 
-    dispenser = event["topic"].split("/")[2]
-
+    started_at = time.time()
     try:
-        if event["state"]["reported"].get("response") is not None:
-            event_request_id = event["state"]["reported"]["response"]["requestId"]
+        dispenser, response, mode = dispenser_response(event)
+        if response is not None:
+            event_request_id = response["requestId"]
         else:
             # Response object found but NULL, ignore as this is us clearing out the
             # object below
@@ -283,106 +419,118 @@ def process_iot_event(event, dispenser_table, event_table):
         # No response object found, shadow event not of interest
         return
     try:
-        # Check for corresponding requestId in event from DynamoDB table
-        event_response_result = event["state"]["reported"]["response"]["result"]
-        dispenser_record = read_dispenser(dispenser, dispenser_table)
-        dispense_request = request_details(
-            requests=dispenser_record["requests"], command="dispense"
+        # Reconcile the requestId against the DynamoDB record, the request is removed
+        # (and on success the credit deducted) only if it matches
+        event_response_result = response["result"]
+        spans = metrics.Spans(
+            requestId=event_request_id, dispenserId=dispenser, result=event_response_result
         )
+        with spans.time("Reconciliation"):
+            dispenser_record = complete_dispense(
+                dispenser,
+                event_request_id,
+                deduct=(event_response_result == "success"),
+                table=dispenser_table,
+            )
         logger.info(f"got request from shadow and DDB, shadow: {event}, DDB: {dispenser_record}")
-        if dispense_request is not None:
-            if (event_request_id == dispense_request["requestId"]) and (
-                event_response_result == "success"
-            ):
-                # request still current - delete request, deduct $1.00 from  dispenser, and log
-                dispenser_record = remove_request(
-                    record=dispenser_record, command="dispense"
-                )
-                dispenser_record["credits"] = dispenser_record["credits"] - Decimal(
-                    1.00
-                )
-                write_dispenser_record(dispenser_record, dispenser_table)
-                # Set ring LED with new state (if needed) and clear out request and response objects
-                count, color = set_led_ring(dispenser_record["credits"])
-                new_state = {
-                    "state": {
-                        "desired": {"led_ring": {"count": count, "color": color}},
-                        "reported": {"response": None},
-                    }
-                }
-                iot_client.update_thing_shadow(
-                    thingName=dispenser, payload=json.dumps(new_state)
-                )
-
-                # Place on events topic to trigger app to refresh - will also generate log entry
-                iot_publish_event(
-                    topic=f"events/{dispenser}",
-                    message=(
-                        f"Dispense: Successfully dispensed for request "
-                        f'{dispense_request["requestId"]} after '
-                        f'{(time.time() - dispense_request["timestamp"]):0.2f} seconds, '
-                        f"$1.00 deducted from credits",
-                    ),
-                )
-            elif (event_request_id == dispense_request["requestId"]) and (
-                event_response_result == "failure"
-            ):
-                # dispenser reporting error, remove dispense entry but do not deduct credits
-                dispenser_record = remove_request(
-                    record=dispenser_record, command="dispense"
-                )
-                write_dispenser_record(dispenser_record, dispenser_table)
-
-                # Clean out any request/response objects, no need to touch rest of dispenser
-                new_state = {
-                    "state": {
-                        "desired": {"request": None},
-                        "reported": {"response": None},
+        if dispenser_record is not None:
+            dispense_request = request_slots.get_slot(dispenser_record, "dispense")
+            spans.add("DispenseLatency", time.time() - dispense_request.timestamp)
+            if received_at(event) is not None:
+                # DeviceReport ends here, see dispense_latency.py
+                spans.mark("receivedAt", received_at(event))
+                spans.add("RuleDelivery", started_at - received_at(event))
+            with spans.time("Completion"):
+                if event_response_result == "success":
+                    # request was current - request deleted, $1.00 deducted from dispenser, log
+                    credits = dispenser_record["credits"] - DISPENSE_COST
+                    # Set ring LED with new state (if needed) and clear out response object,
+                    # and place on events topic to trigger app to refresh - will also
+                    # generate log entry
+                    fanout.gather(
+                        lambda: update_led_ring(
+                            dispenser_table,
+                            dispenser,
+                            credits,
+                            dispenser_record,
+                            # Only a shadow response needs clearing
+                            state={"reported": {"response": None}} if mode == "shadow" else None,
+                        ),
+                        lambda: iot_publish_event(
+                            topic=f"events/{dispenser}",
+                            message=(
+                                f"Dispense: Successfully dispensed for request "
+                                f"{dispense_request.request_id} after "
+                                f"{(time.time() - dispense_request.timestamp):0.2f} seconds, "
+                                f"$1.00 deducted from credits",
+                            ),
+                            request_id=dispense_request.request_id,
+                        ),
+                    )
+                else:
+                    # dispenser reporting error, dispense entry removed but credits not deducted
+                    # Clean out any request/response objects, no need to touch rest of dispenser
+                    new_state = {
+                        "state": {
+                            "desired": {"request": None},
+                            "reported": {"response": None},
+                        }
                     }
-                }
-                iot_client.update_thing_shadow(
-                    thingName=dispenser, payload=json.dumps(new_state)
-                )
-
-                # Log entry directly to event table, no change to state
+                    # Clear them (only in the shadow in shadow mode) and log entry
+                    # directly to event table, concurrently
+                    calls = [
+                        lambda: log_event(
+                            event_table,
+                            dispenser,
+                            f"Dispense: ERROR, did not dispense for request "
+                            f"{dispense_request.request_id} after "
+                            f"{(time.time() - dispense_request.timestamp):0.2f} seconds, "
+                            f"dispenser reported failure. No credits deducted",
+                            request_id=dispense_request.request_id,
+                        )
+                    ]
+                    if mode == "shadow":
+                        calls.append(
+                            lambda: clients.client("iot-data").update_thing_shadow(
+                                thingName=dispenser, payload=json.dumps(new_state)
+                            )
+                        )
+                    fanout.gather(*calls)
+            spans.emit(Mode=mode)
+        else:
+            # requestId does not match, clear and do not deduct
+            dispense_request = discard_dispense(dispenser, dispenser_table)
+            if dispense_request is not None:
                 log_event(
                     event_table,
                     dispenser,
-                    f"Dispense: ERROR, did not dispense for request "
-                    f'{dispense_request["requestId"]} after '
-                    f'{(time.time() - dispense_request["timestamp"]):0.2f} seconds, '
-                    f"dispenser reported failure. No credits deducted",
+                    f"Dispense: ERROR, dispenser requestId {event_request_id} "
+                    f"does not match stored request {dispense_request.request_id}, "
+                    f"reset request state and NO credits deducted",
+                    request_id=event_request_id,
                 )
             else:
-                # requestId does not match, clear and do not deduct
-                dispenser_record = remove_request(
-                    record=dispenser_record, command="dispense"
-                )
-                write_dispenser_record(dispenser_record, dispenser_table)
+                # Should not get here normally, discard response and log
                 log_event(
                     event_table,
                     dispenser,
-                    f'Dispense: ERROR, dispenser requestId {event["requestId"]} '
-                    f'does not match stored request {dispense_request["requestId"]}, '
-                    f"reset request state and NO credits deducted",
+                    f"Dispense: ERROR, requestId: {event_request_id} not found "
+                    f"in Dispenser database, no action taken",
+                    request_id=event_request_id,
                 )
-        else:
-            # Should not get here normally, discard response and log
-            log_event(
-                event_table,
-                dispenser,
-                f'Dispense: ERROR, requestId: {event["requestId"]} not found '
-                f"in Dispenser database, no action taken",
-            )
     except KeyError as e:
         logger.error("Error: %s", e)
     return
 
 
+@idempotency.idempotent("dispense")
 def handler(event, context):
     """Dispense drink if credits are available or reconcile outstanding operations"""
     logger.info("Received event: {}".format(json.dumps(event)))
 
+    dispenser_table = clients.table(os.environ["DISPENSER_TABLE"])
+    event_table = clients.table(os.environ["EVENT_TABLE"])
+
     if "queryStringParameters" in event:
         # Invoked by API Gateway, should only have one parameter
         if event["queryStringParameters"] is not None:
@@ -0,0 +1,122 @@
+"""
+Returns a page of dispenser event history, newest first
+
+Query string parameters (all optional):
+    limit - events per page, default 50, at most 100
+    from, to - ISO 8601 UTC times bounding the events, default the event
+               retention period up to now
+    next - continuation token from the previous page's response
+    dispenserId - admin only, another dispenser's events, or "all" for the
+                  events of all dispensers
+    requestId - only the events of this dispense request, oldest first (the
+                other parameters are ignored)
+
+Response body:
+    {"events": [{"dispenserId": "105", "timestamp": "...", "log": "..."}, ...],
+     "next": "<token>" or null on the last page}
+
+Environment Variables:
+  EVENT_TABLE - DDB table of dispenser events
+"""
+
+import base64
+import binascii
+import json
+import logging
+from datetime import datetime, timezone
+from decimal import Decimal, InvalidOperation
+
+from cdd_common import events
+from cdd_common.responses import HTTP_HEADERS, http_response
+
+__copyright__ = (
+    "Copyright 2019 Amazon.com, Inc. or its affiliates. All Rights Reserved."
+)
+__license__ = "MIT-0"
+
+logger = logging.getLogger()
+logger.setLevel(logging.INFO)
+
+DEFAULT_LIMIT = 50
+MAX_LIMIT = 100
+
+
+def encode_token(last):
+    """Opaque continuation token for the (ts, pk) of a page's last event"""
+    ts, pk = last
+    return base64.urlsafe_b64encode(json.dumps([str(ts), pk]).encode()).decode()
+
+
+def decode_token(token):
+    """(ts, pk) from a continuation token, raises ValueError if invalid"""
+    try:
+        ts, pk = json.loads(base64.urlsafe_b64decode(token.encode()))
+        return Decimal(ts), str(pk)
+    except (binascii.Error, TypeError, InvalidOperation) as e:
+        raise ValueError(f"invalid token: {e}")
+
+
+def parse_time(value):
+    """datetime (naive UTC) of an ISO 8601 time such as 2019-12-10T17:46:40Z
+    or 2019-12-10T18:46:40+01:00, raises ValueError if invalid"""
+    if value.endswith("Z"):
+        value = value[:-1] + "+00:00"
+    at = datetime.fromisoformat(value)
+    if at.tzinfo is not None:
+        at = at.astimezone(timezone.utc).replace(tzinfo=None)
+    return at
+
+
+def strip_keys(items):
+    """Event items without the table keys, returns items"""
+    for item in items:
+        for key in ("pk", "ts", "expiresAt", "timeBucket"):
+            item.pop(key, None)
+    return items
+
+
+def handler(event, context):
+    """Return a page of the caller's dispenser events, or any dispenser's
+    (or all) for admins"""
+    logger.info("Received event: {}".format(json.dumps(event)))
+
+    claims = event["requestContext"]["authorizer"]["claims"]
+    params = event.get("queryStringParameters") or {}
+    # The workshop admin has no dispenser, so must name one (or "all")
+    own_dispenser_id = claims.get("custom:dispenserId")
+    dispenser_id = params.get("dispenserId", own_dispenser_id)
+    if dispenser_id is None:
+        return http_response(HTTP_HEADERS, 400, 'ERROR: Parameter "dispenserId" must be present')
+    if dispenser_id != own_dispenser_id and claims.get("custom:group") != "admin":
+        return http_response(
+            HTTP_HEADERS, 403, "ERROR: Only admins may read other dispensers' events"
+        )
+    if "requestId" in params:
+        items = [
+            item
+            for item in events.for_request(params["requestId"])
+            if dispenser_id == "all" or item["dispenserId"] == dispenser_id
+        ]
+        return http_response(HTTP_HEADERS, 200, {"events": strip_keys(items), "next": None})
+    try:
+        limit = int(params.get("limit", DEFAULT_LIMIT))
+        if not 0 < limit <= MAX_LIMIT:
+            raise ValueError(f"limit must be between 1 and {MAX_LIMIT}")
+        start = parse_time(params["from"]) if "from" in params else None
+        end = parse_time(params["to"]) if "to" in params else None
+        after = decode_token(params["next"]) if "next" in params else None
+    except ValueError as e:
+        return http_response(HTTP_HEADERS, 400, f"ERROR: {e}")
+
+    items, last = events.history(
+        None if dispenser_id == "all" else dispenser_id,
+        limit=limit,
+        start=start,
+        end=end,
+        after=after,
+    )
+    return http_response(
+        HTTP_HEADERS,
+        200,
+        {"events": strip_keys(items), "next": encode_token(last) if last else None},
+    )
@@ -4,6 +4,20 @@ Methods to create and return resource values
 Function and resource created:
 
 iam_user - IAM user assigned to specific group for role permissions
+iot_thing - IoT thing named for the dispenser
+iot_certificate - private key and certificate, claimed from the pool or
+                  registered with AWS IoT
+iot_attach - policy and thing attached to the certificate, initial shadow
+cognito_iot_policy - IoT policy attached to the Cognito identity
+cloud9_instance - Cloud9 environment owned by the IAM user
+initialize_dispenser_tables - initial dispenser record and event
+
+Each function is safe to call from the provisioning worker pool, see
+provisioning.py, and to call again for resources that an earlier attempt
+created: existing users, things, attachments and dispenser records are
+reused. A certificate is only reused from the checkpoint, as its private key
+cannot be recovered, iot_attach() deletes certificates left attached to the
+thing by an earlier attempt.
 
 """
 
@@ -12,16 +26,17 @@ import json
 import logging
 import time
 import random
-import boto3
+import threading
+from contextlib import contextmanager
 from decimal import Decimal
-from datetime import datetime
 from botocore.exceptions import ClientError
-from cryptography.hazmat.backends import default_backend
-from cryptography.hazmat.primitives import serialization
-from cryptography.hazmat.primitives.asymmetric import ec
-from cryptography import x509
-from cryptography.x509.oid import NameOID
-from cryptography.hazmat.primitives import hashes
+
+from cdd_common import certificates, clients, events, password_policy, retry
+
+# NOTE: cryptography is provided by the crypto layer and only imported when a
+# key and CSR are generated, see certificates.generate_key_and_csr(). This
+# keeps the import cost off the cold start of the common read-only
+# /getResources path.
 
 __copyright__ = (
     "Copyright 2019 Amazon.com, Inc. or its affiliates. All Rights Reserved."
@@ -54,6 +69,14 @@ o/ufQJVtMVT8QtPHRh8jrdkPSHCa2XV4cdFyQzR1bldZwgJcJmApzyMZFo6IQ6XU
 rqXRfboQnoZsG4q5WTP468SQvvG5
 -----END CERTIFICATE-----"""
 
+# Password policy mode, "stack" if the workshop password policy is applied by
+# the stack for the life of the workshop (see cr_password_policy), otherwise
+# "per_user" to relax the account policy while each IAM user is created
+PASSWORD_POLICY_STACK = "stack"
+_password_policy_lock = threading.Lock()
+_password_policy_users = 0
+_account_password_policy = None
+
 shadow_clear = json.dumps({"state": {"reported": None, "desired": None}})
 shadow_initial = json.dumps(
     {
@@ -68,18 +91,6 @@ shadow_initial = json.dumps(
 )
 
 
-class DecimalEncoder(json.JSONEncoder):
-    """Helper class to convert DynamoDB item to JSON"""
-
-    def default(self, o):  # pylint: disable=E0202
-        if isinstance(o, decimal.Decimal):  # pylint: disable=E0602
-            if o % 1 > 0:
-                return float(o)
-            else:
-                return int(o)
-        return super(DecimalEncoder, self).default(o)
-
-
 def create_password():
     """Create a random password"""
     animal_word_list = [
@@ -114,276 +125,181 @@ def create_password():
         return f"{building_word_list[random.randint(0, 10)]}{random.randint(100, 999)}{animal_word_list[random.randint(0, 10)]}"
 
 
-def iam_user(username, iam_group):
-    "Create user with random password and assign to IAM group name"
+@contextmanager
+def relaxed_password_policy():
+    """Apply the workshop password policy while IAM users are being created
 
-    iam_client = boto3.client("iam")
-    asset = {"iam_user": {}}
+    Concurrent callers (the provisioning worker pool) share a single policy
+    swap: the first caller in stores the account policy and relaxes it, the
+    last caller out restores it. Nothing to do when the stack applies the
+    policy (PASSWORD_POLICY_MODE is "stack").
 
-    # Read current IAM password policy and store
-    # NOTE - Not safe for multiple users make changes at the same time - worst case is password policy is set to
-    # workshop settings.
+    NOTE: Separate invocations each swap the policy, and can restore it while
+    another is creating a user, use the "stack" mode for concurrent signups.
+    """
 
-    start_time = time.time()
-    temppol = {
-        "MinimumPasswordLength": 6,
-        "RequireSymbols": False,
-        "RequireNumbers": True,
-        "RequireUppercaseCharacters": False,
-        "RequireLowercaseCharacters": True,
-        "AllowUsersToChangePassword": False,
-    }
-    while (time.time() - start_time) < 300:
-        try:
-            prodPasswordPolicy = iam_client.get_account_password_policy()["PasswordPolicy"]
-            prodPasswordPolicy.pop("ExpirePasswords", None)
-            break
-        except iam_client.exceptions.NoSuchEntityException as e:
-            # There is no policy set, so create one based on temppol above to revert to when user created
-            prodPasswordPolicy = temppol
-            break
-        except ClientError as e:
-            # Any other errors, such as API limit timeouts
-            logger.warning(
-                f"Error calling iam.get_account_password_policy() (will retry) for user {username}, error: {e}"
-            )
-            time.sleep(2)
-            continue
+    global _password_policy_users, _account_password_policy
 
-    start_time = time.time()
-    while (time.time() - start_time) < 300:
-        try:
-            iam_client.update_account_password_policy(**temppol)
-            break
-        except ClientError as e:
-            logger.warning(
-                f"Error calling iam.update_account_password_policy (will retry) for user {username}, error: {e}"
-            )
-            time.sleep(2)
-            continue
+    if os.environ.get("PASSWORD_POLICY_MODE") == PASSWORD_POLICY_STACK:
+        yield
+        return
+    with _password_policy_lock:
+        if _password_policy_users == 0:
+            _account_password_policy = password_policy.get_policy()
+            password_policy.set_policy(password_policy.WORKSHOP_PASSWORD_POLICY)
+        _password_policy_users += 1
+    try:
+        yield
+    finally:
+        with _password_policy_lock:
+            _password_policy_users -= 1
+            if _password_policy_users == 0:
+                # Reset password policy back to original
+                password_policy.set_policy(_account_password_policy)
 
-    start_time = time.time()
-    while (time.time() - start_time) < 300:
-        try:
-            result = iam_client.create_user(UserName=username)
-            asset["iam_user"]["userArn"] = result["User"]["Arn"]
-            asset["iam_user"]["username"] = result["User"]["UserName"]
-            asset["iam_user"]["password"] = create_password()
-            break
-        except ClientError as e:
-            logger.warning(
-                f"Error calling iam.create_user (will retry) for user {username}, error: {e}"
-            )
-            time.sleep(2)
-            continue
-    start_time = time.time()
-    while (time.time() - start_time) < 300:
-        try:
-            iam_client.create_login_profile(
-                UserName=username,
-                Password=asset["iam_user"]["password"],
-                PasswordResetRequired=False,
-            )
-            break
-        except ClientError as e:
-            logger.warning(
-                f"Error calling iam.create_user (will retry) for user {username}, error: {e}"
-            )
-            time.sleep(2)
-            continue
 
-    start_time = time.time()
-    while (time.time() - start_time) < 300:
+def iam_user(username, iam_group):
+    """Create user with random password and assign to IAM group name, an
+    existing user is given a new password"""
+
+    asset = {"iam_user": {}}
+
+    with relaxed_password_policy():
         try:
-            iam_client.add_user_to_group(GroupName=iam_group, UserName=username)
-            break
+            result = retry.call("iam", "create_user", UserName=username)
         except ClientError as e:
-            logger.warning(
-                f"Error calling iam.add_user_to_group (will retry) for user {username}, error: {e}"
-            )
-            time.sleep(2)
-            continue
-
-    # Reset password policy back to original
-    start_time = time.time()
-    while (time.time() - start_time) < 300:
+            if e.response["Error"]["Code"] != "EntityAlreadyExists":
+                raise
+            logger.info(f"IAM user {username} already exists")
+            result = retry.call("iam", "get_user", UserName=username)
+        asset["iam_user"]["userArn"] = result["User"]["Arn"]
+        asset["iam_user"]["username"] = result["User"]["UserName"]
+        asset["iam_user"]["password"] = create_password()
+        # The new user, and the relaxed password policy, are eventually consistent
+        login_profile = {
+            "retry_on": ("NoSuchEntity", "PasswordPolicyViolation"),
+            "UserName": username,
+            "Password": asset["iam_user"]["password"],
+            "PasswordResetRequired": False,
+        }
         try:
-            iam_client.update_account_password_policy(**prodPasswordPolicy)
-            break
+            retry.call("iam", "create_login_profile", **login_profile)
         except ClientError as e:
-            logger.warning(
-                f"Error calling iam.add_user_to_group (will retry) for user {username}, error: {e}"
-            )
-            time.sleep(2)
-            continue
-
+            if e.response["Error"]["Code"] != "EntityAlreadyExists":
+                raise
+            retry.call("iam", "update_login_profile", **login_profile)
+
+    retry.call(
+        "iam",
+        "add_user_to_group",
+        retry_on=("NoSuchEntity",),
+        GroupName=iam_group,
+        UserName=username,
+    )
     return asset
 
 
-def iot_thing_certificate(dispenser_id, iot_policy):
-    """Create IoT thing, private key and CSR, register with AWS IoT and 
-    return iot assets"""
+def iot_thing(dispenser_id):
+    """Create IoT thing and return iot assets"""
 
-    iot_client = boto3.client("iot")
-    iot_data_client = boto3.client("iot-data")
-    asset = {"iot": {"thingName": dispenser_id}}
+    try:
+        retry.call("iot", "create_thing", thingName=dispenser_id)
+    except ClientError as e:
+        # Only raised if the existing thing has different attributes
+        if e.response["Error"]["Code"] != "ResourceAlreadyExistsException":
+            raise
+        logger.info(f"IoT thing {dispenser_id} already exists")
+    return {"iot": {"thingName": dispenser_id}}
+
+
+def iot_certificate(dispenser_id):
+    """Claim the pre-generated certificate for the dispenser from the pool, or
+    when there is none create a private key and certificate, and return iot
+    assets"""
+
+    certificate = None
+    if os.environ.get("CERT_POOL_TABLE"):
+        certificate = certificates.claim_certificate(
+            clients.table(os.environ["CERT_POOL_TABLE"]), dispenser_id
+        )
+        if certificate is None:
+            logger.warning(f"No pooled certificate for dispenser {dispenser_id}")
+    if certificate is None:
+        certificate = certificates.create_certificate(dispenser_id)
+    return {"iot": {**certificate, "rootCA": amazon_root_ca_ca1}}
 
 
-    # Due to API throttling, AWS IoT calls need to tried with backoff timers
-    # in lock-step to crete the resources. Track by dispenserId to match
-    # back to user.
+def detach_other_certificates(dispenser_id, certificate_arn, iot_policy):
+    """Delete certificates other than certificate_arn attached to the thing by
+    an earlier provisioning attempt"""
 
-    start_time = time.time()
-    while (time.time() - start_time) < 300:
-        try:
-            # Create thing
-            iot_client.create_thing(thingName=dispenser_id)
-            break
-        except ClientError as e:
-            logger.warning(
-                f"Error calling iot.create_thing() (will retry) for dispenser {dispenser_id}, error: {e}"
-            )
-            time.sleep(2)
+    principals = retry.call("iot", "list_thing_principals", thingName=dispenser_id)
+    for principal in principals["principals"]:
+        if principal == certificate_arn:
             continue
-
-    # Create certificate and private key
-    key = ec.generate_private_key(curve=ec.SECP256R1(), backend=default_backend())
-    # key = rsa.generate_private_key(
-    #     public_exponent=65537, key_size=2048, backend=default_backend()
-    # )
-    private_key = key.private_bytes(
-        encoding=serialization.Encoding.PEM,
-        format=serialization.PrivateFormat.TraditionalOpenSSL,
-        encryption_algorithm=serialization.NoEncryption(),
-    ).decode("utf-8")
-    asset["iot"]["privateKey"] = private_key
-
-    # Generate a CSR and set subject (CN=dispenserId)
-    csr = (
-        x509.CertificateSigningRequestBuilder()
-        .subject_name(
-            x509.Name(
-                [
-                    # Provide various details about who we are.
-                    x509.NameAttribute(NameOID.COUNTRY_NAME, "US"),
-                    x509.NameAttribute(NameOID.STATE_OR_PROVINCE_NAME, "NV"),
-                    x509.NameAttribute(NameOID.LOCALITY_NAME, "Las Vegas"),
-                    x509.NameAttribute(NameOID.ORGANIZATION_NAME, "re:Invent 2084"),
-                    x509.NameAttribute(NameOID.COMMON_NAME, dispenser_id),
-                ]
-            )
+        logger.info(f"Deleting certificate {principal} from an earlier attempt")
+        retry.call(
+            "iot", "detach_thing_principal", thingName=dispenser_id, principal=principal
         )
-        .sign(key, hashes.SHA256(), default_backend())
-    )
+        retry.call(
+            "iot", "detach_principal_policy", policyName=iot_policy, principal=principal
+        )
+        certificates.delete_certificate(principal)
 
-    # Generate and create AWS IoT certificate
-    # NOTE: Use the ECDHE-ECDSA-AES128-SHA256 and CA3 root for communication
-    start_time = time.time()
-    while (time.time() - start_time) < 300:
-        try:
-            result = iot_client.create_certificate_from_csr(
-                certificateSigningRequest=str(
-                    csr.public_bytes(serialization.Encoding.PEM), "utf-8"
-                ),
-                setAsActive=True,
-            )
-            asset["iot"]["certificateArn"] = result["certificateArn"]
-            asset["iot"]["certificatePem"] = result["certificatePem"]
-            asset["iot"]["rootCA"] = amazon_root_ca_ca1
-            break
-        except ClientError as e:
-            logger.warning(
-                f"Error calling iot.create_certificate() (will retry) for dispenser {dispenser_id}, error: {e}"
-            )
-            time.sleep(2)
-            continue
 
-    # Thing and certificate created, attach thing <-> certificate <-> policy
-    # Policy to certificate
-    start_time = time.time()
-    while (time.time() - start_time) < 300:
-        try:
-            iot_client.attach_principal_policy(
-                policyName=iot_policy, principal=asset["iot"]["certificateArn"]
-            )
-            break
-        except ClientError as e:
-            logger.warning(
-                f"Error calling iot.attach_principal_policy() policy to cert (will retry) for dispenser {dispenser_id}, error: {e}"
-            )
-            time.sleep(2)
-            continue
+def iot_attach(dispenser_id, certificate_arn, iot_policy, resume=False):
+    """With thing and certificate created, attach thing <-> certificate <-> policy
+    and set the initial shadow state"""
 
-    # Thing to certificate
-    start_time = time.time()
-    while (time.time() - start_time) < 300:
-        try:
-            iot_client.attach_thing_principal(
-                thingName=asset["iot"]["thingName"], principal=asset["iot"]["certificateArn"]
-            )
-            break
-        except ClientError as e:
-            logger.warning(
-                f"Error calling iot.attach_principal_policy() thing to cert (will retry) for dispenser {dispenser_id}, error: {e}"
-            )
-            time.sleep(2)
-            continue
+    if resume:
+        detach_other_certificates(dispenser_id, certificate_arn, iot_policy)
 
-    
-    start_time = time.time()
-    while (time.time() - start_time) < 300:
-        try:
-            # Clear then create initial shadow state
-            iot_data_client.update_thing_shadow(
-                thingName=asset["iot"]["thingName"], payload=shadow_clear
-            )
-            # Then set initial state
-            iot_data_client.update_thing_shadow(
-                thingName=asset["iot"]["thingName"], payload=shadow_initial
-            )
-            break
-        except ClientError as e:
-            logger.warning(
-                f"Error calling iot.update_thing_shadow()  (will retry) for dispenser {dispenser_id}, error: {e}"
-            )
-            time.sleep(2)
-            continue
-    return asset
+    # Policy to certificate
+    retry.call(
+        "iot",
+        "attach_principal_policy",
+        retry_on=("ResourceNotFoundException",),
+        policyName=iot_policy,
+        principal=certificate_arn,
+    )
+    # Thing to certificate
+    retry.call(
+        "iot",
+        "attach_thing_principal",
+        retry_on=("ResourceNotFoundException",),
+        thingName=dispenser_id,
+        principal=certificate_arn,
+    )
+    # Clear then create initial shadow state
+    retry.call(
+        "iot-data", "update_thing_shadow", thingName=dispenser_id, payload=shadow_clear
+    )
+    # Then set initial state
+    retry.call(
+        "iot-data",
+        "update_thing_shadow",
+        thingName=dispenser_id,
+        payload=shadow_initial,
+    )
+    return {}
 
 
 def cognito_iot_policy(cognito_identity_id, iot_policy):
     """Attach Cognito identity to IoT policy"""
 
-    asset = {"cognito": {}}
-    iot_client = boto3.client("iot")
-
-    start_time = time.time()
-    while (time.time() - start_time) < 300:
-        try:
-            iot_client.attach_policy(policyName=iot_policy, target=cognito_identity_id)
-            asset["cognito"]["principalId"] = cognito_identity_id
-            asset["cognito"]["iotPolicy"] = iot_policy
-            return asset
-        except ClientError as e:
-            logger.warning(
-                f"Error calling iot.attach_policy() cognito (will retry) for cognito_id {cognito_identity_id}, error: {e}"
-            )
-            time.sleep(2)
-            continue
-    logger.error(
-        f"ERROR: Could not attach principal {cognito_identity_id} to policy {iot_policy} after 300 seconds"
+    retry.call(
+        "iot", "attach_policy", policyName=iot_policy, target=cognito_identity_id
     )
-    return False
+    return {"cognito": {"principalId": cognito_identity_id, "iotPolicy": iot_policy}}
 
 
 def initialize_dispenser_tables(dispenser_id):
     """With assets created, make the initial entries and credit for the participant's
-    dispenser"""
+    dispenser, an existing dispenser record is left as is"""
 
     try:
-        ddb = boto3.resource("dynamodb")
+        ddb = clients.resource("dynamodb")
         log_entry = f"IoT: Initial shadow set for dispenser {dispenser_id}"
-        ts = datetime.utcnow().isoformat() + "Z"
 
         # Create default DispenserStatus document
         dispenser_table = ddb.Table(os.environ["DISPENSER_TABLE"])
@@ -392,51 +308,70 @@ def initialize_dispenser_tables(dispenser_id):
             "credits": Decimal(str(1.00)),
             "leaderBoardStatus": Decimal(str(1)),
             "leaderBoardTime": Decimal(int(time.time())),
-            "requests": [],
+            "requests": {},
         }
-        dispenser_table.put_item(Item=item)
+        try:
+            dispenser_table.put_item(
+                Item=item, ConditionExpression="attribute_not_exists(dispenserId)"
+            )
+        except ClientError as e:
+            if e.response["Error"]["Code"] != "ConditionalCheckFailedException":
+                raise
+            logger.info(f"Dispenser {dispenser_id} already initialized")
+            return True
 
-        event_table = ddb.Table(os.environ["EVENT_TABLE"])
-        item = {"dispenserId": dispenser_id, "timestamp": ts, "log": log_entry}
-        event_table.put_item(Item=item)
+        events.put(dispenser_id, log_entry)
         return True
     except ClientError as e:
         logger.error(f"ERROR: Could not update database tables, error: {e}")
         return False
 
 
-def cloud9_instance(owner_arn, instance_type):
-    """Create a Cloud 9 instance for the user in the default VPC"""
+def find_cloud9_environment(name, owner_arn):
+    """Return the id of the owner's Cloud9 environment named name, or None"""
+
+    kwargs = {}
+    while True:
+        response = retry.call("cloud9", "list_environments", **kwargs)
+        ids = response["environmentIds"]
+        # describe_environments takes at most 25 ids
+        for i in range(0, len(ids), 25):
+            for environment in retry.call(
+                "cloud9", "describe_environments", environmentIds=ids[i : i + 25]
+            )["environments"]:
+                if environment["name"] == name and environment["ownerArn"] == owner_arn:
+                    return environment["id"]
+        if not response.get("nextToken"):
+            return None
+        kwargs["nextToken"] = response["nextToken"]
 
-    asset = {"cloud9": {}}
-    client = boto3.client("cloud9")
-    username = owner_arn.split("/")[-1]
 
-    # A new IAM user is not immediately available or throttling on EC23 create.
-    # Loop for up to 300 seconds before hard failing, log errors as info along
-    # the way.
+def cloud9_instance(owner_arn, instance_type, resume=False):
+    """Create a Cloud 9 instance for the user in the default VPC, on resume
+    return the user's existing environment if there is one"""
+
+    username = owner_arn.split("/")[-1]
+    if resume:
+        environment_id = find_cloud9_environment(username, owner_arn)
+        if environment_id:
+            logger.info(f"Cloud9 environment for user {username} already exists")
+            return {"cloud9": {"environmentId": environment_id}}
     start_time = time.time()
-    while (time.time() - start_time) < 300:
-        try:
-            response = client.create_environment_ec2(
-                name=username,
-                description=f"{username} Cloud9 environment",
-                instanceType=instance_type,
-                automaticStopTimeMinutes=60,
-                ownerArn=owner_arn,
-            )
-            asset["cloud9"]["environmentId"] = response["environmentId"]
-            logger.info(
-                f"It took {time.time() - start_time} seconds to create the Cloud9 environment for user: {username}"
-            )
-            return asset
-        except ClientError as e:
-            # Log to collect statistics on average creation time
-            logger.warning(
-                f"Error creating Cloud9 environment (will retry) for user {username}, error: {e}"
-            )
-            time.sleep(2)
-            continue
-    # The Cloud9 instance was not created, log major error
-    logger.error(f"Error creating Cloud 9 environment within 300 seconds for user: {username}")
-    return asset
+
+    # A new IAM user is not immediately available to Cloud9 and is rejected
+    # as an invalid owner, retry until it is
+    response = retry.call(
+        "cloud9",
+        "create_environment_ec2",
+        retry_on=("BadRequestException",),
+        name=username,
+        description=f"{username} Cloud9 environment",
+        instanceType=instance_type,
+        automaticStopTimeMinutes=60,
+        ownerArn=owner_arn,
+    )
+    # Log to collect statistics on average creation time
+    logger.info(
+        f"It took {time.time() - start_time} seconds to create the Cloud9 environment for user: {username}"
+    )
+    return {"cloud9": {"environmentId": response["environmentId"]}}
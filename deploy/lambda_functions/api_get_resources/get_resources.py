@@ -1,21 +1,17 @@
 """
 Method to return users configuration details, and if they don't
-exist, to create the specific assets
+exist, to start a job to create the specific assets, see provisioning_job.py
 
 """
 
 import json
 import os
 import logging
-import time
-import boto3
 from boto3.dynamodb.conditions import Key, Attr
-from botocore.exceptions import ClientError
-from decimal import Decimal
-from collections.abc import MutableMapping
 
-
-import create_resources as AWS_resource
+from cdd_common import clients
+from cdd_common.responses import dumps
+import provisioning_job
 
 __copyright__ = (
     "Copyright 2019 Amazon.com, Inc. or its affiliates. All Rights Reserved."
@@ -27,53 +23,42 @@ logger.setLevel(logging.INFO)
 
 # Global Variables - Lambda manages CORS
 httpHeaders = {"Access-Control-Allow-Origin": "*"}
-ddb = boto3.resource("dynamodb")
-
-
-# Helper class to convert a DynamoDB item to JSON.
-class DecimalEncoder(json.JSONEncoder):
-    def default(self, o):  # pylint: disable=E0202
-        if isinstance(o, decimal.Decimal):  # pylint: disable=E0602
-            if o % 1 > 0:
-                return float(o)
-            else:
-                return int(o)
-        return super(DecimalEncoder, self).default(o)
 
 
 def handler(event, context):
     """This function does not process any parameters, but returns complete
-    details of the user based on username in token"""
+    details of the user based on username in token. If the assets have not
+    been created, a provisioning job is started and its progress returned
+    (status code 202), call again to poll until the assets are returned."""
 
     # Log event
     logger.info("Received event: %s", json.dumps(event))
 
     username = event["requestContext"]["authorizer"]["claims"]["cognito:username"]
     dispenser_id = event["requestContext"]["authorizer"]["claims"]["custom:dispenserId"]
-    table = ddb.Table(os.environ["USER_TABLE"])
+    table = clients.table(os.environ["USER_TABLE"])
 
     # Query user and return contents of assets
     response = table.query(KeyConditionExpression=Key("userName").eq(username))
     if len(response["Items"]) == 1:
         user_db_record = response["Items"][0]
-        if response["Items"][0]["assets"] == "CREATING":
-            # Another call has started the creation process
-            time.sleep(5)
-            logger.error(f"Resources for {username} already in progress")
-            retval = {
-                "body": json.dumps(
-                    {"message": "ERROR: Could not create all resources, see log files"}
-                ),
-                "headers": httpHeaders,
-                "statusCode": 200,
-            }
-            return retval
-        if response["Items"][0]["assets"] == None:
-            # Create assets
+        # Step results of an unfinished job, the assets once complete
+        user_db_record.pop("checkpoints", None)
+        if user_db_record["assets"] in (None, "CREATING"):
+            if provisioning_job.is_active(user_db_record.get("job")):
+                # Another call has started the creation process, return progress
+                return {
+                    "body": dumps(user_db_record),
+                    "headers": httpHeaders,
+                    "statusCode": 202,
+                }
+            # Create assets, or with "retry" in the body resume after a failed
+            # or timed out job
 
             # Validate that required parameters have been provided
             try:
-                cognito_identity_id = json.loads(event["body"])["cognitoIdentityId"]
+                body = json.loads(event["body"])
+                cognito_identity_id = body["cognitoIdentityId"]
             except Exception as e:
                 logger.error(
                     "cognitoIdentityId parameter not found in body, error: %s", e
@@ -85,65 +70,36 @@ def handler(event, context):
                 }
                 return retval
 
-            # First set user record to status of creating in case multiple API calls are made
-            response = table.put_item(
-                Item={
-                    "userName": username,
-                    "dispenserId": dispenser_id,
-                    "assets": "CREATING",
-                }
-            )
-
-            assets = {}
-            try:
-                # IAM user
-                iam_user = AWS_resource.iam_user(
-                    username, os.environ["USER_PERMISSIONS_GROUP"]
-                )
-                if iam_user:
-                    assets.update(iam_user)
-                # IoT Thing and certificates
-                iot = AWS_resource.iot_thing_certificate(
-                    dispenser_id=dispenser_id,
-                    iot_policy=os.environ["IOT_POLICY_DISPENSER_LIMITED"],
-                )
-                if iot:
-                    assets.update(iot)
-                # Associate IoT policy with Cognito identity
-                cognito = AWS_resource.cognito_iot_policy(
-                    cognito_identity_id=cognito_identity_id,
-                    iot_policy=os.environ["IOT_POLICY_CLIENT"],
-                )
-                if cognito:
-                    assets.update(cognito)
-                # Cloud9 Instance
-                cloud9 = AWS_resource.cloud9_instance(
-                    iam_user["iam_user"]["userArn"], os.environ["CLOUD9_INSTANCE_SIZE"]
-                )
-                if cloud9:
-                    assets.update(cloud9)
-                # Initial dispenser status in DDB - no assets returned
-                AWS_resource.initialize_dispenser_tables(dispenser_id)
-            except Exception as e:
-                logger.error("Error during creation of resources, error: %s", e)
-                retval = {
-                    "body": "ERROR: Could not create all resources, see log files",
+            if user_db_record.get("job") and not body.get("retry"):
+                # Failed job, return status
+                return {
+                    "body": dumps(user_db_record),
                     "headers": httpHeaders,
                     "statusCode": 200,
                 }
-                return retval
-            user_db_record["assets"] = assets
-            response = table.put_item(
-                Item={
-                    "userName": username,
-                    "dispenserId": dispenser_id,
-                    "assets": user_db_record["assets"],
-                }
-            )
+
+            # Set user record to status of creating in case multiple API calls are made
+            job = provisioning_job.start_job(table, username)
+            if job is not None:
+                provisioning_job.invoke_worker(
+                    username,
+                    dispenser_id,
+                    cognito_identity_id,
+                    job["jobId"],
+                    job["resume"],
+                )
+            user_db_record = table.get_item(
+                Key={"userName": username}, ConsistentRead=True
+            )["Item"]
+            user_db_record.pop("checkpoints", None)
+            return {
+                "body": dumps(user_db_record),
+                "headers": httpHeaders,
+                "statusCode": 202 if user_db_record["assets"] == "CREATING" else 200,
+            }
         # Return completed assets as a JSON object
-        # body = json.dumps(user_db_record)
         retval = {
-            "body": json.dumps(user_db_record),
+            "body": dumps(user_db_record),
             "headers": httpHeaders,
             "statusCode": 200,
         }
@@ -0,0 +1,269 @@
+"""
+Provisioning engine for participant resources
+
+A participant's resources are created by steps (see create_resources.py)
+whose dependencies form a DAG:
+
+    iam_user ----------------------> cloud9_instance
+    iot_thing -------+
+                     +-> iot_attach -> dispenser_tables
+    iot_certificate -+
+    cognito_iot_policy
+
+Steps run on a shared thread pool as soon as the steps they require have
+completed, so independent API calls (IAM, IoT, certificate generation) overlap
+instead of running in sequence. Bulk mode provisions many participants in one
+invocation with all their steps sharing the same pool.
+
+The result of each completed step is checkpointed by the caller (see
+provisioning_job.py), and passed back in as completed steps when provisioning
+is retried, so a retry only runs the steps that did not complete. As a
+checkpoint can be lost (the worker timed out between the API call and the
+write), each step also tolerates its resources already existing.
+"""
+
+import logging
+import os
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+from typing import Callable, NamedTuple, Tuple
+
+import create_resources as AWS_resource
+
+__copyright__ = (
+    "Copyright 2019 Amazon.com, Inc. or its affiliates. All Rights Reserved."
+)
+__license__ = "MIT-0"
+
+logger = logging.getLogger()
+logger.setLevel(logging.INFO)
+
+# Concurrent API calls per invocation, shared by all users in bulk mode
+MAX_WORKERS = int(os.environ.get("PROVISIONING_WORKERS", "8"))
+
+
+class Step(NamedTuple):
+    """Provisioning step
+
+    function is called with a dict of the results of the required steps and
+    returns an asset dict to merge into the user's assets.
+    """
+
+    name: str
+    function: Callable
+    requires: Tuple[str, ...] = ()
+
+
+class ProvisioningError(Exception):
+    """A step failed, results holds the steps that did complete"""
+
+    def __init__(self, step, error, results):
+        super().__init__(f"Step {step} failed: {error}")
+        self.step = step
+        self.error = error
+        self.results = results
+
+
+def check_steps(steps):
+    """Raise ValueError if steps do not form a DAG of known steps"""
+
+    names = {step.name for step in steps}
+    if len(names) != len(steps):
+        raise ValueError("Duplicate step names")
+    for step in steps:
+        unknown = set(step.requires) - names
+        if unknown:
+            raise ValueError(f"Step {step.name} requires unknown steps {unknown}")
+    ordered = set()
+    remaining = list(steps)
+    while remaining:
+        ready = [s for s in remaining if set(s.requires) <= ordered]
+        if not ready:
+            raise ValueError(
+                f"Cycle between steps {sorted(s.name for s in remaining)}"
+            )
+        ordered.update(s.name for s in ready)
+        remaining = [s for s in remaining if s.name not in ordered]
+
+
+def run_steps(steps, executor, on_step=None, completed=None):
+    """Run steps on executor as their requirements complete
+
+    Returns dict of step name to result. If a step raises, the steps already
+    running are allowed to finish and ProvisioningError is raised with the
+    results of all completed steps; steps not yet started are not run.
+
+    completed is a dict of step name to result of steps completed by an
+    earlier run, these are SKIPPED and their results passed to the steps
+    that require them.
+
+    on_step(name, status, result) is called from this thread with status
+    SKIPPED or RUNNING as each step starts and COMPLETE (with the result) or
+    FAILED as it ends.
+    """
+
+    check_steps(steps)
+    on_step = on_step or (lambda name, status, result: None)
+    completed = completed or {}
+    pending = []
+    running = {}
+    results = {}
+    for step in steps:
+        if step.name in completed:
+            results[step.name] = completed[step.name]
+            on_step(step.name, "SKIPPED", None)
+        else:
+            pending.append(step)
+
+    def submit_ready():
+        for step in [s for s in pending if all(r in results for r in s.requires)]:
+            pending.remove(step)
+            required = {r: results[r] for r in step.requires}
+            on_step(step.name, "RUNNING", None)
+            running[executor.submit(step.function, required)] = step
+
+    def collect(future):
+        step = running.pop(future)
+        try:
+            results[step.name] = future.result()
+        except Exception as e:
+            logger.error(f"Provisioning step {step.name} failed, error: {e}")
+            on_step(step.name, "FAILED", None)
+            return step.name, e
+        on_step(step.name, "COMPLETE", results[step.name])
+        return None
+
+    submit_ready()
+    while running:
+        done, _ = wait(running, return_when=FIRST_COMPLETED)
+        failures = [f for f in map(collect, done) if f]
+        if failures:
+            for future in wait(running).done:
+                collect(future)
+            step_name, error = failures[0]
+            raise ProvisioningError(step_name, error, results) from error
+        submit_ready()
+    return results
+
+
+def merge_assets(results):
+    """Merge step results into the user's assets, steps may contribute to the
+    same asset (thing and certificate both add to "iot")"""
+
+    assets = {}
+    for asset in results.values():
+        for key, value in (asset or {}).items():
+            assets.setdefault(key, {}).update(value)
+    return assets
+
+
+def user_steps(username, dispenser_id, cognito_identity_id, resume=False):
+    """Return the provisioning steps for a participant, resume if an earlier
+    attempt may have created some of the resources"""
+
+    def dispenser_tables(_):
+        if not AWS_resource.initialize_dispenser_tables(dispenser_id):
+            raise RuntimeError(f"Could not initialize tables for {dispenser_id}")
+        return {}
+
+    return [
+        Step(
+            "iam_user",
+            lambda _: AWS_resource.iam_user(
+                username, os.environ["USER_PERMISSIONS_GROUP"]
+            ),
+        ),
+        Step("iot_thing", lambda _: AWS_resource.iot_thing(dispenser_id)),
+        Step("iot_certificate", lambda _: AWS_resource.iot_certificate(dispenser_id)),
+        Step(
+            "iot_attach",
+            lambda r: AWS_resource.iot_attach(
+                dispenser_id,
+                r["iot_certificate"]["iot"]["certificateArn"],
+                os.environ["IOT_POLICY_DISPENSER_LIMITED"],
+                resume,
+            ),
+            requires=("iot_thing", "iot_certificate"),
+        ),
+        Step(
+            "cognito_iot_policy",
+            lambda _: AWS_resource.cognito_iot_policy(
+                cognito_identity_id, os.environ["IOT_POLICY_CLIENT"]
+            ),
+        ),
+        Step(
+            "cloud9_instance",
+            lambda r: AWS_resource.cloud9_instance(
+                r["iam_user"]["iam_user"]["userArn"],
+                os.environ["CLOUD9_INSTANCE_SIZE"],
+                resume,
+            ),
+            requires=("iam_user",),
+        ),
+        Step("dispenser_tables", dispenser_tables, requires=("iot_attach",)),
+    ]
+
+
+def provision_user(
+    username,
+    dispenser_id,
+    cognito_identity_id,
+    executor=None,
+    on_step=None,
+    completed=None,
+    resume=False,
+):
+    """Create all resources for a participant and return their assets,
+    completed and resume are as for run_steps() and user_steps()"""
+
+    if executor is None:
+        with ThreadPoolExecutor(max_workers=MAX_WORKERS) as executor:
+            return provision_user(
+                username,
+                dispenser_id,
+                cognito_identity_id,
+                executor,
+                on_step,
+                completed,
+                resume,
+            )
+    steps = user_steps(username, dispenser_id, cognito_identity_id, resume)
+    return merge_assets(run_steps(steps, executor, on_step, completed))
+
+
+def provision_users(users, max_workers=MAX_WORKERS, on_step=None):
+    """Provision many participants with their steps sharing one worker pool
+
+    users is a list of dicts with userName, dispenserId and cognitoIdentityId,
+    and optionally the user's completed steps and resume flag. on_step(user,
+    name, status, result) reports step progress per user. Returns dict of
+    userName to assets, or to the exception if provisioning that user failed.
+    """
+
+    def provision(user, executor):
+        return provision_user(
+            user["userName"],
+            user["dispenserId"],
+            user["cognitoIdentityId"],
+            executor,
+            on_step
+            and (lambda name, status, result: on_step(user, name, status, result)),
+            user.get("completed"),
+            user.get("resume", False),
+        )
+
+    results = {}
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        # Each user's DAG is driven from a thread of its own while it runs,
+        # at most max_workers users at a time, the API calls themselves are
+        # bounded by the shared step executor
+        with ThreadPoolExecutor(max_workers=max(min(len(users), max_workers), 1)) as drivers:
+            futures = {
+                drivers.submit(provision, user, executor): user["userName"]
+                for user in users
+            }
+            for future in futures:
+                try:
+                    results[futures[future]] = future.result()
+                except Exception as e:
+                    results[futures[future]] = e
+    return results
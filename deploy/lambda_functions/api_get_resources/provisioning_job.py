@@ -0,0 +1,315 @@
+"""
+Asynchronous provisioning jobs
+
+/getResources starts a job for the user and returns immediately. The job is
+run by the provisioning worker function (this module's handler, invoked
+asynchronously), which records the status of each step in the user record
+as it goes:
+
+    "assets": "CREATING",
+    "job": {
+        "jobId": "5f0c...",
+        "status": "RUNNING",
+        "steps": {"iam_user": "COMPLETE", "cloud9_instance": "RUNNING", ...},
+        "startedAt": 1576000000,
+        "updatedAt": 1576000012
+    }
+
+The result of each completed step is checkpointed in the user record:
+
+    "checkpoints": {"iam_user": {"iam_user": {"userArn": ...}}, ...}
+
+On success the assets replace "CREATING", the checkpoints are removed and the
+job status is COMPLETE. On failure the status is FAILED with the failed step
+and error, and the next call to /getResources with "retry" starts a new job.
+A job that has not been updated for JOB_TIMEOUT seconds (worker timed out) is
+treated as failed. A new job resumes from the checkpoints, the completed
+steps are SKIPPED.
+
+Invoked directly with a list of users, the worker provisions them all in one
+invocation (bulk mode), see bulk_handler(). Running the same list again
+resumes the users that failed.
+"""
+
+import json
+import os
+import logging
+import time
+import uuid
+from decimal import Decimal
+
+from botocore.exceptions import ClientError
+
+from cdd_common import clients, retry
+
+__copyright__ = (
+    "Copyright 2019 Amazon.com, Inc. or its affiliates. All Rights Reserved."
+)
+__license__ = "MIT-0"
+
+logger = logging.getLogger()
+logger.setLevel(logging.INFO)
+
+# Seconds without an update after which a RUNNING job is considered failed,
+# longer than the worker function timeout
+JOB_TIMEOUT = 960
+
+# Provisioning steps, see provisioning.user_steps()
+STEPS = (
+    "iam_user",
+    "iot_thing",
+    "iot_certificate",
+    "iot_attach",
+    "cognito_iot_policy",
+    "cloud9_instance",
+    "dispenser_tables",
+)
+
+# "job" is used in expressions through a placeholder for consistency with
+# "status", a reserved word (DynamoDB rejects unused placeholders, so #status
+# is added only where used)
+JOB_NAMES = {"#job": "job"}
+STATUS_NAMES = {"#status": "status"}
+
+
+def now():
+    return Decimal(int(time.time()))
+
+
+def is_active(job, at=None):
+    """True if job is running and has been updated within JOB_TIMEOUT"""
+    return (
+        bool(job)
+        and job.get("status") == "RUNNING"
+        and (at or time.time()) - float(job.get("updatedAt", 0)) < JOB_TIMEOUT
+    )
+
+
+def start_job(table, username):
+    """Start a job for the user if assets have not been created and no other
+    job is active. Returns the job, or None if assets exist or another job is
+    running. The returned job's "resume" is True if it replaced an earlier
+    job."""
+
+    job = {
+        "jobId": uuid.uuid4().hex,
+        "status": "RUNNING",
+        "steps": {step: "PENDING" for step in STEPS},
+        "startedAt": now(),
+        "updatedAt": now(),
+    }
+    try:
+        response = table.update_item(
+            Key={"userName": username},
+            UpdateExpression=(
+                "SET assets = :creating, #job = :job, "
+                "checkpoints = if_not_exists(checkpoints, :empty)"
+            ),
+            ConditionExpression=(
+                "attribute_exists(userName) AND (attribute_type(assets, :null) OR "
+                "(assets = :creating AND (attribute_not_exists(#job) OR "
+                "#job.#status = :failed OR #job.updatedAt < :stale)))"
+            ),
+            ExpressionAttributeNames={**JOB_NAMES, **STATUS_NAMES},
+            ExpressionAttributeValues={
+                ":creating": "CREATING",
+                ":job": job,
+                ":empty": {},
+                ":null": "NULL",
+                ":failed": "FAILED",
+                ":stale": now() - JOB_TIMEOUT,
+            },
+            ReturnValues="UPDATED_OLD",
+        )
+    except ClientError as e:
+        if e.response["Error"]["Code"] != "ConditionalCheckFailedException":
+            raise
+        return None
+    return {**job, "resume": "job" in response.get("Attributes", {})}
+
+
+def checkpoints(table, username):
+    """Return the results of the user's completed steps"""
+    response = table.get_item(
+        Key={"userName": username},
+        ProjectionExpression="checkpoints",
+        ConsistentRead=True,
+    )
+    return response.get("Item", {}).get("checkpoints", {})
+
+
+def invoke_worker(username, dispenser_id, cognito_identity_id, job_id, resume=False):
+    """Run the job on the provisioning worker function"""
+    retry.call(
+        "lambda",
+        "invoke",
+        FunctionName=os.environ["PROVISIONING_FUNCTION"],
+        InvocationType="Event",
+        Payload=json.dumps(
+            {
+                "job": {
+                    "jobId": job_id,
+                    "userName": username,
+                    "dispenserId": dispenser_id,
+                    "cognitoIdentityId": cognito_identity_id,
+                    "resume": resume,
+                }
+            }
+        ),
+    )
+
+
+def update_job(
+    table, username, job_id, expression, names=None, values=None, remove=None
+):
+    """Update the user's job record with the SET expression (and REMOVE the
+    attributes in remove) if job_id is still the current job, returns False
+    if the job has been replaced"""
+    update_expression = f"{expression}, #job.updatedAt = :now"
+    if remove:
+        update_expression += f" REMOVE {remove}"
+    try:
+        table.update_item(
+            Key={"userName": username},
+            UpdateExpression=update_expression,
+            ConditionExpression="#job.jobId = :job_id",
+            ExpressionAttributeNames={**JOB_NAMES, **(names or {})},
+            ExpressionAttributeValues={
+                ":job_id": job_id,
+                ":now": now(),
+                **(values or {}),
+            },
+        )
+        return True
+    except ClientError as e:
+        if e.response["Error"]["Code"] != "ConditionalCheckFailedException":
+            raise
+        logger.warning(f"Provisioning job {job_id} for {username} has been replaced")
+        return False
+
+
+def record_step(table, username, job_id, step, status, result=None):
+    """Record the step status, and checkpoint the result of a completed step"""
+    expression = "SET #job.steps.#step = :step_status"
+    values = {":step_status": status}
+    if status == "COMPLETE":
+        expression += ", checkpoints.#step = :result"
+        values[":result"] = result
+    update_job(table, username, job_id, expression, names={"#step": step}, values=values)
+
+
+def complete_job(table, username, job_id, assets):
+    update_job(
+        table,
+        username,
+        job_id,
+        "SET assets = :assets, #job.#status = :complete",
+        names=STATUS_NAMES,
+        values={":assets": assets, ":complete": "COMPLETE"},
+        remove="checkpoints",
+    )
+
+
+def fail_job(table, username, job_id, error):
+    update_job(
+        table,
+        username,
+        job_id,
+        "SET #job.#status = :failed, #job.#error = :error, #job.failedStep = :step",
+        names={**STATUS_NAMES, "#error": "error"},
+        values={
+            ":failed": "FAILED",
+            ":error": str(error),
+            ":step": getattr(error, "step", None),
+        },
+    )
+
+
+def run_job(table, job):
+    """Provision the user for job and record the outcome, returns the assets
+    or None if provisioning failed"""
+
+    import provisioning
+
+    username, job_id = job["userName"], job["jobId"]
+    try:
+        assets = provisioning.provision_user(
+            username,
+            job["dispenserId"],
+            job["cognitoIdentityId"],
+            on_step=lambda step, status, result: record_step(
+                table, username, job_id, step, status, result
+            ),
+            completed=checkpoints(table, username),
+            resume=job.get("resume", False),
+        )
+    except Exception as e:
+        logger.error(f"Error during creation of resources for {username}, error: {e}")
+        fail_job(table, username, job_id, e)
+        return None
+    finally:
+        retry.log_metrics()
+    complete_job(table, username, job_id, assets)
+    return assets
+
+
+def bulk_handler(event, table):
+    """Provision all users in one invocation
+
+    Event:
+        {"users": [{"userName": "user1", "dispenserId": "100",
+                    "cognitoIdentityId": "us-west-2:..."}, ...],
+         "maxWorkers": 16}
+
+    Users with assets or an active job are skipped, users with a failed job
+    resume from their checkpoints. Returns the user names created, skipped
+    and the error for those that failed.
+    """
+
+    import provisioning
+
+    jobs, skipped, users = {}, [], []
+    for user in event["users"]:
+        job = start_job(table, user["userName"])
+        if job is None:
+            skipped.append(user["userName"])
+            continue
+        jobs[user["userName"]] = job["jobId"]
+        users.append(
+            {
+                **user,
+                "completed": checkpoints(table, user["userName"]),
+                "resume": job["resume"],
+            }
+        )
+    results = provisioning.provision_users(
+        users,
+        max_workers=event.get("maxWorkers", provisioning.MAX_WORKERS),
+        on_step=lambda user, step, status, result: record_step(
+            table, user["userName"], jobs[user["userName"]], step, status, result
+        ),
+    )
+    retry.log_metrics()
+    created, failed = [], {}
+    for user in users:
+        username = user["userName"]
+        if isinstance(results[username], Exception):
+            logger.error(
+                f"Error during creation of resources for {username}, error: {results[username]}"
+            )
+            fail_job(table, username, jobs[username], results[username])
+            failed[username] = str(results[username])
+        else:
+            complete_job(table, username, jobs[username], results[username])
+            created.append(username)
+    return {"created": created, "skipped": skipped, "failed": failed}
+
+
+def handler(event, context):
+    """Provisioning worker, runs a single job or bulk provisions users"""
+
+    logger.info("Received event: %s", json.dumps(event))
+    table = clients.table(os.environ["USER_TABLE"])
+    if "users" in event:
+        return bulk_handler(event, table)
+    return {"created": run_job(table, event["job"]) is not None}
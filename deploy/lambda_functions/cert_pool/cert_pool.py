@@ -0,0 +1,75 @@
+"""
+Keep the certificate pool filled for the next participants
+
+handler - run on a schedule, tops up the pool when it falls below the
+          refill threshold
+main - CloudFormation custom resource, fills the pool when the stack is
+       created or updated and deletes the unclaimed certificates when the
+       stack is deleted
+"""
+
+import os
+import logging
+
+import cfnresponse
+from cdd_common import certificates, clients, retry
+
+__copyright__ = (
+    "Copyright 2019 Amazon.com, Inc. or its affiliates. All Rights Reserved."
+)
+__license__ = "MIT-0"
+
+logger = logging.getLogger()
+logger.setLevel(logging.INFO)
+
+# First dispenser id handed out, see cog_post_confirm
+FIRST_DISPENSER_ID = "100"
+
+
+def next_dispenser_id():
+    """Next dispenser id to be assigned, from the admin tracking record"""
+    response = clients.table(os.environ["USER_TABLE"]).get_item(
+        Key={"userName": "admin"}, ConsistentRead=True
+    )
+    return response.get("Item", {}).get("nextDispenserId", FIRST_DISPENSER_ID)
+
+
+def refill():
+    """Refill the pool as configured, returns the number of certificates added"""
+    added = certificates.refill_pool(
+        clients.table(os.environ["CERT_POOL_TABLE"]),
+        next_dispenser_id(),
+        pool_size=int(os.environ["CERT_POOL_SIZE"]),
+        refill_threshold=int(os.environ["CERT_POOL_REFILL_THRESHOLD"]),
+    )
+    retry.log_metrics()
+    return added
+
+
+def handler(event, context):
+    """Scheduled refill"""
+    return {"added": refill()}
+
+
+def main(event, context):
+    physical_id = "CertificatePool"
+
+    try:
+        logger.info("Input event: %s", event)
+        if event["RequestType"] in ("Create", "Update"):
+            attributes = {
+                "Response": f"{physical_id} {event['RequestType'].upper()} performed, {refill()} certificates added"
+            }
+        else:
+            deleted = certificates.drain_pool(
+                clients.table(os.environ["CERT_POOL_TABLE"])
+            )
+            attributes = {
+                "Response": f"{physical_id} DELETE performed, {deleted} certificates deleted"
+            }
+        cfnresponse.send(event, context, cfnresponse.SUCCESS, attributes, physical_id)
+
+    except Exception as e:
+        logger.exception(e)
+        # cfnresponse's error message is always "see CloudWatch"
+        cfnresponse.send(event, context, cfnresponse.FAILED, {}, physical_id)
@@ -0,0 +1,68 @@
+"""
+CloudFormation custom resource to apply the workshop IAM password policy for
+the life of the stack
+
+Create - store the account password policy and apply the workshop policy
+Update - apply the workshop policy again (e.g. changed outside the stack)
+Delete - restore the stored account password policy, or delete the policy
+         if the account had none
+
+The account policy is stored in the physical resource id, which CloudFormation
+passes to every later request for the resource.
+"""
+
+import json
+import logging
+
+import cfnresponse
+from cdd_common import password_policy
+
+__copyright__ = (
+    "Copyright 2019 Amazon.com, Inc. or its affiliates. All Rights Reserved."
+)
+__license__ = "MIT-0"
+
+logger = logging.getLogger()
+logger.setLevel(logging.INFO)
+
+PHYSICAL_ID_PREFIX = "WorkshopPasswordPolicy"
+
+
+def physical_id_for(policy):
+    return f"{PHYSICAL_ID_PREFIX}:{json.dumps(policy, sort_keys=True, separators=(',', ':'))}"
+
+
+def policy_from(physical_id):
+    """Account policy stored in the physical id, None if there was none"""
+    return json.loads(physical_id.split(":", 1)[1])
+
+
+def main(event, context):
+    physical_id = event.get("PhysicalResourceId", PHYSICAL_ID_PREFIX)
+
+    try:
+        logger.info("Input event: %s", event)
+        if event["RequestType"] == "Create":
+            physical_id = physical_id_for(password_policy.get_policy())
+            password_policy.set_policy(password_policy.WORKSHOP_PASSWORD_POLICY)
+            attributes = {
+                "Response": f"{PHYSICAL_ID_PREFIX} CREATE performed, workshop password policy applied"
+            }
+        elif event["RequestType"] == "Update":
+            password_policy.set_policy(password_policy.WORKSHOP_PASSWORD_POLICY)
+            attributes = {
+                "Response": f"{PHYSICAL_ID_PREFIX} UPDATE performed, workshop password policy applied"
+            }
+        else:
+            # A failed create has no stored policy, nothing to restore
+            if physical_id.startswith(f"{PHYSICAL_ID_PREFIX}:"):
+                password_policy.set_policy(policy_from(physical_id))
+            attributes = {
+                "Response": f"{PHYSICAL_ID_PREFIX} DELETE performed, account password policy restored"
+            }
+        cfnresponse.send(event, context, cfnresponse.SUCCESS, attributes, physical_id)
+
+    except Exception as e:
+        logger.exception(e)
+        # cfnresponse's error message is always "see CloudWatch"
+        cfnresponse.send(event, context, cfnresponse.FAILED, {}, physical_id)
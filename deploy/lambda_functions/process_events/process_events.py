@@ -4,18 +4,31 @@
     of event (shadow topic or event/dispenserId topic)
     Standalone, not API Gateway
 
+    Two ingestion modes, set by the IoT rule actions (see cdd/base_services.py):
+      direct - each rule invokes the function with a single message, the log
+               entry is written with PutItem
+      batched - the rules put messages on a Kinesis stream, the function is
+                invoked with batches of stream records and writes the log
+                entries with BatchWriteItem, 25 per request
+
+    Shadow update documents also update the status projection on the
+    dispenser record (see cdd_common/status.py), for the newest document of
+    each dispenser in a batch.
+
     Environment Variables:
       EVENT_TABLE - DDB table to post events
+      DISPENSER_TABLE - DDB table of dispenser records, for the status projection
 """
 
-import boto3
-from boto3.dynamodb.conditions import Key
+import base64
 from botocore.exceptions import ClientError
 from datetime import datetime as dt
 import json
 import os
 import logging
 
+from cdd_common import clients, events, status
+
 logger = logging.getLogger()
 logger.setLevel(logging.INFO)
 
@@ -24,59 +37,144 @@ __copyright__ = (
 )
 __license__ = "MIT-0"
 
-# Global variables for function access and Lambda reuse
-ddb = boto3.resource("dynamodb")
-event_db = ddb.Table(os.environ["EVENT_TABLE"])
-
 
 def thing_name(topic):
     """Get thing name from provided shadow topic"""
     return topic.split("/")[2]
 
 
-def compare_shadow(current, previous, path="", section=""):
-    """Compare current shadow to previous shadow documents for
-    desired and reported states"""
-
-    err = ""
-    key_add = ""
-    key_change = ""
-    old_path = path
-    for k in current.keys():
-        if k == "desired" or k == "reported":
-            section = k
-        else:
-            # Set path only after desired or reported
-            path = old_path + "[%s]" % k
-        if not k in previous:
-            key_add += f'Attribute {path} = {current[k]} added to "{section} state"\n'
+def pointer_token(key):
+    """Escape a key as a JSON pointer (RFC 6901) reference token"""
+    key = str(key)
+    if "~" in key or "/" in key:
+        key = key.replace("~", "~0").replace("/", "~1")
+    return key
+
+
+def child_path(pointer, path, section, key):
+    """JSON pointer, path and section of key in the document at pointer"""
+
+    # desired and reported name the section, they are not in the path
+    if not pointer and key in ("desired", "reported"):
+        return "/" + key, path, key
+    return f"{pointer}/{pointer_token(key)}", f"{path}[{key}]", section
+
+
+def diff_shadow(current, previous):
+    """Differences between current and previous shadow state documents
+
+    Returns a list of (op, pointer, path, section, old, new) tuples, op is
+    "added", "removed" or "changed", pointer is the JSON pointer of the
+    attribute from the state root (e.g. "/reported/led_ring/count"), path
+    the same below the desired or reported section (e.g.
+    "[led_ring][count]"). Dicts are compared by key and lists by index,
+    anything else by value.
+
+    The documents are walked with an explicit stack, equal values (including
+    whole sub-documents) are skipped with a single comparison, and pointer
+    and path strings are only built for attributes that differ.
+    """
+
+    changes = []
+    # (current, previous, pointer, path, section) of documents to compare
+    stack = [(current, previous, "", "", "")]
+    while stack:
+        cur, prev, *at = stack.pop()
+        if isinstance(cur, dict):
+            added_keys = cur.keys() - prev.keys()
+            removed_keys = prev.keys() - cur.keys()
+            # Keep document order for the log
+            added = [k for k in cur if k in added_keys] if added_keys else ()
+            removed = [k for k in prev if k in removed_keys] if removed_keys else ()
+            shared = [k for k in cur if k not in added_keys] if added_keys else cur
         else:
-            if isinstance(current[k], dict) and isinstance(previous[k], dict):
-                err += compare_shadow(current[k], previous[k], path, section)
+            added = range(len(prev), len(cur))
+            removed = range(len(cur), len(prev))
+            shared = range(min(len(cur), len(prev)))
+
+        for k in added:
+            changes.append(("added", *child_path(*at, k), None, cur[k]))
+        for k in removed:
+            changes.append(("removed", *child_path(*at, k), prev[k], None))
+        nested = []
+        for k in shared:
+            value, old = cur[k], prev[k]
+            if value == old:
+                continue
+            if (isinstance(value, dict) and isinstance(old, dict)) or (
+                isinstance(value, list) and isinstance(old, list)
+            ):
+                nested.append((value, old, *child_path(*at, k)))
             else:
-                if current[k] != previous[k]:
-                    key_change += f'Attribute {path} in "{section} state" changed from "{previous[k]}" to "{current[k]}"'
+                changes.append(("changed", *child_path(*at, k), old, value))
+        # Reversed so nested documents are walked in document order
+        stack.extend(reversed(nested))
 
-    for k in previous.keys():
-        path = old_path + "[%s]" % k
-        if not k in current:
-            key_add += f'Attribute {path} removed from "{section} state"\n'
+    return changes
 
-    return "Shadow: " + key_add + key_change + err
+
+def structured_diff(changes):
+    """JSON pointers of the added, removed and changed attributes"""
+    diff = {"added": [], "removed": [], "changed": []}
+    for op, pointer, *_ in changes:
+        diff[op].append(pointer)
+    return diff
+
+
+def log_line(changes):
+    """Human readable description of the changes"""
+    lines = []
+    for op, _, path, section, old, new in changes:
+        if op == "added":
+            lines.append(f'Attribute {path} = {new} added to "{section} state"')
+        elif op == "removed":
+            lines.append(f'Attribute {path} removed from "{section} state"')
+        else:
+            lines.append(
+                f'Attribute {path} in "{section} state" changed from "{old}" to "{new}"'
+            )
+    return "Shadow: " + "\n".join(lines)
 
 
-def process_shadow(event):
+def compare_shadow(current, previous):
+    """Compare current shadow to previous shadow documents for
+    desired and reported states, returns the log line"""
+
+    return log_line(diff_shadow(current, previous))
+
+
+def request_attributes(request_id):
+    """Event log attributes for the id of the request an event is about"""
+    return {"requestId": request_id} if isinstance(request_id, str) and request_id else {}
+
+
+def shadow_request_id(event):
+    """Id of the dispense request in the desired state or the dispenser's
+    response of the shadow document (current, else previous), None if none"""
+
+    for document in ("current", "previous"):
+        state = event.get(document, {}).get("state", {})
+        for section, key in (("desired", "request"), ("reported", "response")):
+            value = (state.get(section) or {}).get(key)
+            if isinstance(value, dict) and value.get("requestId"):
+                return value["requestId"]
+    return None
+
+
+def process_shadow(event, at=None):
     """Create log entry on changes seen between current and previous shadow states"""
 
-    log_entry = {
-        "dispenserId": event["topic"].split("/")[2],
-        "timestamp": dt.utcnow().isoformat() + "Z",
-        "log": compare_shadow(event["current"]["state"], event["previous"]["state"]),
-    }
-    return log_entry
+    changes = diff_shadow(event["current"]["state"], event["previous"]["state"])
+    return events.entry(
+        event["topic"].split("/")[2],
+        log_line(changes),
+        at,
+        changes=structured_diff(changes),
+        **request_attributes(shadow_request_id(event)),
+    )
 
 
-def process_generic_event(event):
+def process_generic_event(event, at=None):
     """Create log entry from "event" topic"""
 
     if "dispenserId" in event:
@@ -91,32 +189,49 @@ def process_generic_event(event):
         dispenser_id = "000"
         message = f"ERROR: Message received without 'dispenserId' set, message was: {event}"
 
-    log_entry = {
-        "dispenserId": dispenser_id,
-        "timestamp": dt.utcnow().isoformat() + "Z",
-        "log": message,
-    }
-    return log_entry
+    return events.entry(dispenser_id, message, at, **request_attributes(event.get("requestId")))
 
 
-def process_dispenser_event(event):
-    """Create log entry from "event/dispenserId" topic"""
+def process_dispenser_event(event, at=None):
+    """Create log entry from "event/dispenserId" topic, None if the publisher
+    already logged the event ("logged" set, as for a ledger mode credit)"""
 
+    if event.get("logged"):
+        return None
     dispenser_id = event["topic"].split("/")[1]
     if "message" in event:
         # Use the text of this field only
         message = f'MQTT: {event["message"]}'
     else:
         message = "MQTT: " +  str({key: event[key] for key in event if key not in ["topic", "ts", "dispenserId"]})
-    log_entry = {
-        "dispenserId": dispenser_id,
-        "timestamp": dt.utcnow().isoformat() + "Z",
-        "log": message,
-    }
-    return log_entry
+    return events.entry(dispenser_id, message, at, **request_attributes(event.get("requestId")))
 
 
 
+def log_entry_for(event, at=None):
+    """Create the log entry for a message by its topic, None if the message
+    has no topic or is not logged"""
+
+    # Determine source of event by topic and process
+    if "topic" not in event:
+        logger.error("Attribute 'topic' not found in event: %s", json.dumps(event))
+        return None
+    # $aws/things/+/shadow/update/documents
+    if event["topic"].startswith("$aws/things/"):
+        # Shadow document
+        return process_shadow(event, at)
+    elif event["topic"].startswith("events/"):
+        # Per dispenser topic (e.g., "events/123")
+        return process_dispenser_event(event, at)
+    elif event["topic"] == "events":
+        # Generic event
+        return process_generic_event(event, at)
+    # Should not get here - log anyway
+    return events.entry(
+        "000", f"ERROR: received event on unknown topic, original event is {event}", at
+    )
+
+
 def publish_event(entry, table):
     """Put log entry into DynamoDB table"""
 
@@ -127,31 +242,112 @@ def publish_event(entry, table):
         logging.error("An error has occurred:, {}".format(e))
 
 
+def shadow_projection(event):
+    """(dispenser id, status projection) of a shadow update documents
+    message, None for other messages"""
+
+    if not event.get("topic", "").startswith("$aws/things/"):
+        return None
+    current = event["current"]
+    return (
+        thing_name(event["topic"]),
+        status.projection(current["state"], current.get("version", 0)),
+    )
+
+
+def update_projections(messages):
+    """Update the status projection of each dispenser from the newest shadow
+    document among messages, returns the number of dispensers"""
+
+    newest = {}
+    for event in messages:
+        try:
+            result = shadow_projection(event)
+        except Exception as e:
+            logger.error(f"Could not project message {json.dumps(event)}, error: {e!r}")
+            continue
+        if result is None:
+            continue
+        dispenser_id, projection = result
+        if (
+            dispenser_id not in newest
+            or newest[dispenser_id]["version"] <= projection["version"]
+        ):
+            newest[dispenser_id] = projection
+    for dispenser_id, projection in newest.items():
+        status.update(dispenser_id, projection)
+    return len(newest)
+
+
+def decode_records(records):
+    """(message, arrival time) of each Kinesis stream record holding a JSON
+    object, others are logged and skipped"""
+
+    for record in records:
+        try:
+            event = json.loads(base64.b64decode(record["kinesis"]["data"]))
+        except ValueError as e:
+            logger.error(f"Could not decode record {record['kinesis']['sequenceNumber']}, error: {e}")
+            continue
+        if not isinstance(event, dict):
+            logger.error(f"Record {record['kinesis']['sequenceNumber']} is not a JSON object")
+            continue
+        yield event, dt.utcfromtimestamp(record["kinesis"]["approximateArrivalTimestamp"])
+
+
+def message_entries(messages):
+    """Log entries for (message, time) pairs, a message that cannot be
+    logged is logged as an error and skipped"""
+
+    entries = []
+    for event, at in messages:
+        try:
+            entry = log_entry_for(event, at)
+        except Exception as e:
+            logger.error(f"Could not log message {json.dumps(event)}, error: {e!r}")
+            continue
+        if entry is not None:
+            entries.append(entry)
+    return entries
+
+
+def record_entries(records):
+    """Log entries for Kinesis stream records
+
+    The entry time is the record's arrival time on the stream, so a batch
+    that is retried writes the same keys again rather than duplicate entries.
+    """
+    return message_entries(decode_records(records))
+
+
+def batch_handler(event):
+    """Write the log entries for a batch of Kinesis records and update the
+    status projections
+
+    Raises (so the batch is retried) if entries could not be written.
+    """
+
+    messages = list(decode_records(event["Records"]))
+    entries = message_entries(messages)
+    requests = events.put_entries(entries)
+    logger.info(
+        f"Wrote {len(entries)} log entries from {len(event['Records'])} records in {requests} requests"
+    )
+    dispensers = update_projections(message for message, _ in messages)
+    return {"entries": len(entries), "requests": requests, "statuses": dispensers}
+
+
 def handler(event, context):
-    """Process properly formed JSON messages from AWS IoT topics"""
-    logger.info("Received event: %s", json.dumps(event))
+    """Process properly formed JSON messages from AWS IoT topics, one message
+    from a rule or a batch of Kinesis records"""
 
-    # Determine source of event by topic and process
-    if "topic" not in event:
-        logger.error("Attribute 'topic' not found in event: %s", json.dumps(event))
-        return
-    # $aws/things/+/shadow/update/documents
-    if event["topic"].startswith("$aws/things/"):
-        # Shadow document
-        log_entry = process_shadow(event)
-    elif event["topic"].startswith("events/"):
-        # Per dispenser topic (e.g., "events/123")
-        log_entry = process_dispenser_event(event)
-    elif event["topic"] == "events":
-        # Generic event
-        log_entry = process_generic_event(event)
-    else:
-        # Should not get here - log anyway
-        log_entry = {
-            "dispenserId": "000",
-            "timestamp": dt.utcnow().isoformat() + "Z",
-            "log": f"ERROR: received event on unknown topic, original event is {event}",
-        }
-    publish_event(log_entry, event_db)
+    if "Records" in event:
+        return batch_handler(event)
+
+    logger.info("Received event: %s", json.dumps(event))
+    log_entry = log_entry_for(event)
+    if log_entry is not None:
+        publish_event(log_entry, clients.table(os.environ["EVENT_TABLE"]))
+    update_projections([event])
 
     return
@@ -0,0 +1,144 @@
+"""
+Clear dispense requests the dispenser never answered
+
+Run every minute. The records with an expired in-flight dispense request are
+read a page at a time from the sparse in-flight index (see
+cdd_common/request_slots.py), so the cost follows the number of expired
+requests, not the number of dispensers. For each page:
+
+- the request slots are removed, each only if it still holds the expired
+  request (a new request may have taken the slot since)
+- the desired "request" object is cleared from those dispensers' shadows,
+  again only if it is still the expired request
+- a log entry per request is written to the event log in one batch
+
+and the number of timeouts is published as the DispenseTimeouts metric (see
+cdd_common/metrics.py).
+"""
+
+import json
+import os
+import logging
+import time
+
+from botocore.exceptions import ClientError
+
+from cdd_common import clients, events, fanout, metrics, request_slots
+
+__copyright__ = (
+    "Copyright 2019 Amazon.com, Inc. or its affiliates. All Rights Reserved."
+)
+__license__ = "MIT-0"
+
+logger = logging.getLogger()
+logger.setLevel(logging.INFO)
+
+COMMAND = "dispense"
+# Records read (and cleared concurrently) at a time
+PAGE_SIZE = 25
+# Stop reading pages when less time than this (ms) is left in the invocation
+MIN_REMAINING_MS = 10000
+# Shadow updates lost to concurrent updates before a shadow is left as is
+MAX_SHADOW_ATTEMPTS = 3
+
+
+def clear_slot(table, record):
+    """Remove the expired request slot of record, returns the RequestSlot
+    removed or None if the slot was completed or replaced meanwhile"""
+
+    slot = request_slots.get_slot(record, COMMAND)
+    if slot is None:
+        return None
+    try:
+        table.update_item(
+            Key={"dispenserId": record["dispenserId"]},
+            UpdateExpression=f"REMOVE requests.#command, {request_slots.IN_FLIGHT_REMOVE}",
+            ConditionExpression="requests.#command.requestId = :request_id",
+            ExpressionAttributeNames={"#command": COMMAND},
+            ExpressionAttributeValues={":request_id": slot.request_id},
+        )
+    except ClientError as e:
+        if e.response["Error"]["Code"] != "ConditionalCheckFailedException":
+            raise
+        return None
+    return slot
+
+
+def clear_shadow(dispenser_id, request_id):
+    """Set the desired request of the shadow to null if it is request_id,
+    returns True if cleared"""
+
+    iot_data = clients.client("iot-data")
+    for _ in range(MAX_SHADOW_ATTEMPTS):
+        try:
+            response = iot_data.get_thing_shadow(thingName=dispenser_id)
+        except ClientError as e:
+            if e.response["Error"]["Code"] != "ResourceNotFoundException":
+                raise
+            return False
+        shadow = json.loads(response["payload"].read().decode("utf-8"))
+        request = shadow.get("state", {}).get("desired", {}).get("request") or {}
+        if request.get("requestId") != request_id:
+            return False
+        payload = {"state": {"desired": {"request": None}}, "version": shadow["version"]}
+        try:
+            iot_data.update_thing_shadow(thingName=dispenser_id, payload=json.dumps(payload))
+            return True
+        except ClientError as e:
+            if e.response["Error"]["Code"] != "ConflictException":
+                raise
+    logger.warning(f"Shadow of {dispenser_id} changing too often, request {request_id} left")
+    return False
+
+
+def sweep_page(table, records, now):
+    """Clear the expired requests of a page of records, returns the number
+    of requests cleared"""
+
+    slots = fanout.gather(*[lambda r=r: clear_slot(table, r) for r in records])
+    cleared = [(r["dispenserId"], slot) for r, slot in zip(records, slots) if slot]
+    if not cleared:
+        return 0
+    fanout.gather(
+        *[
+            lambda d=dispenser_id, s=slot: clear_shadow(d, s.request_id)
+            for dispenser_id, slot in cleared
+        ]
+    )
+    events.put_entries(
+        [
+            events.entry(
+                dispenser_id,
+                f"Dispense: ERROR, request {slot.request_id} timed out after "
+                f"{(now - slot.timestamp):0.2f} seconds without a response from the "
+                f"dispenser, request cleared and NO credits deducted",
+                requestId=slot.request_id,
+            )
+            for dispenser_id, slot in cleared
+        ]
+    )
+    return len(cleared)
+
+
+def sweep(context=None, now=None):
+    """Clear all requests expired by now, returns the number cleared"""
+
+    now = time.time() if now is None else now
+    table = clients.table(os.environ["DISPENSER_TABLE"])
+    timeouts = 0
+    last = None
+    while True:
+        records, last = request_slots.expired(table, COMMAND, now, PAGE_SIZE, last)
+        timeouts += sweep_page(table, records, now)
+        if last is None:
+            break
+        if context and context.get_remaining_time_in_millis() < MIN_REMAINING_MS:
+            logger.warning("Out of time, remaining requests left to the next sweep")
+            break
+    metrics.emit("DispenseTimeouts", timeouts, now=now)
+    return timeouts
+
+
+def handler(event, context):
+    """Scheduled sweep"""
+    return {"timeouts": sweep(context)}
@@ -0,0 +1,25 @@
+"""
+Code shared by the CDD Lambda functions, deployed as a Lambda layer
+
+Modules:
+
+clients - lazily created, connection-pooled boto3 clients and tables
+responses - API Gateway responses and JSON encoding of DynamoDB items
+led - LED ring state from credits and coalesced LED ring shadow updates
+retry - backoff with jitter and per-API rate limits for AWS calls
+certificates - dispenser certificates and the pre-generated certificate pool
+password_policy - IAM account password policy for workshop participants
+batch - DynamoDB batch writes with unprocessed item retries
+events - dispenser event log schema, writer and readers
+status - dispenser status projection of the shadow on the dispenser record
+fanout - run independent AWS calls concurrently
+request_slots - in-flight requests of dispenser records and their expiry
+idempotency - Idempotency-Key handling of API requests that must not repeat
+ids - sortable request ids (ULID)
+metrics - CloudWatch metrics in embedded metric format
+"""
+
+__copyright__ = (
+    "Copyright 2019 Amazon.com, Inc. or its affiliates. All Rights Reserved."
+)
+__license__ = "MIT-0"
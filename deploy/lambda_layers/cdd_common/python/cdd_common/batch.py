@@ -0,0 +1,108 @@
+"""
+DynamoDB batch writes
+
+put_items() writes any number of items with BatchWriteItem, 25 items per
+request instead of one PutItem each. Items DynamoDB does not process (the
+table or partition is throttled) are returned by the request and resubmitted
+with the same full jitter backoff as retry.call(), which also retries the
+requests themselves when throttled.
+
+Usage:
+    from cdd_common import batch
+
+    batch.put_items(os.environ["EVENT_TABLE"], log_entries)
+"""
+
+import logging
+import time
+
+from boto3.dynamodb.types import TypeSerializer
+
+from cdd_common import retry
+
+__copyright__ = (
+    "Copyright 2019 Amazon.com, Inc. or its affiliates. All Rights Reserved."
+)
+__license__ = "MIT-0"
+
+logger = logging.getLogger()
+logger.setLevel(logging.INFO)
+
+# Most items accepted by a single BatchWriteItem request
+MAX_BATCH_SIZE = 25
+# Default time to keep resubmitting unprocessed items before giving up
+DEFAULT_DEADLINE = 10
+
+_serializer = TypeSerializer()
+
+
+class UnprocessedItemsError(Exception):
+    """Items were still unprocessed at the deadline"""
+
+    def __init__(self, table_name, items):
+        super().__init__(f"{len(items)} items not written to {table_name}")
+        self.table_name = table_name
+        self.items = items
+
+
+def serialize(item):
+    """Item of Python values (as used with Table resources) to attribute values"""
+    return {key: _serializer.serialize(value) for key, value in item.items()}
+
+
+def write_batch(table_name, requests, deadline):
+    """Send up to MAX_BATCH_SIZE write requests, resubmitting unprocessed
+    requests until deadline (time.time()). Returns the requests still
+    unprocessed."""
+
+    attempt = 0
+    while requests:
+        response = retry.call(
+            "dynamodb",
+            "batch_write_item",
+            deadline=max(deadline - time.time(), 0),
+            RequestItems={table_name: requests},
+        )
+        requests = response.get("UnprocessedItems", {}).get(table_name, [])
+        if not requests:
+            break
+        attempt += 1
+        delay = retry.backoff(attempt)
+        if time.time() + delay > deadline:
+            break
+        logger.warning(
+            f"{len(requests)} items unprocessed writing to {table_name} (will retry in {delay:.2f}s, attempt {attempt})"
+        )
+        retry.metrics(retry.api_name("dynamodb", "batch_write_item")).add(
+            backoff_time=delay
+        )
+        time.sleep(delay)
+    return requests
+
+
+def put_items(table_name, items, deadline=DEFAULT_DEADLINE):
+    """Put items with BatchWriteItem, returns the number of batches written.
+
+    Items within one call must have unique keys. Raises UnprocessedItemsError
+    with the items not written if any are still unprocessed after deadline
+    seconds, all other items have been written.
+    """
+
+    end = time.time() + deadline
+    unprocessed = []
+    requests = 0
+    for i in range(0, len(items), MAX_BATCH_SIZE):
+        unprocessed.extend(
+            write_batch(
+                table_name,
+                [
+                    {"PutRequest": {"Item": serialize(item)}}
+                    for item in items[i : i + MAX_BATCH_SIZE]
+                ],
+                end,
+            )
+        )
+        requests += 1
+    if unprocessed:
+        raise UnprocessedItemsError(table_name, unprocessed)
+    return requests
@@ -0,0 +1,199 @@
+"""
+Dispenser certificates and the pre-generated certificate pool
+
+Dispenser ids are handed out in sequence (see cog_post_confirm), and the
+dispenser IoT policy scopes topics to the certificate's CN, so the pool holds
+a ready private key and active certificate for each of the next dispenser
+ids in the CertificatePool table, keyed by dispenserId:
+
+    {"dispenserId": "105", "certificateArn": ..., "certificatePem": ...,
+     "privateKey": ..., "createdAt": 1576000000}
+
+Provisioning claims the entry for its dispenser with a single UpdateItem that
+marks it claimed and removes the key material, returning the old values, so
+a certificate is handed out at most once. A claim for a dispenser with no
+entry leaves a claimed placeholder, which stops a concurrent refill from
+adding a certificate nobody will claim.
+
+cryptography is only imported when a key is generated, functions calling
+generate_key_and_csr() need the crypto layer.
+"""
+
+import logging
+import time
+from decimal import Decimal
+
+from botocore.exceptions import ClientError
+
+from cdd_common import retry
+
+__copyright__ = (
+    "Copyright 2019 Amazon.com, Inc. or its affiliates. All Rights Reserved."
+)
+__license__ = "MIT-0"
+
+logger = logging.getLogger()
+logger.setLevel(logging.INFO)
+
+
+def generate_key_and_csr(dispenser_id):
+    """Generate EC private key and CSR with subject CN=dispenserId, returns
+    PEM encoded private key and CSR"""
+
+    from cryptography import x509
+    from cryptography.hazmat.backends import default_backend
+    from cryptography.hazmat.primitives import hashes, serialization
+    from cryptography.hazmat.primitives.asymmetric import ec
+    from cryptography.x509.oid import NameOID
+
+    # Create certificate and private key
+    key = ec.generate_private_key(curve=ec.SECP256R1(), backend=default_backend())
+    private_key = key.private_bytes(
+        encoding=serialization.Encoding.PEM,
+        format=serialization.PrivateFormat.TraditionalOpenSSL,
+        encryption_algorithm=serialization.NoEncryption(),
+    ).decode("utf-8")
+
+    # Generate a CSR and set subject (CN=dispenserId)
+    csr = (
+        x509.CertificateSigningRequestBuilder()
+        .subject_name(
+            x509.Name(
+                [
+                    # Provide various details about who we are.
+                    x509.NameAttribute(NameOID.COUNTRY_NAME, "US"),
+                    x509.NameAttribute(NameOID.STATE_OR_PROVINCE_NAME, "NV"),
+                    x509.NameAttribute(NameOID.LOCALITY_NAME, "Las Vegas"),
+                    x509.NameAttribute(NameOID.ORGANIZATION_NAME, "re:Invent 2084"),
+                    x509.NameAttribute(NameOID.COMMON_NAME, dispenser_id),
+                ]
+            )
+        )
+        .sign(key, hashes.SHA256(), default_backend())
+    )
+    return private_key, str(csr.public_bytes(serialization.Encoding.PEM), "utf-8")
+
+
+def create_certificate(dispenser_id):
+    """Generate a key and register an active certificate for it with AWS IoT,
+    returns dict of privateKey, certificateArn and certificatePem"""
+
+    private_key, csr = generate_key_and_csr(dispenser_id)
+    # NOTE: Use the ECDHE-ECDSA-AES128-SHA256 and CA3 root for communication
+    result = retry.call(
+        "iot",
+        "create_certificate_from_csr",
+        certificateSigningRequest=csr,
+        setAsActive=True,
+    )
+    return {
+        "privateKey": private_key,
+        "certificateArn": result["certificateArn"],
+        "certificatePem": result["certificatePem"],
+    }
+
+
+def delete_certificate(certificate_arn):
+    """Deactivate and delete an unattached certificate"""
+
+    certificate_id = certificate_arn.split("/")[-1]
+    retry.call(
+        "iot", "update_certificate", certificateId=certificate_id, newStatus="INACTIVE"
+    )
+    retry.call("iot", "delete_certificate", certificateId=certificate_id)
+
+
+def claim_certificate(pool_table, dispenser_id):
+    """Claim the pooled certificate for dispenser_id, returns dict of
+    privateKey, certificateArn and certificatePem, or None if the pool had no
+    certificate for the dispenser"""
+
+    response = pool_table.update_item(
+        Key={"dispenserId": dispenser_id},
+        UpdateExpression="SET claimedAt = :now REMOVE privateKey, certificatePem",
+        ExpressionAttributeValues={":now": Decimal(int(time.time()))},
+        ReturnValues="ALL_OLD",
+    )
+    item = response.get("Attributes", {})
+    if "claimedAt" in item or "certificateArn" not in item:
+        return None
+    return {
+        "privateKey": item["privateKey"],
+        "certificateArn": item["certificateArn"],
+        "certificatePem": item["certificatePem"],
+    }
+
+
+def add_certificate(pool_table, dispenser_id):
+    """Create a certificate and add it to the pool, returns False if the
+    dispenser already has a pool entry (the certificate is deleted)"""
+
+    certificate = create_certificate(dispenser_id)
+    try:
+        pool_table.put_item(
+            Item={
+                "dispenserId": dispenser_id,
+                "createdAt": Decimal(int(time.time())),
+                **certificate,
+            },
+            ConditionExpression="attribute_not_exists(dispenserId)",
+        )
+        return True
+    except ClientError as e:
+        if e.response["Error"]["Code"] != "ConditionalCheckFailedException":
+            raise
+        # Claimed (or added) since the pool was read
+        delete_certificate(certificate["certificateArn"])
+        return False
+
+
+def pool_entries(pool_table):
+    """Return all pool entries, without key material"""
+
+    entries = []
+    kwargs = {"ProjectionExpression": "dispenserId, certificateArn, claimedAt"}
+    while True:
+        response = pool_table.scan(**kwargs)
+        entries.extend(response["Items"])
+        if "LastEvaluatedKey" not in response:
+            return entries
+        kwargs["ExclusiveStartKey"] = response["LastEvaluatedKey"]
+
+
+def refill_pool(pool_table, next_dispenser_id, pool_size, refill_threshold):
+    """Top up the pool to pool_size certificates for the dispenser ids from
+    next_dispenser_id, when fewer than refill_threshold are available.
+    Returns the number of certificates added."""
+
+    entries = {e["dispenserId"]: e for e in pool_entries(pool_table)}
+    upcoming = [str(i) for i in range(int(next_dispenser_id), int(next_dispenser_id) + pool_size)]
+    available = [d for d in upcoming if d in entries and "claimedAt" not in entries[d]]
+    if len(available) >= refill_threshold:
+        logger.info(f"Certificate pool has {len(available)} certificates, no refill needed")
+        return 0
+    added = 0
+    for dispenser_id in upcoming:
+        if dispenser_id not in entries and add_certificate(pool_table, dispenser_id):
+            added += 1
+    logger.info(
+        f"Certificate pool refilled with {added} certificates for dispensers from {next_dispenser_id}"
+    )
+    return added
+
+
+def drain_pool(pool_table):
+    """Delete all unclaimed certificates and pool entries, returns the
+    number of certificates deleted"""
+
+    deleted = 0
+    for entry in pool_entries(pool_table):
+        if "claimedAt" not in entry and "certificateArn" in entry:
+            try:
+                delete_certificate(entry["certificateArn"])
+                deleted += 1
+            except ClientError as e:
+                logger.error(
+                    f"Error deleting pooled certificate {entry['certificateArn']}, error: {e}"
+                )
+        pool_table.delete_item(Key={"dispenserId": entry["dispenserId"]})
+    return deleted
@@ -0,0 +1,110 @@
+"""
+Lazily created boto3 clients, resources and tables
+
+Clients are created on first use (not at import) from a single session and
+cached for the life of the Lambda execution environment. All clients share
+a botocore configuration tuned for short-lived API handlers: a connection
+pool sized for concurrent calls, TCP keep-alive, and adaptive retries.
+Clients for callers that retry themselves (cdd_common/retry.py) are the
+same but make a single attempt per call, see unretried_client().
+
+Usage:
+    from cdd_common import clients
+
+    clients.client("iot-data").update_thing_shadow(...)
+    clients.table(os.environ["DISPENSER_TABLE"]).get_item(...)
+"""
+
+import os
+import threading
+import boto3
+from botocore.config import Config
+
+__copyright__ = (
+    "Copyright 2019 Amazon.com, Inc. or its affiliates. All Rights Reserved."
+)
+__license__ = "MIT-0"
+
+_config_options = {
+    "max_pool_connections": int(os.environ.get("MAX_POOL_CONNECTIONS", "25")),
+    "retries": {"max_attempts": 5, "mode": "adaptive"},
+}
+try:
+    CLIENT_CONFIG = Config(tcp_keepalive=True, **_config_options)
+except TypeError:
+    # botocore prior to 1.27.84 does not support tcp_keepalive
+    CLIENT_CONFIG = Config(**_config_options)
+# max_attempts is the number of retries after the first attempt
+UNRETRIED_CLIENT_CONFIG = CLIENT_CONFIG.merge(
+    Config(retries={"max_attempts": 0, "mode": "standard"})
+)
+
+_lock = threading.RLock()
+_session = None
+_clients = {}
+_unretried_clients = {}
+_resources = {}
+_tables = {}
+
+
+def session():
+    """Return the shared boto3 session"""
+    global _session
+    if _session is None:
+        with _lock:
+            if _session is None:
+                _session = boto3.session.Session()
+    return _session
+
+
+def client(service_name):
+    """Return cached low-level client for service_name"""
+    try:
+        return _clients[service_name]
+    except KeyError:
+        pass
+    # Client creation from a session is not thread safe
+    with _lock:
+        if service_name not in _clients:
+            _clients[service_name] = session().client(
+                service_name, config=CLIENT_CONFIG
+            )
+    return _clients[service_name]
+
+
+def unretried_client(service_name):
+    """Return cached low-level client for service_name that does not retry
+    failed calls"""
+    try:
+        return _unretried_clients[service_name]
+    except KeyError:
+        pass
+    with _lock:
+        if service_name not in _unretried_clients:
+            _unretried_clients[service_name] = session().client(
+                service_name, config=UNRETRIED_CLIENT_CONFIG
+            )
+    return _unretried_clients[service_name]
+
+
+def resource(service_name):
+    """Return cached resource for service_name"""
+    try:
+        return _resources[service_name]
+    except KeyError:
+        pass
+    with _lock:
+        if service_name not in _resources:
+            _resources[service_name] = session().resource(
+                service_name, config=CLIENT_CONFIG
+            )
+    return _resources[service_name]
+
+
+def table(table_name):
+    """Return cached DynamoDB Table resource"""
+    try:
+        return _tables[table_name]
+    except KeyError:
+        _tables[table_name] = resource("dynamodb").Table(table_name)
+        return _tables[table_name]
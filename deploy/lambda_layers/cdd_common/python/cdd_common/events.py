@@ -0,0 +1,319 @@
+"""
+Dispenser event log schema, writer and readers
+
+Every event log entry is written through this module:
+
+    {"pk": "105", "ts": Decimal("1576000000.123456"), "dispenserId": "105",
+     "timestamp": "2019-12-10T17:46:40.123456Z", "log": "MQTT: ...",
+     "expiresAt": 1578592000, "timeBucket": "2019-12-10#2"}
+
+pk - partition key, the dispenser id, or for the dispensers configured in
+     EVENT_DAY_BUCKETS (comma separated ids, or "*" for all) the dispenser id
+     and UTC day ("105#2019-12-10") so a busy dispenser's events are spread
+     over a partition per day
+ts - sort key, epoch seconds with microseconds, unique per partition
+timestamp - the same time as ISO 8601 for display
+expiresAt - epoch seconds after which DynamoDB deletes the entry (TTL),
+            EVENT_TTL_DAYS after the event
+timeBucket - partition key of the ByTime index (sort key ts) for time
+             ordered queries across all dispensers, the UTC day and one of
+             TIME_BUCKET_SHARDS shards picked by dispenser id
+requestId - only on the entries of a dispense request, its id (see ids.py),
+            partition key of the sparse ByRequest index (sort key ts) so
+            the entries of a request are one query, see for_request()
+
+Usage:
+    from cdd_common import events
+
+    events.put("105", "MQTT: Dispense complete")
+    events.put_entries([events.entry("105", "..."), ...])
+    events.latest("105", limit=20)
+    items, last = events.history("105", limit=50, start=start, end=end)
+    events.for_request("01ARZ3NDEKTSV4RRFFQ69G5FAV")
+"""
+
+import heapq
+import os
+import time
+import zlib
+from datetime import datetime, timedelta
+from decimal import Decimal
+
+from boto3.dynamodb.conditions import Key
+
+from cdd_common import batch, clients
+
+__copyright__ = (
+    "Copyright 2019 Amazon.com, Inc. or its affiliates. All Rights Reserved."
+)
+__license__ = "MIT-0"
+
+TIME_INDEX = "ByTime"
+REQUEST_INDEX = "ByRequest"
+# Attributes returned by history(), ts and pk locate the next page
+HISTORY_ATTRIBUTES = ("pk", "ts", "dispenserId", "timestamp", "log", "changes", "requestId")
+# Shards of each day in the ByTime index, spreads the writes of all
+# dispensers over this many index partitions
+TIME_BUCKET_SHARDS = 4
+DEFAULT_TTL_DAYS = 30
+EPOCH = datetime(1970, 1, 1)
+MICROSECOND = Decimal("0.000001")
+
+
+def ttl_days():
+    return int(os.environ.get("EVENT_TTL_DAYS", DEFAULT_TTL_DAYS))
+
+
+def is_day_bucketed(dispenser_id):
+    """True if the dispenser's events are partitioned by day"""
+    bucketed = os.environ.get("EVENT_DAY_BUCKETS", "")
+    return bucketed == "*" or dispenser_id in bucketed.split(",")
+
+
+def day(at):
+    return at.strftime("%Y-%m-%d")
+
+
+def partition_key(dispenser_id, at):
+    """Partition key of the dispenser's events at datetime at (UTC)"""
+    if is_day_bucketed(dispenser_id):
+        return f"{dispenser_id}#{day(at)}"
+    return dispenser_id
+
+
+def time_bucket(dispenser_id, at, shard=None):
+    """ByTime index partition key for the dispenser's events on at's day"""
+    if shard is None:
+        shard = zlib.crc32(dispenser_id.encode()) % TIME_BUCKET_SHARDS
+    return f"{day(at)}#{shard}"
+
+
+def epoch(at):
+    """Sort key of datetime at (UTC)"""
+    delta = at - EPOCH
+    return Decimal(delta.days * 86400 + delta.seconds) + delta.microseconds * MICROSECOND
+
+
+def iso_timestamp(ts):
+    """ISO 8601 time of sort key ts"""
+    seconds = int(ts)
+    at = EPOCH + timedelta(
+        seconds=seconds, microseconds=int((ts - seconds) / MICROSECOND)
+    )
+    return at.isoformat(timespec="microseconds") + "Z"
+
+
+def entry(dispenser_id, log, at=None, **attributes):
+    """Event log item for dispenser_id at datetime at (UTC, default now),
+    with any other attributes"""
+
+    at = at or datetime.utcnow()
+    return {
+        "pk": partition_key(dispenser_id, at),
+        "ts": epoch(at),
+        "dispenserId": dispenser_id,
+        "timestamp": at.isoformat(timespec="microseconds") + "Z",
+        "log": log,
+        "expiresAt": int(time.time()) + ttl_days() * 86400,
+        "timeBucket": time_bucket(dispenser_id, at),
+        **attributes,
+    }
+
+
+def unique_entries(entries):
+    """Move the time of entries with the same key as an earlier entry on by a
+    microsecond, as for events logged in the same microsecond and written in
+    one batch. Returns entries."""
+
+    keys = set()
+    for item in entries:
+        while (item["pk"], item["ts"]) in keys:
+            item["ts"] += MICROSECOND
+            item["timestamp"] = iso_timestamp(item["ts"])
+        keys.add((item["pk"], item["ts"]))
+    return entries
+
+
+def table():
+    return clients.table(os.environ["EVENT_TABLE"])
+
+
+def put(dispenser_id, log, at=None, **attributes):
+    """Write an event log entry, returns the item"""
+    item = entry(dispenser_id, log, at, **attributes)
+    table().put_item(Item=item)
+    return item
+
+
+def put_entries(entries):
+    """Write event log entries in batches, see batch.put_items()"""
+    return batch.put_items(os.environ["EVENT_TABLE"], unique_entries(entries))
+
+
+def latest(dispenser_id, limit=20, days=None):
+    """Return the dispenser's latest limit events, newest first. A day
+    bucketed dispenser's partitions are read back day by day, for at most
+    days (default EVENT_TTL_DAYS) days."""
+
+    if not is_day_bucketed(dispenser_id):
+        response = table().query(
+            KeyConditionExpression=Key("pk").eq(dispenser_id),
+            ScanIndexForward=False,
+            Limit=limit,
+        )
+        return response["Items"]
+    items = []
+    today = datetime.utcnow()
+    for days_ago in range(days or ttl_days()):
+        response = table().query(
+            KeyConditionExpression=Key("pk").eq(
+                partition_key(dispenser_id, today - timedelta(days=days_ago))
+            ),
+            ScanIndexForward=False,
+            Limit=limit - len(items),
+        )
+        items.extend(response["Items"])
+        if len(items) >= limit:
+            break
+    return items
+
+
+def latest_all(limit=50, at=None):
+    """Return the latest limit events of all dispensers on at's day (default
+    today), newest first, from the ByTime index"""
+
+    at = at or datetime.utcnow()
+    shards = [
+        table().query(
+            IndexName=TIME_INDEX,
+            KeyConditionExpression=Key("timeBucket").eq(time_bucket("", at, shard)),
+            ScanIndexForward=False,
+            Limit=limit,
+        )["Items"]
+        for shard in range(TIME_BUCKET_SHARDS)
+    ]
+    return list(
+        heapq.merge(*shards, key=lambda item: item["ts"], reverse=True)
+    )[:limit]
+
+
+def for_request(request_id):
+    """Return the events of a request, oldest first, from the ByRequest index"""
+    response = table().query(
+        IndexName=REQUEST_INDEX,
+        KeyConditionExpression=Key("requestId").eq(request_id),
+    )
+    return response["Items"]
+
+
+def days(start, end):
+    """Midnight of each UTC day from end's back to start's"""
+    day = datetime(end.year, end.month, end.day)
+    while day >= datetime(start.year, start.month, start.day):
+        yield day
+        day -= timedelta(days=1)
+
+
+def query_page(key_condition, limit, **kwargs):
+    """One query of at most limit events newest first, HISTORY_ATTRIBUTES only.
+    Returns (items, LastEvaluatedKey or None)."""
+
+    names = {f"#{name}": name for name in HISTORY_ATTRIBUTES}
+    response = table().query(
+        KeyConditionExpression=key_condition,
+        ScanIndexForward=False,
+        Limit=limit,
+        ProjectionExpression=", ".join(names),
+        ExpressionAttributeNames=names,
+        **kwargs,
+    )
+    return response["Items"], response.get("LastEvaluatedKey")
+
+
+def shard_page(bucket, lower, upper, limit, after=None):
+    """At most limit events of a ByTime partition between sort keys lower and
+    upper before after (ts, pk), newest first. Fewer only if the partition
+    has no more."""
+
+    items = []
+    kwargs = {}
+    while True:
+        found, last_key = query_page(
+            Key("timeBucket").eq(bucket) & Key("ts").between(lower, upper),
+            limit - len(items),
+            IndexName=TIME_INDEX,
+            **kwargs,
+        )
+        # Events in the same microsecond as the last event (of other
+        # dispensers) are ordered by pk, those up to it were on the page
+        items.extend(
+            item for item in found if not after or (item["ts"], item["pk"]) < after
+        )
+        if len(items) >= limit or not last_key:
+            return items
+        kwargs = {"ExclusiveStartKey": last_key}
+
+
+def history(dispenser_id=None, limit=50, start=None, end=None, after=None):
+    """Page of events between datetimes start and end (UTC, default the
+    retention period up to now), newest first. All dispensers' events from
+    the ByTime index if dispenser_id is None.
+
+    after is the (ts, pk) of the last event of the previous page. Returns
+    (items, last) with last the (ts, pk) to pass as after for the next page,
+    None if there are no more events. Each page is at most limit items read
+    by queries of one partition per day (or shard), however many events
+    there are before it.
+    """
+
+    end = end or datetime.utcnow()
+    start = start or end - timedelta(days=ttl_days())
+    upper = epoch(end)
+    if after:
+        upper = min(upper, after[0])
+        end = EPOCH + timedelta(seconds=int(upper))
+    lower = epoch(start)
+    if lower > upper:
+        return [], None
+
+    items = []
+    if dispenser_id is not None:
+        partitions = (
+            [partition_key(dispenser_id, day) for day in days(start, end)]
+            if is_day_bucketed(dispenser_id)
+            else [dispenser_id]
+        )
+        for pk in partitions:
+            # The previous page ended in the newest partition
+            kwargs = (
+                {"ExclusiveStartKey": {"pk": pk, "ts": after[0]}}
+                if after and pk == partitions[0]
+                else {}
+            )
+            found, _ = query_page(
+                Key("pk").eq(pk) & Key("ts").between(lower, upper),
+                limit - len(items),
+                **kwargs,
+            )
+            items.extend(found)
+            if len(items) >= limit:
+                break
+    else:
+        for day in days(start, end):
+            # Each shard returns the events still needed unless it has fewer,
+            # so the day is only done when found is short
+            found = [
+                item
+                for shard in range(TIME_BUCKET_SHARDS)
+                for item in shard_page(
+                    time_bucket("", day, shard), lower, upper, limit - len(items), after
+                )
+            ]
+            found.sort(key=lambda item: (item["ts"], item["pk"]), reverse=True)
+            items.extend(found[: limit - len(items)])
+            if len(items) >= limit:
+                break
+
+    if len(items) < limit:
+        return items, None
+    return items, (items[-1]["ts"], items[-1]["pk"])
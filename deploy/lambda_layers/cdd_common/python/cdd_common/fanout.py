@@ -0,0 +1,56 @@
+"""
+Run independent AWS calls concurrently
+
+Calls are run on a thread pool kept for the life of the Lambda execution
+environment, with the shared clients (see clients.py, their connection pool
+allows concurrent requests). A handler making two independent calls waits
+for the slower one instead of both in turn:
+
+    from cdd_common import fanout
+
+    shadow, record = fanout.gather(
+        lambda: clients.client("iot-data").get_thing_shadow(thingName=dispenser),
+        lambda: table.get_item(Key={"dispenserId": dispenser}),
+    )
+"""
+
+import threading
+from concurrent.futures import ThreadPoolExecutor, wait
+
+__copyright__ = (
+    "Copyright 2019 Amazon.com, Inc. or its affiliates. All Rights Reserved."
+)
+__license__ = "MIT-0"
+
+# Most calls in flight at once, more calls are queued
+MAX_WORKERS = 8
+
+_lock = threading.Lock()
+_executor = None
+
+
+def executor():
+    """Return the shared thread pool"""
+    global _executor
+    if _executor is None:
+        with _lock:
+            if _executor is None:
+                _executor = ThreadPoolExecutor(
+                    max_workers=MAX_WORKERS, thread_name_prefix="fanout"
+                )
+    return _executor
+
+
+def gather(*calls):
+    """Call each function in calls (without arguments) concurrently and
+    return their results in order, once all have completed.
+
+    If any call raises, the exception of the first such call (in order) is
+    raised after the others have completed.
+    """
+
+    if len(calls) == 1:
+        return [calls[0]()]
+    futures = [executor().submit(call) for call in calls]
+    wait(futures)
+    return [future.result() for future in futures]
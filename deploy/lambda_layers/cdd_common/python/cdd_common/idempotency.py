@@ -0,0 +1,186 @@
+"""
+Idempotency keys for API requests that must not be repeated
+
+A client that may retry a request sends the same "Idempotency-Key" header
+with each attempt. The first attempt claims the key with a conditional put
+to IDEMPOTENCY_TABLE, and its response is stored with the key. Retries get
+that response back ("Idempotent-Replayed: true") without the handler
+running again:
+
+    {"idempotencyKey": "105#credit#0f8fad5b-d9cb-469f-a165-70867728950e",
+     "status": "completed", "fingerprint": "9b74c9...",
+     "response": "{\"statusCode\": 200, ...}", "expiresAt": 1576000600}
+
+Keys are scoped to the calling dispenser and the API. A retry while the
+first attempt is still running gets 409, a key reused with different
+parameters gets 422. Responses to server errors and rate limited requests
+(5xx, 429) are not kept, so those may be retried with the same key. Keys
+expire after IDEMPOTENCY_TTL seconds (DynamoDB TTL on expiresAt, the
+expiry is also checked as TTL deletion is not immediate). Requests without
+the header are handled as before.
+
+Usage:
+    from cdd_common import idempotency
+
+    @idempotency.idempotent("credit")
+    def handler(event, context):
+        ...
+"""
+
+import functools
+import hashlib
+import json
+import logging
+import os
+import time
+
+from botocore.exceptions import ClientError
+
+from cdd_common import clients
+from cdd_common.responses import HTTP_HEADERS, http_response
+
+__copyright__ = (
+    "Copyright 2019 Amazon.com, Inc. or its affiliates. All Rights Reserved."
+)
+__license__ = "MIT-0"
+
+logger = logging.getLogger()
+logger.setLevel(logging.INFO)
+
+HEADER = "idempotency-key"
+MAX_KEY_LENGTH = 255
+DEFAULT_TTL = 600
+# Seconds after which a claim of a request that never completed (the
+# function failed or timed out) may be taken over by a retry
+IN_PROGRESS_TIMEOUT = 30
+
+
+def ttl():
+    return int(os.environ.get("IDEMPOTENCY_TTL", DEFAULT_TTL))
+
+
+def table():
+    return clients.table(os.environ["IDEMPOTENCY_TABLE"])
+
+
+def request_key(event):
+    """Value of the Idempotency-Key header (any case), None if not sent"""
+    for name, value in (event.get("headers") or {}).items():
+        if name.lower() == HEADER:
+            return value
+    return None
+
+
+def fingerprint(event):
+    """Hash of the request parameters, to spot a key reused for another request"""
+    request = [event.get("queryStringParameters"), event.get("body")]
+    return hashlib.sha256(json.dumps(request, sort_keys=True).encode("utf-8")).hexdigest()
+
+
+def claim(key, request_fingerprint, now):
+    """Claim key for a request, returns None if claimed, otherwise the item
+    of the request that holds it"""
+
+    try:
+        table().put_item(
+            Item={
+                "idempotencyKey": key,
+                "status": "in_progress",
+                "fingerprint": request_fingerprint,
+                "lockedUntil": int(now) + IN_PROGRESS_TIMEOUT,
+                "expiresAt": int(now) + ttl(),
+            },
+            ConditionExpression=(
+                "attribute_not_exists(idempotencyKey) OR expiresAt < :now OR "
+                "(#status = :in_progress AND lockedUntil < :now)"
+            ),
+            ExpressionAttributeNames={"#status": "status"},
+            ExpressionAttributeValues={":now": int(now), ":in_progress": "in_progress"},
+        )
+        return None
+    except ClientError as e:
+        if e.response["Error"]["Code"] != "ConditionalCheckFailedException":
+            raise
+    item = table().get_item(Key={"idempotencyKey": key}, ConsistentRead=True).get("Item")
+    # Released meanwhile, let the caller retry
+    return item or {"status": "in_progress", "fingerprint": request_fingerprint}
+
+
+def complete(key, response):
+    """Keep the response of the request that claimed key"""
+    table().update_item(
+        Key={"idempotencyKey": key},
+        UpdateExpression="SET #status = :completed, #response = :response REMOVE lockedUntil",
+        ExpressionAttributeNames={"#status": "status", "#response": "response"},
+        ExpressionAttributeValues={":completed": "completed", ":response": json.dumps(response)},
+    )
+
+
+def release(key):
+    """Give up the claim of key, so a retry runs the request again"""
+    table().delete_item(Key={"idempotencyKey": key})
+
+
+def is_kept(response):
+    """True if retries should get response rather than try again"""
+    status_code = int(response.get("statusCode", 500))
+    return status_code < 500 and status_code != 429
+
+
+def replay(item, request_fingerprint):
+    """Response to a retry of the request that holds the key"""
+    if item.get("fingerprint") != request_fingerprint:
+        return http_response(
+            HTTP_HEADERS, 422, "ERROR: Idempotency-Key already used for a different request"
+        )
+    if item.get("status") != "completed":
+        return http_response(
+            {**HTTP_HEADERS, "Retry-After": "1"},
+            409,
+            "ERROR: A request with this Idempotency-Key is still in progress",
+        )
+    response = json.loads(item["response"])
+    response["headers"] = {**(response.get("headers") or {}), "Idempotent-Replayed": "true"}
+    return response
+
+
+def idempotent(scope):
+    """Decorate an API Gateway handler to run once per Idempotency-Key,
+    scope names the API the keys are for"""
+
+    def decorate(handler):
+        @functools.wraps(handler)
+        def wrapper(event, context):
+            value = request_key(event)
+            if value is None:
+                return handler(event, context)
+            if not 0 < len(value) <= MAX_KEY_LENGTH:
+                return http_response(
+                    HTTP_HEADERS,
+                    400,
+                    f"ERROR: Idempotency-Key must be 1 to {MAX_KEY_LENGTH} characters",
+                )
+            try:
+                caller = event["requestContext"]["authorizer"]["claims"]["custom:dispenserId"]
+            except (KeyError, TypeError):
+                return handler(event, context)
+            key = f"{caller}#{scope}#{value}"
+            request_fingerprint = fingerprint(event)
+            item = claim(key, request_fingerprint, time.time())
+            if item is not None:
+                logger.info(f"Retry of request with key {key}, not run again")
+                return replay(item, request_fingerprint)
+            try:
+                response = handler(event, context)
+            except Exception:
+                release(key)
+                raise
+            if is_kept(response):
+                complete(key, response)
+            else:
+                release(key)
+            return response
+
+        return wrapper
+
+    return decorate
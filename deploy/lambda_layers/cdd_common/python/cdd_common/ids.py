@@ -0,0 +1,77 @@
+"""
+Sortable request ids (ULID)
+
+A ULID is a 48 bit millisecond timestamp followed by 80 random bits, as 26
+Crockford base32 characters, e.g. "01ARZ3NDEKTSV4RRFFQ69G5FAV". Ids sort by
+the time they were made, as strings or numbers, and two made in the same
+millisecond by the same execution environment sort in the order they were
+made (the random part of the later one is the earlier one's plus one).
+
+Usage:
+    from cdd_common import ids
+
+    request_id = ids.ulid()
+    ids.timestamp(request_id)
+"""
+
+import os
+import threading
+import time
+
+__copyright__ = (
+    "Copyright 2019 Amazon.com, Inc. or its affiliates. All Rights Reserved."
+)
+__license__ = "MIT-0"
+
+ENCODING = "0123456789ABCDEFGHJKMNPQRSTVWXYZ"
+LENGTH = 26
+RANDOM_BITS = 80
+
+_lock = threading.Lock()
+_last = (0, 0)
+
+
+def encode(value):
+    """26 character base32 string of a 128 bit value"""
+    chars = []
+    for _ in range(LENGTH):
+        value, digit = divmod(value, 32)
+        chars.append(ENCODING[digit])
+    return "".join(reversed(chars))
+
+
+def ulid(now=None):
+    """New id for a request made at now (time.time(), default now)"""
+
+    global _last
+    ms = int((time.time() if now is None else now) * 1000)
+    with _lock:
+        last_ms, last_random = _last
+        if ms <= last_ms:
+            # Same millisecond (or the clock went back), keep the order
+            ms = last_ms
+            random = last_random + 1
+            if random >> RANDOM_BITS:
+                ms, random = ms + 1, 0
+        else:
+            random = int.from_bytes(os.urandom(RANDOM_BITS // 8), "big")
+        _last = (ms, random)
+    return encode((ms << RANDOM_BITS) | random)
+
+
+def is_ulid(value):
+    """True if value is a ULID string"""
+    return (
+        isinstance(value, str)
+        and len(value) == LENGTH
+        and value[0] <= "7"
+        and all(c in ENCODING for c in value)
+    )
+
+
+def timestamp(value):
+    """Time (seconds) a ULID was made"""
+    ms = 0
+    for c in value[:10]:
+        ms = ms * 32 + ENCODING.index(c)
+    return ms / 1000
@@ -0,0 +1,197 @@
+"""
+LED ring state from credits, and coalesced updates of the desired LED ring
+in the dispenser's shadow
+
+The last LED ring written to the shadow is kept on the dispenser record:
+
+    "ledRing": {"count": 3, "color": "#00E600", "updatedAt": 1576000000.1}
+
+update_led_ring() skips the shadow update when the ring for the new credits
+is the one already written. A change within LED_RING_DEBOUNCE seconds of
+the last write is deferred to the end of that window
+("ledRing.pendingUntil" is set), where one update writes the ring for the
+credits at that time; changes by other calls while it is pending are left
+to it and return at once. So of a burst of changes only the call that
+claims the update waits, for at most one window (LED_RING_DEBOUNCE seconds),
+and the ring is not older than that.
+"""
+
+import json
+import time
+from decimal import Decimal
+
+from botocore.exceptions import ClientError
+
+from cdd_common import clients
+
+__copyright__ = (
+    "Copyright 2019 Amazon.com, Inc. or its affiliates. All Rights Reserved."
+)
+__license__ = "MIT-0"
+
+# Green colors for 1, 2, 3, and greater
+COLOR_SCALE = ["#006600", "#009900", "#00E600", "#00FF00"]
+# Seconds after a shadow update during which further changes are coalesced
+LED_RING_DEBOUNCE = 1.0
+# Seconds after which a pending update (of a call that failed) is abandoned
+PENDING_TIMEOUT = 10.0
+
+
+def set_led_ring(amount: float):
+    """Return count and color based on credit float amount
+
+    the ring LED has 8 elements and are set based on credit amounts:
+
+    credits         LEDs lit            Color
+    =============== =================== ===========================
+    0 - 0.24        8                    red (#FF0000)
+    0.25 - 0.49     2                    white (#F0F0F0)
+    0.50 - 0.74     4                    white (#F0F0F0)
+    0.75 - 0.99     6                    white (#F0F0F0)
+    1.00 - 1.99     1                    darkest green (#006600)
+    2.00 - 2.99     2                    dark green (#009900)
+    3.00 - 3.99     3                    green (#00E600)
+    4.00 - 4.99     4                    bright green(#00FF00)
+    5.00 - 5.99     5                    bright green(#00FF00)
+    6.00 - 6.99     6                    bright green(#00FF00)
+    7.00 - 7.99     7                    bright green(#00FF00)
+    8.00 >          8                    bright green(#00FF00)
+    """
+
+    # Cast to float, most likely Decimal coming in
+    amount = float(amount)
+    if amount == 0.0:
+        # No credits all lit up red
+        count = 8
+        color = "#FF0000"
+    elif amount < 1.00:
+        # 0.01 - 0.99 - 2 per .25, white
+        count = int(amount / 0.25) * 2
+        color = "#F0F0F0"
+    else:
+        # At least 1.00 or more, set count to 1-8 per 1.00
+        count = int(amount / 1.00) if amount < 8.00 else 8
+        if count < 4:
+            color = COLOR_SCALE[count - 1]
+        else:
+            color = COLOR_SCALE[3]
+    return count, color
+
+
+def written_ring(record):
+    """(count, color) last written to the shadow, None if not known"""
+    ring = record.get("ledRing")
+    if not ring or "count" not in ring:
+        return None
+    return int(ring["count"]), ring["color"]
+
+
+def write_shadow(dispenser_id, desired=None, reported=None):
+    """Update the desired and reported shadow state"""
+    state = {}
+    if desired:
+        state["desired"] = desired
+    if reported:
+        state["reported"] = reported
+    clients.client("iot-data").update_thing_shadow(
+        thingName=dispenser_id, payload=json.dumps({"state": state})
+    )
+
+
+def update_led_ring(table, dispenser_id, credits, record, state=None, now=None):
+    """Set the desired LED ring for credits, if it changed
+
+    record is the dispenser record as read or returned by the update of the
+    credits. state is other shadow state ({"desired": ..., "reported": ...})
+    to write now, with the LED ring if that is written now. Returns True if
+    the LED ring was written, False if unchanged or left to a pending update.
+    """
+
+    state = state or {}
+    now = time.time() if now is None else now
+    ring = record.get("ledRing") or {}
+    pending_until = float(ring.get("pendingUntil", 0))
+    pending = pending_until and now < pending_until + PENDING_TIMEOUT
+    if pending or set_led_ring(credits) == written_ring(record):
+        if state:
+            write_shadow(dispenser_id, **state)
+        return False
+
+    # Claim the update, for now or the end of the debounce window
+    write_at = max(now, float(ring.get("updatedAt", 0)) + LED_RING_DEBOUNCE)
+    condition = "attribute_exists(dispenserId) AND attribute_not_exists(ledRing)"
+    values = {":ring": {**ring, "pendingUntil": Decimal(str(round(write_at, 6)))}}
+    if ring:
+        condition = "ledRing = :previous"
+        values[":previous"] = ring
+    try:
+        table.update_item(
+            Key={"dispenserId": dispenser_id},
+            UpdateExpression="SET ledRing = :ring",
+            ConditionExpression=condition,
+            ExpressionAttributeValues=values,
+        )
+    except ClientError as e:
+        if e.response["Error"]["Code"] != "ConditionalCheckFailedException":
+            raise
+        # Claimed (or written) by a concurrent call
+        if state:
+            write_shadow(dispenser_id, **state)
+        return False
+
+    if write_at > now:
+        if state:
+            write_shadow(dispenser_id, **state)
+            state = {}
+        time.sleep(write_at - now)
+    return flush_led_ring(table, dispenser_id, state, waited=write_at > now)
+
+
+def flush_led_ring(table, dispenser_id, state, waited=False):
+    """Write the LED ring for the current credits and release the claim. If
+    the credits change meanwhile, again for those changes, at the end of the
+    debounce window unless the caller already waited for one (waited).
+    Returns True if the LED ring was written."""
+
+    written = False
+    while True:
+        record = table.get_item(
+            Key={"dispenserId": dispenser_id},
+            ProjectionExpression="credits, ledRing",
+            ConsistentRead=True,
+        ).get("Item")
+        if record is None:
+            return written
+        count, color = set_led_ring(record["credits"])
+        if (count, color) != written_ring(record):
+            desired = {**state.get("desired", {}), "led_ring": {"count": count, "color": color}}
+            write_shadow(dispenser_id, desired, state.get("reported"))
+            written = True
+            table.update_item(
+                Key={"dispenserId": dispenser_id},
+                UpdateExpression="SET ledRing.#count = :count, ledRing.color = :color, ledRing.updatedAt = :now",
+                ExpressionAttributeNames={"#count": "count"},
+                ExpressionAttributeValues={
+                    ":count": count,
+                    ":color": color,
+                    ":now": Decimal(str(round(time.time(), 6))),
+                },
+            )
+        elif state:
+            write_shadow(dispenser_id, **state)
+        state = {}
+        try:
+            table.update_item(
+                Key={"dispenserId": dispenser_id},
+                UpdateExpression="REMOVE ledRing.pendingUntil",
+                ConditionExpression="credits = :credits",
+                ExpressionAttributeValues={":credits": record["credits"]},
+            )
+            return written
+        except ClientError as e:
+            if e.response["Error"]["Code"] != "ConditionalCheckFailedException":
+                raise
+        # Credits changed while writing, their calls left the update to this one
+        if written and not waited:
+            waited = True
+            time.sleep(LED_RING_DEBOUNCE)
@@ -0,0 +1,109 @@
+"""
+CloudWatch metrics in embedded metric format
+
+A metric is written as a JSON line to the function's log, which CloudWatch
+Logs turns into metric data, so publishing one needs no API call or
+permission beyond logging:
+
+    from cdd_common import metrics
+
+    metrics.emit("DispenseLatency", 812.5, unit="Milliseconds", Mode="command")
+
+The metrics are in the METRIC_NAMESPACE namespace (the stack name), keyword
+arguments are the dimensions.
+
+The durations of the stages of a request are published together, one metric
+per stage, with properties that are logged but are not dimensions (the
+request id, to follow a request across functions):
+
+    spans = metrics.Spans(requestId=request_id)
+    with spans.time("Reservation"):
+        ...
+    spans.add("DeviceReport", seconds)
+    spans.mark("sentAt")
+    spans.emit(Mode="command")
+
+A mark is the time of an event as a property (epoch milliseconds), to
+measure a stage that starts in one function and ends in another from the
+records of both.
+"""
+
+import contextlib
+import json
+import os
+import time
+
+__copyright__ = (
+    "Copyright 2019 Amazon.com, Inc. or its affiliates. All Rights Reserved."
+)
+__license__ = "MIT-0"
+
+DEFAULT_NAMESPACE = "CDD"
+
+
+def values_document(values, unit="Count", now=None, dimensions=None, properties=None):
+    """Embedded metric format log document of metric values (name: value)
+    with the same unit and dimensions"""
+
+    dimensions = dimensions or {}
+    return {
+        "_aws": {
+            "Timestamp": int((time.time() if now is None else now) * 1000),
+            "CloudWatchMetrics": [
+                {
+                    "Namespace": os.environ.get("METRIC_NAMESPACE", DEFAULT_NAMESPACE),
+                    "Dimensions": [list(dimensions)],
+                    "Metrics": [{"Name": name, "Unit": unit} for name in values],
+                }
+            ],
+        },
+        **(properties or {}),
+        **values,
+        **dimensions,
+    }
+
+
+def document(name, value, unit="Count", now=None, **dimensions):
+    """Embedded metric format log document of one metric value"""
+    return values_document({name: value}, unit, now, dimensions)
+
+
+def emit(name, value, unit="Count", now=None, **dimensions):
+    """Publish a metric value"""
+    # Printed, not logged, the line must be the JSON document only
+    print(json.dumps(document(name, value, unit, now, **dimensions)))
+
+
+class Spans:
+    """Durations (milliseconds) of the stages of one request"""
+
+    def __init__(self, **properties):
+        self.properties = properties
+        self.durations = {}
+
+    def add(self, name, seconds):
+        self.durations[name] = round(seconds * 1000, 1)
+
+    def mark(self, name, at=None):
+        """Record time at (epoch seconds, default now) as property name"""
+        self.properties[name] = round((time.time() if at is None else at) * 1000, 1)
+
+    @contextlib.contextmanager
+    def time(self, name):
+        """Time the block as stage name"""
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.add(name, time.perf_counter() - start)
+
+    def emit(self, now=None, **dimensions):
+        """Publish the durations, if any"""
+        if self.durations:
+            print(
+                json.dumps(
+                    values_document(
+                        self.durations, "Milliseconds", now, dimensions, self.properties
+                    )
+                )
+            )
@@ -0,0 +1,64 @@
+"""
+IAM account password policy for workshop participants
+
+Participant passwords are generated (see create_resources.create_password)
+and do not meet a typical account password policy, so the policy is relaxed
+to WORKSHOP_PASSWORD_POLICY while the workshop runs. Either the stack applies
+it once on deploy and restores the account's policy on delete (see
+cr_password_policy), or provisioning relaxes it around each user's creation.
+"""
+
+import logging
+
+from botocore.exceptions import ClientError
+
+from cdd_common import retry
+
+__copyright__ = (
+    "Copyright 2019 Amazon.com, Inc. or its affiliates. All Rights Reserved."
+)
+__license__ = "MIT-0"
+
+logger = logging.getLogger()
+logger.setLevel(logging.INFO)
+
+WORKSHOP_PASSWORD_POLICY = {
+    "MinimumPasswordLength": 6,
+    "RequireSymbols": False,
+    "RequireNumbers": True,
+    "RequireUppercaseCharacters": False,
+    "RequireLowercaseCharacters": True,
+    "AllowUsersToChangePassword": False,
+}
+
+
+def get_policy():
+    """Return the account password policy as arguments for set_policy(), or
+    None if the account has no policy"""
+
+    try:
+        policy = retry.call("iam", "get_account_password_policy")["PasswordPolicy"]
+    except ClientError as e:
+        if e.response["Error"]["Code"] != "NoSuchEntity":
+            raise
+        return None
+    # ExpirePasswords is read-only, unset limits are returned as 0 but must be
+    # omitted from the update
+    policy.pop("ExpirePasswords", None)
+    for key in ("MaxPasswordAge", "PasswordReusePrevention"):
+        if not policy.get(key):
+            policy.pop(key, None)
+    return policy
+
+
+def set_policy(policy):
+    """Set the account password policy, or delete it if policy is None"""
+
+    if policy is None:
+        try:
+            retry.call("iam", "delete_account_password_policy")
+        except ClientError as e:
+            if e.response["Error"]["Code"] != "NoSuchEntity":
+                raise
+    else:
+        retry.call("iam", "update_account_password_policy", **policy)
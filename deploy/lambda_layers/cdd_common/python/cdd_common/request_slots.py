@@ -0,0 +1,211 @@
+"""
+In-flight request slots for dispenser records
+
+Each dispenser record holds at most one in-flight request per command in the
+"requests" map attribute, keyed by command:
+
+    "requests": {
+        "dispense": {
+            "requestId": "01ARZ3NDEKTSV4RRFFQ69G5FAV",
+            "timestamp": 1576000000.123,
+            "target": "dispenser",
+            "expiresAt": 1576000005.123
+        }
+    }
+
+Lookups and removals address the slot directly (requests.dispense) with
+targeted UpdateItem SET/REMOVE expressions. Records still using the legacy
+list of "requestId|command|timestamp|target" strings are converted in place
+the first time a slot is updated, see migrate_record(), which also adds the
+newest converted request to the in-flight index below.
+
+A record with an in-flight request also has the command and its expiry in
+the top level "inFlight" and "inFlightExpiresAt" attributes, set and
+removed with the slot (IN_FLIGHT_SET and IN_FLIGHT_REMOVE). Only those
+records are in the sparse INFLIGHT_INDEX, so the expired requests are found
+with one query instead of a scan, see expired() and the sweep_requests
+function.
+
+Usage:
+    from cdd_common import request_slots
+
+    request_slots.get_slot(record, "dispense")
+"""
+
+import time
+from decimal import Decimal
+from typing import NamedTuple
+from boto3.dynamodb.conditions import Key
+from botocore.exceptions import ClientError
+
+__copyright__ = (
+    "Copyright 2019 Amazon.com, Inc. or its affiliates. All Rights Reserved."
+)
+__license__ = "MIT-0"
+
+# Seconds after which an in-flight request is stale and its slot may be reused
+COMMAND_TTL = {"dispense": 5}
+DEFAULT_TTL = 5
+# Sparse index of the records with an in-flight request, by expiry
+INFLIGHT_INDEX = "InFlight"
+# Update actions adding a record to INFLIGHT_INDEX with the SET of its slot
+# (values from in_flight_values()), and removing it with the REMOVE
+IN_FLIGHT_SET = "inFlight = :inFlight, inFlightExpiresAt = :inFlightExpiresAt"
+IN_FLIGHT_REMOVE = "inFlight, inFlightExpiresAt"
+
+
+class RequestSlot(NamedTuple):
+    """In-flight request for a single command"""
+
+    request_id: str
+    command: str
+    timestamp: float
+    target: str
+    expires_at: float
+
+    @classmethod
+    def new(cls, request_id, command, target="dispenser", now=None):
+        """Create slot for a request issued now"""
+        now = time.time() if now is None else now
+        return cls(
+            request_id=request_id,
+            command=command,
+            timestamp=now,
+            target=target,
+            expires_at=now + COMMAND_TTL.get(command, DEFAULT_TTL),
+        )
+
+    @classmethod
+    def from_item(cls, command, item):
+        """Create slot from the DynamoDB map value"""
+        return cls(
+            request_id=item["requestId"],
+            command=command,
+            timestamp=float(item["timestamp"]),
+            target=item["target"],
+            expires_at=float(item["expiresAt"]),
+        )
+
+    def to_item(self):
+        """Return DynamoDB map value for the slot"""
+        return {
+            "requestId": self.request_id,
+            "timestamp": Decimal(str(self.timestamp)),
+            "target": self.target,
+            "expiresAt": Decimal(str(self.expires_at)),
+        }
+
+    def expired(self, now=None):
+        """True if the request is stale"""
+        return (time.time() if now is None else now) >= self.expires_at
+
+
+def in_flight_values(slot):
+    """Values of IN_FLIGHT_SET for the slot"""
+    return {
+        ":inFlight": slot.command,
+        ":inFlightExpiresAt": Decimal(str(slot.expires_at)),
+    }
+
+
+def expired(table, command, now=None, limit=25, after=None):
+    """One page of the records whose request for command expired by now,
+    from INFLIGHT_INDEX. Returns (records, last), last is the key to pass as
+    after for the next page, None on the last page."""
+
+    kwargs = {"ExclusiveStartKey": after} if after else {}
+    response = table.query(
+        IndexName=INFLIGHT_INDEX,
+        KeyConditionExpression=Key("inFlight").eq(command)
+        & Key("inFlightExpiresAt").lte(
+            Decimal(str(time.time() if now is None else now))
+        ),
+        Limit=limit,
+        **kwargs,
+    )
+    return response["Items"], response.get("LastEvaluatedKey")
+
+
+def get_slot(record, command):
+    """Return RequestSlot for command from a dispenser record, or None"""
+    requests = record.get("requests") or {}
+    if isinstance(requests, list):
+        requests = from_legacy(requests)
+    if command in requests:
+        return RequestSlot.from_item(command, requests[command])
+    return None
+
+
+def from_legacy(requests):
+    """Convert legacy "requestId|command|timestamp|target" strings to slot map
+    values, where a command appears more than once the newest request wins"""
+    slots = {}
+    for request in requests:
+        request_id, command, timestamp, target = request.split("|")
+        slot = RequestSlot(
+            request_id=request_id,
+            command=command,
+            timestamp=float(timestamp),
+            target=target,
+            expires_at=float(timestamp) + COMMAND_TTL.get(command, DEFAULT_TTL),
+        )
+        if command not in slots or float(slots[command]["timestamp"]) < slot.timestamp:
+            slots[command] = slot.to_item()
+    return slots
+
+
+def is_invalid_path(error):
+    """True if the ClientError may be due to the requests map not existing (or
+    being a legacy list), which requires migrate_record()"""
+    return error.response["Error"]["Code"] == "ValidationException"
+
+
+def migrate_record(dispenser, table, record=None):
+    """Convert the requests attribute of a record to the slot map
+
+    record is the record if the caller has just read it, otherwise it is read.
+    The conversion is conditional on the attribute not having changed since it
+    was read, so concurrent migrations are safe. Returns True if the record
+    was converted (by this or a concurrent call), False if the record does not
+    exist or already holds a slot map.
+    """
+
+    if record is None:
+        record = table.get_item(
+            Key={"dispenserId": dispenser},
+            ProjectionExpression="dispenserId, requests",
+            ConsistentRead=True,
+        ).get("Item")
+        if record is None:
+            return False
+    requests = record.get("requests")
+    if isinstance(requests, dict):
+        return False
+    update_expression = "SET requests = :requests"
+    if requests is None:
+        condition = "attribute_exists(dispenserId) AND attribute_not_exists(requests)"
+        values = {":requests": {}}
+    else:
+        condition = "requests = :current"
+        slots = from_legacy(requests)
+        values = {":requests": slots, ":current": requests}
+        if slots:
+            # Add the newest request to INFLIGHT_INDEX, so it is swept if it expires
+            newest = max(
+                (RequestSlot.from_item(command, item) for command, item in slots.items()),
+                key=lambda slot: slot.timestamp,
+            )
+            update_expression += f", {IN_FLIGHT_SET}"
+            values.update(in_flight_values(newest))
+    try:
+        table.update_item(
+            Key={"dispenserId": dispenser},
+            UpdateExpression=update_expression,
+            ConditionExpression=condition,
+            ExpressionAttributeValues=values,
+        )
+    except ClientError as e:
+        if e.response["Error"]["Code"] != "ConditionalCheckFailedException":
+            raise
+        # Migrated by a concurrent call
+    return True
@@ -0,0 +1,44 @@
+"""API Gateway proxy responses and JSON encoding of DynamoDB items"""
+
+import json
+from decimal import Decimal
+
+__copyright__ = (
+    "Copyright 2019 Amazon.com, Inc. or its affiliates. All Rights Reserved."
+)
+__license__ = "MIT-0"
+
+# Lambda manages CORS
+HTTP_HEADERS = {"Access-Control-Allow-Origin": "*"}
+
+
+class DecimalEncoder(json.JSONEncoder):
+    """Helper class to convert DynamoDB item to JSON, Decimal values with no
+    fractional part are encoded as int, others as float"""
+
+    def default(self, o):  # pylint: disable=E0202
+        if isinstance(o, Decimal):
+            if o == o.to_integral_value():
+                return int(o)
+            return float(o)
+        return super().default(o)
+
+
+# Reuse a single encoder instead of creating one per call
+_encoder = DecimalEncoder()
+
+
+def dumps(obj):
+    """Serialize obj (which may contain Decimal values) to a JSON string"""
+    return _encoder.encode(obj)
+
+
+def http_response(headers, status_code, body):
+    """Create response dict for returning query"""
+    if type(body) != str:
+        if type(body) == dict:
+            body = dumps(body)
+        else:
+            body = f"ERROR, invalid type of {type(body)} for body of return"
+            status_code = 500
+    return {"body": body, "headers": headers, "statusCode": status_code}
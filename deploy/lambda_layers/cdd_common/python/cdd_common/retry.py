@@ -0,0 +1,247 @@
+"""
+Retries with exponential backoff and full jitter, rate limited per API
+
+All provisioning and deletion calls go through call(), which:
+
+- waits for a token from the API's token bucket so that concurrent callers
+  (the provisioning worker pool) share one request rate per API instead of
+  each retrying on its own. The buckets are per execution environment, not
+  a budget shared by concurrent invocations, so the rates are set below the
+  account limits to leave headroom for those
+- makes each attempt with a client that does not retry itself
+  (clients.unretried_client()), so throttled calls are retried only here,
+  with the backoff and deadline below
+- classifies errors: throttling and transient service errors are always
+  retried, codes passed in retry_on are retried for eventual consistency
+  (e.g. a new IAM user not yet visible to Cloud9), anything else is raised
+  immediately
+- sleeps a random time between 0 and base * 2^attempt (capped), the "full
+  jitter" backoff, so callers that were throttled together do not retry
+  together
+- records attempts, throttles and time spent waiting per API, see
+  log_metrics()
+
+Usage:
+    from cdd_common import retry
+
+    retry.call("iot", "create_thing", thingName=dispenser_id)
+    retry.call(
+        "cloud9", "create_environment_ec2", retry_on=("BadRequestException",), ...
+    )
+"""
+
+import json
+import logging
+import random
+import threading
+import time
+
+from botocore.exceptions import ClientError, ConnectionError, ReadTimeoutError
+
+from cdd_common import clients
+
+__copyright__ = (
+    "Copyright 2019 Amazon.com, Inc. or its affiliates. All Rights Reserved."
+)
+__license__ = "MIT-0"
+
+logger = logging.getLogger()
+logger.setLevel(logging.INFO)
+
+# Backoff is random between 0 and min(BACKOFF_CAP, BACKOFF_BASE * 2^attempt)
+BACKOFF_BASE = 0.25
+BACKOFF_CAP = 20.0
+# Default time to keep retrying a call before raising the last error
+DEFAULT_DEADLINE = 300
+
+THROTTLING_ERRORS = {
+    "Throttling",
+    "ThrottlingException",
+    "ThrottledException",
+    "RequestThrottled",
+    "RequestThrottledException",
+    "RequestLimitExceeded",
+    "TooManyRequestsException",
+    "ProvisionedThroughputExceededException",
+    "SlowDown",
+}
+TRANSIENT_ERRORS = {
+    "InternalError",
+    "InternalFailure",
+    "InternalFailureException",
+    "InternalServerError",
+    "InternalServerException",
+    "ServiceUnavailable",
+    "ServiceUnavailableException",
+    "ServiceFailure",
+    "RequestTimeout",
+    "RequestTimeoutException",
+}
+
+# Sustained requests per second and burst for each API, "service.operation"
+# entries override the "service" entry. Set below the account limits so
+# retries from other callers have headroom.
+RATE_LIMITS = {
+    "iam": (10, 10),
+    "iot": (10, 20),
+    "iot.create_certificate_from_csr": (5, 10),
+    "iot-data": (20, 40),
+    "cloud9": (2, 5),
+    "cognito-idp": (10, 20),
+    "dynamodb": (100, 200),
+}
+DEFAULT_RATE_LIMIT = (10, 20)
+
+
+class TokenBucket:
+    """Thread-safe token bucket, rate tokens per second up to burst"""
+
+    def __init__(self, rate, burst):
+        self.rate = rate
+        self.burst = burst
+        self._tokens = burst
+        self._updated = time.monotonic()
+        self._lock = threading.Lock()
+
+    def acquire(self):
+        """Take a token, waiting for one if needed. Returns seconds waited"""
+        waited = 0.0
+        while True:
+            with self._lock:
+                now = time.monotonic()
+                self._tokens = min(
+                    self.burst, self._tokens + (now - self._updated) * self.rate
+                )
+                self._updated = now
+                if self._tokens >= 1:
+                    self._tokens -= 1
+                    return waited
+                wait = (1 - self._tokens) / self.rate
+            time.sleep(wait)
+            waited += wait
+
+
+class ApiMetrics:
+    """Counters for calls to a single API"""
+
+    def __init__(self):
+        self.calls = 0
+        self.attempts = 0
+        self.throttles = 0
+        self.failures = 0
+        self.backoff_time = 0.0
+        self.rate_limit_time = 0.0
+        self._lock = threading.Lock()
+
+    def add(self, **counts):
+        with self._lock:
+            for counter, value in counts.items():
+                setattr(self, counter, getattr(self, counter) + value)
+
+    def as_dict(self):
+        return {
+            "calls": self.calls,
+            "attempts": self.attempts,
+            "throttles": self.throttles,
+            "failures": self.failures,
+            "backoffTime": round(self.backoff_time, 3),
+            "rateLimitTime": round(self.rate_limit_time, 3),
+        }
+
+
+_lock = threading.Lock()
+_buckets = {}
+_metrics = {}
+
+
+def api_name(service_name, operation):
+    return f"{service_name}.{operation}"
+
+
+def bucket(service_name, operation):
+    """Return the shared token bucket for the API"""
+    name = api_name(service_name, operation)
+    key = name if name in RATE_LIMITS else service_name
+    with _lock:
+        if key not in _buckets:
+            _buckets[key] = TokenBucket(*RATE_LIMITS.get(key, DEFAULT_RATE_LIMIT))
+        return _buckets[key]
+
+
+def metrics(name):
+    """Return the metrics for the API"""
+    with _lock:
+        if name not in _metrics:
+            _metrics[name] = ApiMetrics()
+        return _metrics[name]
+
+
+def error_code(error):
+    """Error code of a ClientError, or the exception class name"""
+    if isinstance(error, ClientError):
+        return error.response["Error"]["Code"]
+    return type(error).__name__
+
+
+def is_retryable(error, retry_on=()):
+    """True if the call that raised error should be retried"""
+    if isinstance(error, (ConnectionError, ReadTimeoutError)):
+        return True
+    if not isinstance(error, ClientError):
+        return False
+    code = error_code(error)
+    return code in THROTTLING_ERRORS or code in TRANSIENT_ERRORS or code in retry_on
+
+
+def backoff(attempt):
+    """Full jitter delay before retry number attempt (1 is the first retry)"""
+    return random.uniform(0, min(BACKOFF_CAP, BACKOFF_BASE * 2 ** attempt))
+
+
+def call(service_name, operation, retry_on=(), deadline=DEFAULT_DEADLINE, **kwargs):
+    """Call client operation with kwargs, retrying retryable errors with
+    backoff until deadline seconds have passed, then raise the last error"""
+
+    method = getattr(clients.unretried_client(service_name), operation)
+    name = api_name(service_name, operation)
+    api_bucket = bucket(service_name, operation)
+    api_metrics = metrics(name)
+    api_metrics.add(calls=1)
+    start_time = time.time()
+    attempt = 0
+    while True:
+        api_metrics.add(attempts=1, rate_limit_time=api_bucket.acquire())
+        try:
+            return method(**kwargs)
+        except (ClientError, ConnectionError, ReadTimeoutError) as e:
+            if error_code(e) in THROTTLING_ERRORS:
+                api_metrics.add(throttles=1)
+            attempt += 1
+            delay = backoff(attempt)
+            if not is_retryable(e, retry_on) or (
+                time.time() - start_time + delay > deadline
+            ):
+                api_metrics.add(failures=1)
+                raise
+            logger.warning(
+                f"Error calling {name}() (will retry in {delay:.2f}s, attempt {attempt}), error: {e}"
+            )
+            api_metrics.add(backoff_time=delay)
+            time.sleep(delay)
+
+
+def log_metrics():
+    """Log and reset the per-API metrics, call at the end of an invocation"""
+    with _lock:
+        summary = {name: m.as_dict() for name, m in sorted(_metrics.items())}
+        _metrics.clear()
+    if summary:
+        logger.info("API call metrics: %s", json.dumps(summary))
+    return summary
+
+
+def reset():
+    """Discard the token buckets (to apply changed RATE_LIMITS) and metrics"""
+    with _lock:
+        _buckets.clear()
+        _metrics.clear()
@@ -0,0 +1,116 @@
+"""
+Dispenser status projection
+
+The reported LED and LED ring state of each dispenser's shadow is copied to
+its dispenser record, next to the credits, so the status is one GetItem:
+
+    "shadowState": {"led": "on", "ledRing": {"count": 3, "color": "#00E600"},
+                    "version": 42, "updatedAt": 1576000000.123}
+
+version is the shadow document version the state was taken from, an
+update only applies if it is newer (or the same version, refreshing
+updatedAt), so out of order shadow documents cannot overwrite newer state.
+process_events updates it from the shadow update documents, read() falls
+back to the live shadow if it is missing or older than STATUS_MAX_AGE
+seconds.
+
+Usage:
+    from cdd_common import status
+
+    status.read("105")
+"""
+
+import json
+import os
+import time
+from decimal import Decimal
+
+from botocore.exceptions import ClientError
+
+from cdd_common import clients
+
+__copyright__ = (
+    "Copyright 2019 Amazon.com, Inc. or its affiliates. All Rights Reserved."
+)
+__license__ = "MIT-0"
+
+DEFAULT_MAX_AGE = 3600
+
+
+def max_age():
+    return float(os.environ.get("STATUS_MAX_AGE", DEFAULT_MAX_AGE))
+
+
+def projection(state, version, at=None):
+    """Status projection of a shadow's state at version"""
+
+    reported = state.get("reported") or {}
+    led_ring = reported.get("led_ring") or {}
+    return {
+        # Defaults if not in the reported state
+        "led": reported.get("led", "off"),
+        "ledRing": {
+            "count": int(led_ring.get("count", 0)),
+            "color": str(led_ring.get("color", "#FFFFFF")),
+        },
+        "version": int(version),
+        "updatedAt": Decimal(str(round(time.time() if at is None else at, 6))),
+    }
+
+
+def table():
+    return clients.table(os.environ["DISPENSER_TABLE"])
+
+
+def update(dispenser_id, shadow_state):
+    """Set the projection of a dispenser record, unless the record has a
+    newer one or does not exist. Returns True if set."""
+
+    try:
+        table().update_item(
+            Key={"dispenserId": dispenser_id},
+            UpdateExpression="SET shadowState = :state",
+            ConditionExpression=(
+                "attribute_exists(dispenserId) AND "
+                "(attribute_not_exists(shadowState) OR shadowState.version <= :version)"
+            ),
+            ExpressionAttributeValues={
+                ":state": shadow_state,
+                ":version": shadow_state["version"],
+            },
+        )
+    except ClientError as e:
+        if e.response["Error"]["Code"] != "ConditionalCheckFailedException":
+            raise
+        return False
+    return True
+
+
+def live(dispenser_id):
+    """Status projection of the dispenser's shadow as it is now"""
+    shadow = json.loads(
+        clients.client("iot-data")
+        .get_thing_shadow(thingName=dispenser_id)["payload"]
+        .read()
+        .decode("utf-8")
+    )
+    return projection(shadow.get("state", {}), shadow.get("version", 0))
+
+
+def read(dispenser_id):
+    """Return the dispenser record's credits and shadowState, from the live
+    shadow (and refreshed) if the projection is missing or stale, None if
+    the dispenser does not exist"""
+
+    response = table().get_item(
+        Key={"dispenserId": dispenser_id},
+        ProjectionExpression="credits, shadowState",
+    )
+    if "Item" not in response:
+        return None
+    item = response["Item"]
+    shadow_state = item.get("shadowState")
+    if shadow_state is None or time.time() - float(shadow_state["updatedAt"]) > max_age():
+        item["shadowState"] = live(dispenser_id)
+        update(dispenser_id, item["shadowState"])
+    return item
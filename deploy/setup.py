@@ -26,9 +26,13 @@ setuptools.setup(
         "aws_cdk.aws_cognito>=1.20.0",
         "aws_cdk.aws_cloudfront>=1.20.0",
         "aws_cdk.aws_dynamodb>=1.20.0",
+        "aws_cdk.aws_events>=1.20.0",
+        "aws_cdk.aws_events_targets>=1.20.0",
         "aws_cdk.aws_s3>=1.20.0",
         "aws_cdk.aws_iam>=1.20.0",
         "aws_cdk.aws_iot>=1.20.0",
+        "aws_cdk.aws_kinesis>=1.20.0",
+        "aws_cdk.aws_lambda_event_sources>=1.20.0",
         "aws_cdk.aws_route53>=1.20.0",
         "aws_cdk.aws_route53_targets>=1.20.0"
     ],
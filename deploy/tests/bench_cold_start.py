@@ -0,0 +1,109 @@
+#!/usr/bin/env python3
+"""
+Cold-start benchmark for the /getResources function
+
+Reports the deployment package size and the handler import time (median of
+fresh interpreters) with the crypto stack bundled and imported at module load
+("before") and packaged as a separate layer and imported only when
+provisioning ("after").
+
+The vendored crypto layer is built for the Lambda Python 3.7 runtime, run this
+with a matching interpreter to include the "before" import time:
+
+    $ python3.7 tests/bench_cold_start.py --runs 20
+"""
+
+import argparse
+import io
+import os
+import statistics
+import subprocess
+import sys
+import zipfile
+from pathlib import Path
+
+__copyright__ = (
+    "Copyright 2019 Amazon.com, Inc. or its affiliates. All Rights Reserved."
+)
+__license__ = "MIT-0"
+
+DEPLOY_DIR = Path(__file__).resolve().parent.parent
+FUNCTION_DIR = DEPLOY_DIR / "lambda_functions" / "api_get_resources"
+COMMON_LAYER_DIR = DEPLOY_DIR / "lambda_layers" / "cdd_common" / "python"
+CRYPTO_LAYER_DIR = DEPLOY_DIR / "lambda_layers" / "crypto" / "python"
+
+# Imports previously made by create_resources at module load
+EAGER_CRYPTO_IMPORTS = """
+from cryptography.hazmat.backends import default_backend
+from cryptography.hazmat.primitives import serialization
+from cryptography.hazmat.primitives.asymmetric import ec
+from cryptography import x509
+from cryptography.x509.oid import NameOID
+from cryptography.hazmat.primitives import hashes
+"""
+
+TIMED_IMPORT = """
+import sys, time
+sys.path[:0] = {paths!r}
+start = time.perf_counter()
+{imports}
+import get_resources
+print(time.perf_counter() - start)
+"""
+
+
+def zipped_size(*directories):
+    """Return size in bytes of the deflated zip of directories, as packaged
+    by the CDK asset staging"""
+    buffer = io.BytesIO()
+    with zipfile.ZipFile(buffer, "w", zipfile.ZIP_DEFLATED) as archive:
+        for directory in directories:
+            for root, _, files in os.walk(directory):
+                for name in files:
+                    path = Path(root) / name
+                    if "__pycache__" in path.parts:
+                        continue
+                    archive.write(path, path.relative_to(directory))
+    return buffer.tell()
+
+
+def import_time(paths, imports, runs):
+    """Median seconds to import the handler module in a fresh interpreter"""
+    code = TIMED_IMPORT.format(paths=[str(p) for p in paths], imports=imports)
+    env = {**os.environ, "AWS_DEFAULT_REGION": "us-west-2"}
+    samples = []
+    for _ in range(runs):
+        result = subprocess.run(
+            [sys.executable, "-c", code], capture_output=True, text=True, env=env
+        )
+        if result.returncode != 0:
+            error = result.stderr.strip().splitlines()[-1]
+            raise RuntimeError(error)
+        samples.append(float(result.stdout))
+    return statistics.median(samples)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument("--runs", type=int, default=10, help="interpreters per case")
+    args = parser.parse_args()
+
+    before_size = zipped_size(FUNCTION_DIR, CRYPTO_LAYER_DIR)
+    after_size = zipped_size(FUNCTION_DIR)
+    print("Deployment package (zipped)")
+    print(f"  before: {before_size / 1024:10.1f} KiB  function with crypto bundled")
+    print(f"  after:  {after_size / 1024:10.1f} KiB  function only")
+    print(f"          {zipped_size(CRYPTO_LAYER_DIR) / 1024:10.1f} KiB  crypto layer")
+
+    print(f"Handler import time (median of {args.runs})")
+    paths = [FUNCTION_DIR, COMMON_LAYER_DIR, CRYPTO_LAYER_DIR]
+    for label, imports in (("before", EAGER_CRYPTO_IMPORTS), ("after", "")):
+        try:
+            seconds = import_time(paths, imports, args.runs)
+            print(f"  {label + ':':7} {seconds * 1000:10.1f} ms")
+        except RuntimeError as e:
+            print(f"  {label + ':':7}        n/a  ({e})")
+
+
+if __name__ == "__main__":
+    main()
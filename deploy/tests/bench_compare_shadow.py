@@ -0,0 +1,147 @@
+#!/usr/bin/env python3
+"""
+Micro-benchmark for the process_events shadow diff
+
+Times compare_shadow() on synthetic shadow documents with many reported
+attributes, for the recursive string-concatenating implementation it
+replaced ("before") and the current diff engine ("after"). Each case changes
+a fraction of the leaf attributes, and adds and removes a few:
+
+    $ python tests/bench_compare_shadow.py --attributes 1000 --depth 3
+"""
+
+import argparse
+import copy
+import os
+import random
+import sys
+import timeit
+from pathlib import Path
+
+__copyright__ = (
+    "Copyright 2019 Amazon.com, Inc. or its affiliates. All Rights Reserved."
+)
+__license__ = "MIT-0"
+
+DEPLOY_DIR = Path(__file__).resolve().parent.parent
+sys.path[:0] = [
+    str(DEPLOY_DIR / "lambda_functions" / "process_events"),
+    str(DEPLOY_DIR / "lambda_layers" / "cdd_common" / "python"),
+]
+os.environ.setdefault("AWS_DEFAULT_REGION", "us-west-2")
+import process_events  # noqa: E402
+
+
+def before_compare_shadow(current, previous, path="", section=""):
+    """compare_shadow() as it was before the diff engine"""
+
+    err = ""
+    key_add = ""
+    key_change = ""
+    old_path = path
+    for k in current.keys():
+        if k == "desired" or k == "reported":
+            section = k
+        else:
+            # Set path only after desired or reported
+            path = old_path + "[%s]" % k
+        if not k in previous:
+            key_add += f'Attribute {path} = {current[k]} added to "{section} state"\n'
+        else:
+            if isinstance(current[k], dict) and isinstance(previous[k], dict):
+                err += before_compare_shadow(current[k], previous[k], path, section)
+            else:
+                if current[k] != previous[k]:
+                    key_change += f'Attribute {path} in "{section} state" changed from "{previous[k]}" to "{current[k]}"'
+
+    for k in previous.keys():
+        path = old_path + "[%s]" % k
+        if not k in current:
+            key_add += f'Attribute {path} removed from "{section} state"\n'
+
+    return "Shadow: " + key_add + key_change + err
+
+
+def synthetic_state(attributes, depth, rng):
+    """Reported state with attributes leaves spread over nested documents"""
+
+    fanout = max(2, round(attributes ** (1 / depth)))
+
+    def document(level, remaining):
+        if level == depth or remaining <= fanout:
+            return {f"attr{i}": rng.randint(0, 1000) for i in range(remaining)}
+        share = remaining // fanout
+        return {
+            f"group{i}": document(level + 1, share + (remaining % fanout if i == 0 else 0))
+            for i in range(fanout)
+        }
+
+    return {
+        "desired": {"led": "off", "led_ring": {"count": 1, "color": "#006600"}},
+        "reported": document(1, attributes),
+    }
+
+
+def leaves(document, parents=()):
+    for key, value in document.items():
+        if isinstance(value, dict):
+            yield from leaves(value, parents + (key,))
+        else:
+            yield parents, key
+
+
+def changed_state(previous, fraction, rng):
+    """Copy of previous with a fraction of the leaves changed, and a few
+    added and removed"""
+
+    current = copy.deepcopy(previous)
+    all_leaves = list(leaves(current["reported"]))
+    for parents, key in rng.sample(all_leaves, max(1, int(len(all_leaves) * fraction))):
+        document = current["reported"]
+        for parent in parents:
+            document = document[parent]
+        document[key] += 1
+    for i, (parents, key) in enumerate(rng.sample(all_leaves, 4)):
+        document = current["reported"]
+        for parent in parents:
+            document = document[parent]
+        if i % 2:
+            document.pop(key, None)
+        else:
+            document[f"{key}_new"] = 0
+    return current
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument("--attributes", type=int, default=1000, help="reported leaves")
+    parser.add_argument("--depth", type=int, default=3, help="nesting of reported state")
+    parser.add_argument("--runs", type=int, default=200, help="diffs per timing")
+    args = parser.parse_args()
+
+    rng = random.Random(42)
+    previous = synthetic_state(args.attributes, args.depth, rng)
+    print(
+        f"compare_shadow() on {args.attributes} reported attributes, depth {args.depth}, "
+        f"median of 5 x {args.runs} diffs"
+    )
+    for fraction in (0.0, 0.01, 0.1, 1.0):
+        current = changed_state(previous, fraction, rng)
+        timings = {}
+        for label, function in (
+            ("before", before_compare_shadow),
+            ("after", process_events.compare_shadow),
+        ):
+            samples = timeit.repeat(
+                lambda: function(current, previous), number=args.runs, repeat=5
+            )
+            timings[label] = sorted(samples)[2] / args.runs
+        print(
+            f"  {fraction:5.0%} changed:  before {timings['before'] * 1e6:9.1f} us  "
+            f"after {timings['after'] * 1e6:9.1f} us  "
+            f"({timings['before'] / timings['after']:.1f}x)"
+        )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,312 @@
+"""
+Shared setup for exercising the Lambda functions against local stand-ins
+of the AWS services (moto). No AWS account or credentials are used.
+"""
+
+import base64
+import functools
+import json
+import os
+import sys
+import threading
+from pathlib import Path
+
+import pytest
+
+__copyright__ = (
+    "Copyright 2019 Amazon.com, Inc. or its affiliates. All Rights Reserved."
+)
+__license__ = "MIT-0"
+
+DEPLOY_DIR = Path(__file__).resolve().parent.parent
+LAMBDA_DIR = DEPLOY_DIR / "lambda_functions"
+LAYER_DIR = DEPLOY_DIR / "lambda_layers"
+EVENT_STREAM = "test-DispenserEventStream"
+
+# Lambda layers are extracted to /opt/python, add the same directories here
+sys.path.insert(0, str(LAYER_DIR / "cdd_common" / "python"))
+
+# Never let a test reach a real account
+os.environ["AWS_ACCESS_KEY_ID"] = "testing"
+os.environ["AWS_SECRET_ACCESS_KEY"] = "testing"
+os.environ["AWS_SECURITY_TOKEN"] = "testing"
+os.environ["AWS_SESSION_TOKEN"] = "testing"
+os.environ["AWS_DEFAULT_REGION"] = "us-west-2"
+os.environ.pop("AWS_PROFILE", None)
+
+# Environment variables normally set by the CDK stack
+os.environ.setdefault("DISPENSER_TABLE", "test-DispenserTable")
+os.environ.setdefault("EVENT_TABLE", "test-DispenserEventLog")
+os.environ.setdefault("USER_TABLE", "test-UserTable")
+os.environ.setdefault("CERT_POOL_TABLE", "test-CertificatePool")
+os.environ.setdefault("IDEMPOTENCY_TABLE", "test-IdempotencyTable")
+os.environ.setdefault("USER_PERMISSIONS_GROUP", "test-UserGroup")
+os.environ.setdefault("IOT_POLICY_DISPENSER_LIMITED", "test-DispenserLimited")
+os.environ.setdefault("IOT_POLICY_CLIENT", "test-ClientPolicy")
+os.environ.setdefault("CLOUD9_INSTANCE_SIZE", "t2.micro")
+
+
+def add_lambda_path(function_directory):
+    """Make the Lambda function's modules importable"""
+    path = str(LAMBDA_DIR / function_directory)
+    if path not in sys.path:
+        sys.path.insert(0, path)
+
+
+def create_tables(ddb):
+    """Create the DynamoDB tables as defined in cdd/base_services.py"""
+    ddb.create_table(
+        TableName=os.environ["DISPENSER_TABLE"],
+        KeySchema=[{"AttributeName": "dispenserId", "KeyType": "HASH"}],
+        AttributeDefinitions=[
+            {"AttributeName": "dispenserId", "AttributeType": "S"},
+            {"AttributeName": "inFlight", "AttributeType": "S"},
+            {"AttributeName": "inFlightExpiresAt", "AttributeType": "N"},
+        ],
+        GlobalSecondaryIndexes=[
+            {
+                "IndexName": "InFlight",
+                "KeySchema": [
+                    {"AttributeName": "inFlight", "KeyType": "HASH"},
+                    {"AttributeName": "inFlightExpiresAt", "KeyType": "RANGE"},
+                ],
+                "Projection": {
+                    "ProjectionType": "INCLUDE",
+                    "NonKeyAttributes": ["requests"],
+                },
+            }
+        ],
+        BillingMode="PAY_PER_REQUEST",
+    )
+    ddb.create_table(
+        TableName=os.environ["EVENT_TABLE"],
+        KeySchema=[
+            {"AttributeName": "pk", "KeyType": "HASH"},
+            {"AttributeName": "ts", "KeyType": "RANGE"},
+        ],
+        AttributeDefinitions=[
+            {"AttributeName": "pk", "AttributeType": "S"},
+            {"AttributeName": "ts", "AttributeType": "N"},
+            {"AttributeName": "timeBucket", "AttributeType": "S"},
+            {"AttributeName": "requestId", "AttributeType": "S"},
+        ],
+        GlobalSecondaryIndexes=[
+            {
+                "IndexName": "ByTime",
+                "KeySchema": [
+                    {"AttributeName": "timeBucket", "KeyType": "HASH"},
+                    {"AttributeName": "ts", "KeyType": "RANGE"},
+                ],
+                "Projection": {"ProjectionType": "ALL"},
+            },
+            {
+                "IndexName": "ByRequest",
+                "KeySchema": [
+                    {"AttributeName": "requestId", "KeyType": "HASH"},
+                    {"AttributeName": "ts", "KeyType": "RANGE"},
+                ],
+                "Projection": {"ProjectionType": "ALL"},
+            },
+        ],
+        BillingMode="PAY_PER_REQUEST",
+    )
+    ddb.create_table(
+        TableName=os.environ["CERT_POOL_TABLE"],
+        KeySchema=[{"AttributeName": "dispenserId", "KeyType": "HASH"}],
+        AttributeDefinitions=[{"AttributeName": "dispenserId", "AttributeType": "S"}],
+        BillingMode="PAY_PER_REQUEST",
+    )
+    ddb.create_table(
+        TableName=os.environ["IDEMPOTENCY_TABLE"],
+        KeySchema=[{"AttributeName": "idempotencyKey", "KeyType": "HASH"}],
+        AttributeDefinitions=[{"AttributeName": "idempotencyKey", "AttributeType": "S"}],
+        BillingMode="PAY_PER_REQUEST",
+    )
+    ddb.create_table(
+        TableName=os.environ["USER_TABLE"],
+        KeySchema=[{"AttributeName": "userName", "KeyType": "HASH"}],
+        AttributeDefinitions=[{"AttributeName": "userName", "AttributeType": "S"}],
+        BillingMode="PAY_PER_REQUEST",
+    )
+
+
+@pytest.fixture
+def aws(monkeypatch):
+    """Start the local AWS stand-ins with the workshop tables created
+
+    The stand-in backends are not thread safe, so requests are serialised to
+    give the same per-item atomicity as the real services when tests fire
+    concurrent calls.
+    """
+    moto = pytest.importorskip("moto")
+    import boto3
+    from moto.core.botocore_stubber import BotocoreStubber
+
+    lock = threading.Lock()
+    stub = BotocoreStubber.__call__
+
+    @functools.wraps(stub)
+    def serialised(self, *args, **kwargs):
+        with lock:
+            return stub(self, *args, **kwargs)
+
+    monkeypatch.setattr(BotocoreStubber, "__call__", serialised)
+    with moto.mock_aws():
+        create_tables(boto3.resource("dynamodb"))
+        yield
+
+
+@pytest.fixture
+def thing(aws):
+    """Factory to create an IoT thing (required before shadow operations)"""
+    import boto3
+
+    def create(thing_name):
+        boto3.client("iot").create_thing(thingName=thing_name)
+        return thing_name
+
+    return create
+
+
+class Cloud9StandIn:
+    """Local stand-in for the Cloud9 API, which moto does not provide
+
+    Like the service, an environment can only be created for an owner that
+    IAM already knows about.
+    """
+
+    def __init__(self):
+        import boto3
+
+        self.iam = boto3.client("iam")
+        self.environments = {}
+        self._lock = threading.Lock()
+
+    def create_environment_ec2(self, name, instanceType, ownerArn, **kwargs):
+        from botocore.exceptions import ClientError
+
+        username = ownerArn.split("/")[-1]
+        try:
+            self.iam.get_user(UserName=username)
+        except ClientError:
+            raise ClientError(
+                {"Error": {"Code": "BadRequestException", "Message": "Invalid owner"}},
+                "CreateEnvironmentEC2",
+            )
+        with self._lock:
+            environment_id = f"{len(self.environments):032x}"
+            self.environments[environment_id] = {
+                "name": name,
+                "instanceType": instanceType,
+                "ownerArn": ownerArn,
+            }
+        return {"environmentId": environment_id}
+
+    def list_environments(self, **kwargs):
+        with self._lock:
+            return {"environmentIds": list(self.environments)}
+
+    def describe_environments(self, environmentIds):
+        with self._lock:
+            return {
+                "environments": [
+                    {"id": environment_id, **self.environments[environment_id]}
+                    for environment_id in environmentIds
+                ]
+            }
+
+    def delete_environment(self, environmentId):
+        with self._lock:
+            self.environments.pop(environmentId)
+        return {}
+
+
+@pytest.fixture
+def cloud9(aws, monkeypatch):
+    """Cloud9 stand-in returned by clients.client("cloud9") and unretried_client()"""
+    from cdd_common import clients
+
+    stand_in = Cloud9StandIn()
+    monkeypatch.setitem(clients._clients, "cloud9", stand_in)
+    monkeypatch.setitem(clients._unretried_clients, "cloud9", stand_in)
+    return stand_in
+
+
+@pytest.fixture
+def unlimited_rate(monkeypatch):
+    """Lift the per-API rate limits, the stand-ins have none"""
+    from cdd_common import retry
+
+    monkeypatch.setattr(retry, "RATE_LIMITS", {})
+    monkeypatch.setattr(retry, "DEFAULT_RATE_LIMIT", (10000, 10000))
+    retry.reset()
+    yield
+    retry.reset()
+
+
+@pytest.fixture
+def stream(aws, unlimited_rate):
+    """Kinesis stream stand-in for batched event ingestion, returns a
+    function that puts messages as the IoT rules do and returns the Lambda
+    event for the records"""
+    import boto3
+
+    kinesis = boto3.client("kinesis")
+    kinesis.create_stream(StreamName=EVENT_STREAM, ShardCount=1)
+    shard_id = kinesis.describe_stream(StreamName=EVENT_STREAM)["StreamDescription"][
+        "Shards"
+    ][0]["ShardId"]
+    iterator = kinesis.get_shard_iterator(
+        StreamName=EVENT_STREAM, ShardId=shard_id, ShardIteratorType="LATEST"
+    )["ShardIterator"]
+
+    def put(messages):
+        nonlocal iterator
+        for message in messages:
+            kinesis.put_record(
+                StreamName=EVENT_STREAM,
+                Data=json.dumps(message).encode(),
+                PartitionKey=message["topic"],
+            )
+        response = kinesis.get_records(ShardIterator=iterator)
+        iterator = response["NextShardIterator"]
+        return {
+            "Records": [
+                {
+                    "kinesis": {
+                        "partitionKey": record["PartitionKey"],
+                        "sequenceNumber": record["SequenceNumber"],
+                        "data": base64.b64encode(record["Data"]).decode(),
+                        "approximateArrivalTimestamp": record[
+                            "ApproximateArrivalTimestamp"
+                        ].timestamp(),
+                    },
+                    "eventSource": "aws:kinesis",
+                }
+                for record in response["Records"]
+            ]
+        }
+
+    return put
+
+
+@pytest.fixture
+def workshop(aws, cloud9, unlimited_rate):
+    """Resources created by the CDK stack that provisioning depends on:
+    participant IAM group, IoT policies and a Cognito identity pool.
+    Returns a factory for Cognito identity ids."""
+    import boto3
+
+    boto3.client("iam").create_group(GroupName=os.environ["USER_PERMISSIONS_GROUP"])
+    iot = boto3.client("iot")
+    for policy in ("IOT_POLICY_DISPENSER_LIMITED", "IOT_POLICY_CLIENT"):
+        iot.create_policy(policyName=os.environ[policy], policyDocument="{}")
+    cognito = boto3.client("cognito-identity")
+    pool_id = cognito.create_identity_pool(
+        IdentityPoolName="test", AllowUnauthenticatedIdentities=False
+    )["IdentityPoolId"]
+
+    def identity():
+        return cognito.get_id(IdentityPoolId=pool_id)["IdentityId"]
+
+    return identity
@@ -0,0 +1,202 @@
+"""Tests for the shared cdd_common layer"""
+
+import json
+import time
+from decimal import Decimal
+
+import pytest
+from botocore.exceptions import ClientError
+
+import conftest  # noqa: F401 - adds the layer to sys.path
+from cdd_common import clients, fanout, ids, metrics, retry
+from cdd_common.led import set_led_ring
+from cdd_common.responses import HTTP_HEADERS, dumps, http_response
+
+__copyright__ = (
+    "Copyright 2019 Amazon.com, Inc. or its affiliates. All Rights Reserved."
+)
+__license__ = "MIT-0"
+
+
+def test_decimal_encoding():
+    assert json.loads(dumps({"a": Decimal("3"), "b": Decimal("3.25")})) == {
+        "a": 3,
+        "b": 3.25,
+    }
+    assert dumps({"a": Decimal("3.00")}) == '{"a": 3}'
+
+
+def test_http_response_encodes_items():
+    response = http_response(HTTP_HEADERS, 200, {"credits": Decimal("1.25")})
+    assert response["body"] == '{"credits": 1.25}'
+    assert http_response(HTTP_HEADERS, 200, 1)["statusCode"] == 500
+
+
+def test_set_led_ring():
+    assert set_led_ring(Decimal("0")) == (8, "#FF0000")
+    assert set_led_ring(Decimal("0.50")) == (4, "#F0F0F0")
+    assert set_led_ring(Decimal("3.25")) == (3, "#00E600")
+    assert set_led_ring(Decimal("12")) == (8, "#00FF00")
+
+
+class FlakyClient:
+    """Client whose operation raises the given error codes, then succeeds"""
+
+    def __init__(self, *codes):
+        self.codes = list(codes)
+        self.calls = 0
+
+    def operation(self, **kwargs):
+        self.calls += 1
+        if self.codes:
+            code = self.codes.pop(0)
+            raise ClientError({"Error": {"Code": code, "Message": code}}, "Operation")
+        return {"ResponseMetadata": {"RetryAttempts": 0}, **kwargs}
+
+
+@pytest.fixture
+def flaky(monkeypatch, unlimited_rate):
+    monkeypatch.setattr(retry, "BACKOFF_BASE", 0.001)
+
+    def install(*codes):
+        client = FlakyClient(*codes)
+        monkeypatch.setitem(clients._unretried_clients, "flaky", client)
+        return client
+
+    return install
+
+
+def test_backoff_is_full_jitter():
+    delays = [retry.backoff(3) for _ in range(1000)]
+    assert 0 <= min(delays) < 0.1 * retry.BACKOFF_BASE * 2 ** 3
+    assert max(delays) <= retry.BACKOFF_BASE * 2 ** 3
+    assert max(retry.backoff(30) for _ in range(100)) <= retry.BACKOFF_CAP
+
+
+def test_retries_throttling_and_transient_errors(flaky):
+    client = flaky("ThrottlingException", "ServiceUnavailable")
+    assert retry.call("flaky", "operation", value=1)["value"] == 1
+    assert client.calls == 3
+    assert retry.log_metrics()["flaky.operation"] == {
+        "calls": 1,
+        "attempts": 3,
+        "throttles": 1,
+        "failures": 0,
+        "backoffTime": pytest.approx(0, abs=0.1),
+        "rateLimitTime": 0,
+    }
+
+
+def test_does_not_retry_other_errors(flaky):
+    client = flaky("AccessDeniedException")
+    with pytest.raises(ClientError):
+        retry.call("flaky", "operation")
+    assert client.calls == 1
+    assert retry.log_metrics()["flaky.operation"]["failures"] == 1
+
+
+def test_retries_listed_errors(flaky):
+    client = flaky("NoSuchEntity", "NoSuchEntity")
+    retry.call("flaky", "operation", retry_on=("NoSuchEntity",))
+    assert client.calls == 3
+
+
+def test_raises_after_deadline(flaky):
+    client = flaky(*["Throttling"] * 1000)
+    with pytest.raises(ClientError):
+        retry.call("flaky", "operation", deadline=0.05)
+    assert 1 < client.calls < 1000
+
+
+def test_token_bucket_limits_rate():
+    bucket = retry.TokenBucket(rate=100, burst=5)
+    start = time.monotonic()
+    waited = sum(bucket.acquire() for _ in range(15))
+    # The burst is free, the next 10 tokens take 0.1 seconds at 100/s
+    assert time.monotonic() - start >= 0.08
+    assert waited >= 0.08
+
+
+def test_fanout_runs_calls_concurrently():
+    start = time.monotonic()
+    assert fanout.gather(
+        lambda: time.sleep(0.2) or "shadow", lambda: time.sleep(0.2) or "record"
+    ) == ["shadow", "record"]
+    assert time.monotonic() - start < 0.35
+
+
+def test_fanout_raises_after_all_complete():
+    completed = []
+
+    def fails():
+        raise ValueError("first")
+
+    with pytest.raises(ValueError, match="first"):
+        fanout.gather(fails, lambda: time.sleep(0.1) or completed.append(True))
+    assert completed == [True]
+
+
+@pytest.fixture
+def fresh_ulids(monkeypatch):
+    """No ids made before, as the tests make ids in the past"""
+    monkeypatch.setattr(ids, "_last", (0, 0))
+
+
+def test_ulids_sort_by_time(fresh_ulids):
+    earlier = ids.ulid(now=1576000000.1234)
+    later = ids.ulid(now=1576000000.5)
+    assert ids.is_ulid(earlier) and ids.is_ulid(later)
+    assert earlier < later
+    assert ids.timestamp(earlier) == 1576000000.123
+    assert not ids.is_ulid("1234-5678")
+
+
+def test_ulids_in_the_same_millisecond_keep_their_order(fresh_ulids):
+    made = [ids.ulid(now=1576000001.0) for _ in range(1000)]
+    assert made == sorted(made)
+    assert len(set(made)) == 1000
+    assert {ids.timestamp(i) for i in made} == {1576000001.0}
+
+
+def test_metric_document(monkeypatch):
+    monkeypatch.setenv("METRIC_NAMESPACE", "cdd-test")
+    document = metrics.document(
+        "DispenseLatency", 812.5, unit="Milliseconds", now=1576000000.25, Mode="command"
+    )
+    assert document == {
+        "_aws": {
+            "Timestamp": 1576000000250,
+            "CloudWatchMetrics": [
+                {
+                    "Namespace": "cdd-test",
+                    "Dimensions": [["Mode"]],
+                    "Metrics": [{"Name": "DispenseLatency", "Unit": "Milliseconds"}],
+                }
+            ],
+        },
+        "DispenseLatency": 812.5,
+        "Mode": "command",
+    }
+
+
+def test_spans_are_published_together(capsys):
+    spans = metrics.Spans(requestId="01ARZ3NDEKTSV4RRFFQ69G5FAV")
+    with spans.time("Reservation"):
+        pass
+    spans.add("DeviceReport", 1.25)
+    spans.emit(now=1576000000, Mode="shadow")
+    document = json.loads(capsys.readouterr().out)
+    assert document["_aws"]["CloudWatchMetrics"][0]["Metrics"] == [
+        {"Name": "Reservation", "Unit": "Milliseconds"},
+        {"Name": "DeviceReport", "Unit": "Milliseconds"},
+    ]
+    assert document["_aws"]["CloudWatchMetrics"][0]["Dimensions"] == [["Mode"]]
+    assert 0 <= document["Reservation"] < 1000
+    assert document["DeviceReport"] == 1250.0
+    assert document["requestId"] == "01ARZ3NDEKTSV4RRFFQ69G5FAV"
+    assert document["Mode"] == "shadow"
+
+
+def test_retried_calls_use_single_attempt_clients(aws):
+    assert clients.unretried_client("iot").meta.config.retries["total_max_attempts"] == 1
+    assert clients.client("iot").meta.config.retries["total_max_attempts"] == 6
@@ -0,0 +1,192 @@
+"""
+Dispenser command tests against local DynamoDB and IoT stand-ins
+"""
+
+import json
+import os
+from concurrent.futures import ThreadPoolExecutor
+from decimal import Decimal
+
+import pytest
+
+from conftest import add_lambda_path
+
+pytest.importorskip("moto")
+add_lambda_path("api_command")
+import command  # noqa: E402
+from cdd_common import clients  # noqa: E402
+
+__copyright__ = (
+    "Copyright 2019 Amazon.com, Inc. or its affiliates. All Rights Reserved."
+)
+__license__ = "MIT-0"
+
+
+def api_event(dispenser_id, commands=None, set_led=None):
+    event = {
+        "requestContext": {
+            "authorizer": {"claims": {"custom:dispenserId": dispenser_id}}
+        },
+    }
+    if commands is not None:
+        event.update(
+            httpMethod="POST",
+            body=json.dumps({"commands": commands}),
+            queryStringParameters=None,
+        )
+    else:
+        event.update(httpMethod="GET", queryStringParameters={"setLed": set_led})
+    return event
+
+
+@pytest.fixture
+def dispenser(aws, thing):
+    """Dispenser 100 with $1.00 of credits and its initial shadow"""
+    thing("100")
+    clients.table(os.environ["DISPENSER_TABLE"]).put_item(
+        Item={"dispenserId": "100", "credits": Decimal("1.00"), "requests": {}}
+    )
+    clients.client("iot-data").update_thing_shadow(
+        thingName="100",
+        payload=json.dumps(
+            {
+                "state": {
+                    "desired": {
+                        "led": "off",
+                        "led_ring": {"count": 1, "color": "#006600"},
+                        "dispense_time_ms": 2000,
+                    }
+                }
+            }
+        ),
+    )
+    return "100"
+
+
+@pytest.fixture
+def shadow_updates(monkeypatch):
+    """Payloads of the shadow updates made"""
+    updates = []
+    iot_data = clients.client("iot-data")
+    update_thing_shadow = iot_data.update_thing_shadow
+
+    def counting_update(**kwargs):
+        updates.append(json.loads(kwargs["payload"]))
+        return update_thing_shadow(**kwargs)
+
+    monkeypatch.setattr(iot_data, "update_thing_shadow", counting_update)
+    return updates
+
+
+def desired(dispenser_id):
+    shadow = json.loads(
+        clients.client("iot-data").get_thing_shadow(thingName=dispenser_id)["payload"].read()
+    )
+    return shadow["state"]["desired"]
+
+
+def test_commands_are_one_shadow_update(dispenser, shadow_updates):
+    response = command.handler(
+        api_event(
+            dispenser,
+            [
+                {"command": "setLed", "value": "on"},
+                {"command": "setLedRing", "count": 4, "color": "#0000FF"},
+                {"command": "setDispenseTime", "value": 2500},
+            ],
+        ),
+        None,
+    )
+    assert response["statusCode"] == 200
+    assert len(shadow_updates) == 1
+    assert desired(dispenser) == {
+        "led": "on",
+        "led_ring": {"count": 4, "color": "#0000FF"},
+        "dispense_time_ms": 2500,
+    }
+    ring = clients.table(os.environ["DISPENSER_TABLE"]).get_item(
+        Key={"dispenserId": dispenser}
+    )["Item"]["ledRing"]
+    assert (ring["count"], ring["color"]) == (4, "#0000FF")
+
+
+def test_later_commands_win(dispenser):
+    command.handler(
+        api_event(
+            dispenser,
+            [
+                {"command": "setDispenseTime", "value": 1000},
+                {"command": "setDispenseTime", "value": 3000},
+            ],
+        ),
+        None,
+    )
+    assert desired(dispenser)["dispense_time_ms"] == 3000
+
+
+def test_set_led_query_parameter(dispenser):
+    response = command.handler(api_event(dispenser, set_led="on"), None)
+    assert response["body"] == 'Led state "on" successfully put into device shadow'
+    assert desired(dispenser)["led"] == "on"
+
+
+@pytest.mark.parametrize(
+    "commands",
+    [
+        [],
+        [{"command": "dispense"}],
+        [{"command": "setLed", "value": "blink"}],
+        [{"command": "setLed"}],
+        [{"command": "setLedRing", "count": 9, "color": "#0000FF"}],
+        [{"command": "setLedRing", "count": 2, "color": "blue"}],
+        [{"command": "setDispenseTime", "value": "2000"}],
+        [{"command": "setDispenseTime", "value": 2000, "extra": 1}],
+        # Nothing is written if any command is invalid
+        [{"command": "setLed", "value": "on"}, {"command": "setDispenseTime", "value": 0}],
+    ],
+)
+def test_invalid_commands_are_refused(dispenser, shadow_updates, commands):
+    response = command.handler(api_event(dispenser, commands), None)
+    assert response["statusCode"] == 400
+    assert shadow_updates == []
+
+
+def test_body_without_commands_is_refused(dispenser):
+    event = api_event(dispenser, [])
+    event["body"] = "not json"
+    assert command.handler(event, None)["statusCode"] == 400
+
+
+def test_concurrent_toggles_each_flip_the_led(dispenser):
+    toggle = [{"command": "setLed", "value": "toggle"}]
+    with ThreadPoolExecutor(max_workers=4) as pool:
+        responses = list(
+            pool.map(lambda i: command.handler(api_event(dispenser, toggle), None), range(4))
+        )
+    assert {response["statusCode"] for response in responses} == {200}
+    # Four flips from off
+    assert desired(dispenser)["led"] == "off"
+    assert sorted(response["body"].count('"on"') for response in responses) == [0, 0, 1, 1]
+
+
+def test_toggle_retries_on_version_conflict(dispenser, monkeypatch):
+    read_shadow = command.read_shadow
+    reads = []
+
+    def racing_read_shadow(thing):
+        shadow = read_shadow(thing)
+        if not reads:
+            # Another update lands between the read and the write
+            clients.client("iot-data").update_thing_shadow(
+                thingName=thing, payload=json.dumps({"state": {"desired": {"led": "on"}}})
+            )
+        reads.append(shadow["version"])
+        return shadow
+
+    monkeypatch.setattr(command, "read_shadow", racing_read_shadow)
+    response = command.handler(
+        api_event(dispenser, [{"command": "setLed", "value": "toggle"}]), None
+    )
+    assert response["statusCode"] == 200
+    assert len(reads) == 2
+    assert desired(dispenser)["led"] == "off"
@@ -0,0 +1,278 @@
+"""
+Peer credit tests against a local DynamoDB stand-in, including a burst of
+concurrent credits to the same dispenser
+"""
+
+import functools
+import json
+import os
+import time
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+from decimal import Decimal
+
+import pytest
+
+from conftest import add_lambda_path
+
+pytest.importorskip("moto")
+add_lambda_path("api_credit_dispenser")
+import credit_dispenser  # noqa: E402
+import rate_limit  # noqa: E402
+from cdd_common import clients, led  # noqa: E402
+
+__copyright__ = (
+    "Copyright 2019 Amazon.com, Inc. or its affiliates. All Rights Reserved."
+)
+__license__ = "MIT-0"
+
+
+def api_event(crediting_dispenser, dispenser_id):
+    return {
+        "requestContext": {
+            "authorizer": {"claims": {"custom:dispenserId": crediting_dispenser}}
+        },
+        "queryStringParameters": {"dispenserId": dispenser_id},
+    }
+
+
+def put_dispenser(dispenser_id):
+    dispenser_table().put_item(
+        Item={"dispenserId": dispenser_id, "credits": Decimal("1.00"), "requests": {}}
+    )
+
+
+@pytest.fixture
+def dispenser(aws, thing):
+    """Dispenser 100 with $1.00 of credits, and crediting dispensers 200-239"""
+    thing("100")
+    for dispenser_id in ["100"] + [str(200 + i) for i in range(40)]:
+        put_dispenser(dispenser_id)
+    return "100"
+
+
+def dispenser_table():
+    return clients.table(os.environ["DISPENSER_TABLE"])
+
+
+def credits(dispenser_id):
+    return dispenser_table().get_item(Key={"dispenserId": dispenser_id})["Item"][
+        "credits"
+    ]
+
+
+def desired_led_ring(dispenser_id):
+    shadow = json.loads(
+        clients.client("iot-data").get_thing_shadow(thingName=dispenser_id)["payload"].read()
+    )
+    return shadow["state"]["desired"]["led_ring"]
+
+
+@pytest.mark.parametrize("mode", ["atomic", "ledger"])
+def test_concurrent_credits_are_all_counted(dispenser, monkeypatch, mode):
+    monkeypatch.setenv("CREDIT_MODE", mode)
+    with ThreadPoolExecutor(max_workers=8) as pool:
+        responses = list(
+            pool.map(
+                lambda i: credit_dispenser.handler(api_event(str(200 + i), dispenser), None),
+                range(40),
+            )
+        )
+    assert {response["body"] for response in responses} == {
+        "Dispenser: 100 credited $0.25"
+    }
+    assert credits(dispenser) == Decimal("11.00")
+    assert desired_led_ring(dispenser)["count"] == 8
+    ledger = clients.table(os.environ["EVENT_TABLE"]).scan()["Items"]
+    if mode == "ledger":
+        assert len(ledger) == 40
+        assert sum(item["credit"] for item in ledger) == Decimal("10.00")
+        assert {item["fromDispenserId"] for item in ledger} == {
+            str(200 + i) for i in range(40)
+        }
+    else:
+        assert ledger == []
+
+
+@pytest.mark.parametrize("mode", ["atomic", "ledger"])
+def test_unknown_dispenser_is_not_created(dispenser, monkeypatch, mode):
+    monkeypatch.setenv("CREDIT_MODE", mode)
+    response = credit_dispenser.handler(api_event(dispenser, "999"), None)
+    assert response["body"] == "ERROR: Credit not issued, dispenser 999 does not exist"
+    assert "Item" not in dispenser_table().get_item(Key={"dispenserId": "999"})
+    assert clients.table(os.environ["EVENT_TABLE"]).scan()["Items"] == []
+
+
+def test_own_dispenser_is_refused(dispenser):
+    response = credit_dispenser.handler(api_event(dispenser, dispenser), None)
+    assert response["statusCode"] == 500
+    assert credits(dispenser) == Decimal("1.00")
+
+
+def test_ledger_entry_in_same_microsecond_is_kept(dispenser, monkeypatch):
+    monkeypatch.setenv("CREDIT_MODE", "ledger")
+    at = datetime.utcnow()
+    monkeypatch.setattr(
+        credit_dispenser.events,
+        "entry",
+        functools.partial(credit_dispenser.events.entry, at=at),
+    )
+    for crediting_dispenser in ("200", "201"):
+        credit_dispenser.handler(api_event(crediting_dispenser, dispenser), None)
+    assert credits(dispenser) == Decimal("1.50")
+    ledger = clients.table(os.environ["EVENT_TABLE"]).scan()["Items"]
+    assert sorted(item["fromDispenserId"] for item in ledger) == ["200", "201"]
+
+
+def test_burst_then_rate_limited(dispenser, monkeypatch):
+    monkeypatch.setenv("CREDIT_BURST", "3")
+    monkeypatch.setenv("CREDIT_PAIR_LIMIT", "10")
+    statuses = [
+        credit_dispenser.handler(api_event("200", dispenser), None)["statusCode"]
+        for _ in range(5)
+    ]
+    assert statuses == [200, 200, 200, 429, 429]
+    assert credits(dispenser) == Decimal("1.75")
+    response = credit_dispenser.handler(api_event("200", dispenser), None)
+    assert int(response["headers"]["Retry-After"]) >= 1
+
+
+def test_tokens_refill(dispenser):
+    limits = rate_limit.Limits(rate=0.5, burst=2, pair_limit=10, pair_window=60)
+    table = dispenser_table()
+    assert rate_limit.acquire(table, "200", "100", limits, now=1000) is None
+    assert rate_limit.acquire(table, "200", "100", limits, now=1000.5) is None
+    rejection = rate_limit.acquire(table, "200", "100", limits, now=1001)
+    assert rejection.reason == "rate"
+    assert rejection.retry_after == pytest.approx(1.0)
+    assert rate_limit.acquire(table, "200", "100", limits, now=1002) is None
+
+
+def test_pair_cooldown_is_a_sliding_window(dispenser):
+    limits = rate_limit.Limits(rate=10, burst=10, pair_limit=2, pair_window=60)
+    table = dispenser_table()
+    assert rate_limit.acquire(table, "200", "100", limits, now=1000) is None
+    assert rate_limit.acquire(table, "200", "100", limits, now=1030) is None
+    rejection = rate_limit.acquire(table, "200", "100", limits, now=1050)
+    assert rejection == ("cooldown", 10)
+    # Other targets are not affected
+    assert rate_limit.acquire(table, "200", "201", limits, now=1050) is None
+    # The first credit leaves the window
+    assert rate_limit.acquire(table, "200", "100", limits, now=1061) is None
+    assert rate_limit.acquire(table, "200", "100", limits, now=1062).reason == "cooldown"
+
+
+def test_concurrent_requests_share_one_bucket(dispenser, monkeypatch):
+    monkeypatch.setenv("CREDIT_RATE", "0.001")
+    monkeypatch.setenv("CREDIT_PAIR_LIMIT", "20")
+    with ThreadPoolExecutor(max_workers=8) as pool:
+        statuses = list(
+            pool.map(
+                lambda i: credit_dispenser.handler(api_event("200", dispenser), None)[
+                    "statusCode"
+                ],
+                range(20),
+            )
+        )
+    assert statuses.count(200) == 5
+    assert credits(dispenser) == Decimal("2.25")
+
+
+def test_rejected_before_target_is_touched(dispenser, monkeypatch):
+    monkeypatch.setenv("CREDIT_PAIR_LIMIT", "1")
+    credit_dispenser.handler(api_event("200", dispenser), None)
+    calls = []
+    monkeypatch.setattr(credit_dispenser, "credit_dispenser", lambda *args: calls.append(args))
+    response = credit_dispenser.handler(api_event("200", dispenser), None)
+    assert response["statusCode"] == 429
+    assert "too many credits to this dispenser" in response["body"]
+    assert calls == []
+
+
+def test_unknown_caller_is_refused(dispenser):
+    response = credit_dispenser.handler(api_event("999", dispenser), None)
+    assert response["statusCode"] == 403
+    assert credits(dispenser) == Decimal("1.00")
+
+
+@pytest.fixture
+def shadow_writes(monkeypatch):
+    """LED ring shadow updates made"""
+    writes = []
+    write_shadow = led.write_shadow
+
+    def counting_write_shadow(dispenser_id, desired=None, reported=None):
+        writes.append(desired)
+        write_shadow(dispenser_id, desired, reported)
+
+    monkeypatch.setattr(led, "write_shadow", counting_write_shadow)
+    return writes
+
+
+def test_unchanged_led_ring_is_not_written(dispenser, shadow_writes, monkeypatch):
+    monkeypatch.setattr(led, "LED_RING_DEBOUNCE", 0)
+    # $1.00 to $1.25 changes the ring from nothing written to 1 green
+    credit_dispenser.handler(api_event("200", dispenser), None)
+    # $1.50 and $1.75 still show 1 green
+    credit_dispenser.handler(api_event("201", dispenser), None)
+    credit_dispenser.handler(api_event("202", dispenser), None)
+    assert shadow_writes == [{"led_ring": {"count": 1, "color": "#006600"}}]
+
+
+def test_burst_is_coalesced(dispenser, shadow_writes, monkeypatch):
+    monkeypatch.setattr(led, "LED_RING_DEBOUNCE", 2)
+    with ThreadPoolExecutor(max_workers=8) as pool:
+        list(
+            pool.map(
+                lambda i: credit_dispenser.handler(api_event(str(200 + i), dispenser), None),
+                range(16),
+            )
+        )
+    assert credits(dispenser) == Decimal("5.00")
+    # The first change, then one for all those within the window
+    assert 1 <= len(shadow_writes) <= 2
+    assert desired_led_ring(dispenser) == {"count": 5, "color": "#00FF00"}
+    assert "pendingUntil" not in dispenser_table().get_item(Key={"dispenserId": dispenser})[
+        "Item"
+    ]["ledRing"]
+
+
+def test_update_within_window_waits_for_its_end(dispenser, shadow_writes, monkeypatch):
+    monkeypatch.setattr(led, "LED_RING_DEBOUNCE", 0.3)
+    credit_dispenser.handler(api_event("200", dispenser), None)
+    # $1.25 to $2.00, the last one changes the ring within the window
+    start = time.time()
+    for i in range(1, 4):
+        credit_dispenser.handler(api_event(str(200 + i), dispenser), None)
+    assert time.time() - start < 1
+    assert shadow_writes == [
+        {"led_ring": {"count": 1, "color": "#006600"}},
+        {"led_ring": {"count": 2, "color": "#009900"}},
+    ]
+    assert "pendingUntil" not in dispenser_table().get_item(Key={"dispenserId": dispenser})[
+        "Item"
+    ]["ledRing"]
+
+
+def test_flush_of_missing_dispenser(aws):
+    assert led.flush_led_ring(dispenser_table(), "999", {}) is False
+
+
+@pytest.mark.parametrize("mode", ["atomic", "ledger"])
+def test_credit_is_logged_once(dispenser, monkeypatch, mode):
+    add_lambda_path("process_events")
+    import process_events
+
+    monkeypatch.setenv("CREDIT_MODE", mode)
+    iot_data = clients.client("iot-data")
+    publish = iot_data.publish
+
+    def logging_publish(topic, payload, **kwargs):
+        # As the events/+ rule passes the message on
+        process_events.handler({**json.loads(payload), "topic": topic}, None)
+        return publish(topic=topic, payload=payload, **kwargs)
+
+    monkeypatch.setattr(iot_data, "publish", logging_publish)
+    credit_dispenser.handler(api_event("200", dispenser), None)
+    (item,) = clients.table(os.environ["EVENT_TABLE"]).scan()["Items"]
+    assert "credit from dispenser: 200" in item["log"]
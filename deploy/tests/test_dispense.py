@@ -0,0 +1,333 @@
+"""
+Dispense engine tests against a local DynamoDB stand-in, including
+concurrent requests racing for the same dispenser
+"""
+
+import json
+import os
+import time
+from concurrent.futures import ThreadPoolExecutor
+from decimal import Decimal
+
+import pytest
+from botocore.exceptions import ClientError
+
+from conftest import add_lambda_path
+
+pytest.importorskip("moto")
+add_lambda_path("api_dispense")
+import dispense  # noqa: E402
+from cdd_common import clients, events, ids, request_slots  # noqa: E402
+
+__copyright__ = (
+    "Copyright 2019 Amazon.com, Inc. or its affiliates. All Rights Reserved."
+)
+__license__ = "MIT-0"
+
+
+def api_event(dispenser_id):
+    return {
+        "requestContext": {
+            "authorizer": {"claims": {"custom:dispenserId": dispenser_id}}
+        },
+        "queryStringParameters": {"dispenserId": dispenser_id},
+    }
+
+
+def iot_event(dispenser_id, request_id, result="success"):
+    return {
+        "topic": f"$aws/things/{dispenser_id}/shadow/update/accepted",
+        "state": {
+            "reported": {"response": {"requestId": request_id, "result": result}}
+        },
+    }
+
+
+@pytest.fixture
+def dispenser(aws, thing):
+    """Dispenser 100 with $2.00 of credits and no in-flight requests"""
+    thing("100")
+    dispenser_table().put_item(
+        Item={"dispenserId": "100", "credits": Decimal("2.00"), "requests": {}}
+    )
+    return "100"
+
+
+def dispenser_table():
+    return clients.table(os.environ["DISPENSER_TABLE"])
+
+
+def event_table():
+    return clients.table(os.environ["EVENT_TABLE"])
+
+
+def record(dispenser_id):
+    return dispense.read_dispenser(dispenser_id, dispenser_table())
+
+
+def test_reserve_and_complete(dispenser):
+    response = dispense.process_api_event(
+        api_event(dispenser), dispenser_table(), event_table()
+    )
+    assert response["body"] == f"Dispenser {dispenser} requested to be activated"
+    request = request_slots.get_slot(record(dispenser), "dispense")
+    assert request is not None
+
+    dispense.process_iot_event(
+        iot_event(dispenser, request.request_id),
+        dispenser_table(),
+        event_table(),
+    )
+    completed = record(dispenser)
+    assert completed.pop("ledRing")["count"] == 1
+    assert completed == {
+        "dispenserId": dispenser,
+        "credits": Decimal("1.00"),
+        "requests": {},
+    }
+
+
+def test_failure_does_not_deduct(dispenser):
+    dispense.process_api_event(
+        api_event(dispenser), dispenser_table(), event_table()
+    )
+    request = request_slots.get_slot(record(dispenser), "dispense")
+    dispense.process_iot_event(
+        iot_event(dispenser, request.request_id, result="failure"),
+        dispenser_table(),
+        event_table(),
+    )
+    assert record(dispenser)["credits"] == Decimal("2.00")
+    assert record(dispenser)["requests"] == {}
+
+
+def test_mismatched_response_clears_request(dispenser):
+    dispense.process_api_event(
+        api_event(dispenser), dispenser_table(), event_table()
+    )
+    dispense.process_iot_event(
+        iot_event(dispenser, "0000-0000"),
+        dispenser_table(),
+        event_table(),
+    )
+    assert record(dispenser)["credits"] == Decimal("2.00")
+    assert record(dispenser)["requests"] == {}
+
+
+def test_insufficient_credits(dispenser):
+    dispenser_table().update_item(
+        Key={"dispenserId": dispenser},
+        UpdateExpression="SET credits = :c",
+        ExpressionAttributeValues={":c": Decimal("0.75")},
+    )
+    response = dispense.process_api_event(
+        api_event(dispenser), dispenser_table(), event_table()
+    )
+    assert "at least $1.00 required" in response["body"]
+    assert record(dispenser)["requests"] == {}
+
+
+@pytest.mark.parametrize("slot", [None, "current"])
+def test_rejection_is_one_round_trip(dispenser, monkeypatch, slot):
+    table = dispenser_table()
+    if slot is None:
+        table.update_item(
+            Key={"dispenserId": dispenser},
+            UpdateExpression="SET credits = :credits",
+            ExpressionAttributeValues={":credits": Decimal("0.50")},
+        )
+    else:
+        dispense.reserve_dispense(dispenser, ids.ulid(), table)
+    calls = []
+    for name in ("get_item", "update_item"):
+        monkeypatch.setattr(
+            table,
+            name,
+            lambda method=getattr(table, name), **kwargs: calls.append(method) or method(**kwargs),
+        )
+    slot, dispenser_record = dispense.reserve_dispense(dispenser, ids.ulid(), table)
+    assert slot is None
+    assert len(calls) == 1
+    assert dispenser_record == record(dispenser)
+
+
+def test_unknown_dispenser(aws):
+    response = dispense.process_api_event(
+        api_event("999"), dispenser_table(), event_table()
+    )
+    assert response["body"] == "ERROR: Dispenser 999 does not exist"
+
+
+def test_stale_request_is_replaced(dispenser):
+    stale = request_slots.RequestSlot.new(
+        "1111-1111", "dispense", now=time.time() - dispense.REQUEST_TIMEOUT - 1
+    )
+    dispenser_table().update_item(
+        Key={"dispenserId": dispenser},
+        UpdateExpression="SET requests.dispense = :r",
+        ExpressionAttributeValues={":r": stale.to_item()},
+    )
+    response = dispense.process_api_event(
+        api_event(dispenser), dispenser_table(), event_table()
+    )
+    assert response["body"] == f"Dispenser {dispenser} requested to be activated"
+    assert request_slots.get_slot(record(dispenser), "dispense").request_id != "1111-1111"
+
+
+@pytest.mark.parametrize("legacy", [None, [], ["stale"], ["current"]])
+def test_legacy_request_list_is_migrated(dispenser, legacy):
+    now = time.time()
+    item = {"dispenserId": dispenser, "credits": Decimal("2.00")}
+    if legacy is not None:
+        item["requests"] = [
+            f"2222-2222|dispense|{now - 60 if r == 'stale' else now}|dispenser"
+            for r in legacy
+        ]
+    dispenser_table().put_item(Item=item)
+
+    response = dispense.process_api_event(
+        api_event(dispenser), dispenser_table(), event_table()
+    )
+    slot = request_slots.get_slot(record(dispenser), "dispense")
+    assert isinstance(record(dispenser)["requests"], dict)
+    if legacy == ["current"]:
+        assert "already in progress" in response["body"]
+        assert slot.request_id == "2222-2222"
+    else:
+        assert response["body"] == f"Dispenser {dispenser} requested to be activated"
+        assert slot.request_id != "2222-2222"
+
+
+def test_slot_lookup_from_legacy_list():
+    slot = request_slots.get_slot(
+        {"requests": ["1-1|dispense|10.0|dispenser", "2-2|dispense|20.0|dispenser"]},
+        "dispense",
+    )
+    assert slot.request_id == "2-2"
+    assert slot.expires_at == 20.0 + request_slots.COMMAND_TTL["dispense"]
+
+
+def test_concurrent_requests_reserve_once(dispenser):
+    with ThreadPoolExecutor(max_workers=16) as executor:
+        responses = list(
+            executor.map(
+                lambda _: dispense.process_api_event(
+                    api_event(dispenser), dispenser_table(), event_table()
+                ),
+                range(32),
+            )
+        )
+    activated = [r for r in responses if "requested to be activated" in r["body"]]
+    assert len(activated) == 1
+    assert list(record(dispenser)["requests"]) == ["dispense"]
+
+
+def test_concurrent_completions_deduct_once(dispenser):
+    dispense.process_api_event(
+        api_event(dispenser), dispenser_table(), event_table()
+    )
+    request = request_slots.get_slot(record(dispenser), "dispense")
+    event = iot_event(dispenser, request.request_id)
+    with ThreadPoolExecutor(max_workers=8) as executor:
+        list(
+            executor.map(
+                lambda _: dispense.process_iot_event(
+                    json.loads(json.dumps(event)),
+                    dispenser_table(),
+                    event_table(),
+                ),
+                range(8),
+            )
+        )
+    assert record(dispenser)["credits"] == Decimal("1.00")
+
+
+def test_request_is_correlated_by_id(dispenser):
+    dispense.process_api_event(api_event(dispenser), dispenser_table(), event_table())
+    request = request_slots.get_slot(record(dispenser), "dispense")
+    assert ids.is_ulid(request.request_id)
+    shadow = json.loads(
+        clients.client("iot-data").get_thing_shadow(thingName=dispenser)["payload"].read()
+    )
+    assert shadow["state"]["desired"]["request"]["requestId"] == request.request_id
+    dispense.process_iot_event(
+        iot_event(dispenser, request.request_id, result="failure"),
+        dispenser_table(),
+        event_table(),
+    )
+    logs = [item["log"] for item in events.for_request(request.request_id)]
+    assert len(logs) == 2
+    assert "initiated" in logs[0] and "dispenser reported failure" in logs[1]
+
+
+def command_response(dispenser_id, request_id, result="success"):
+    return {
+        "topic": f"cmd/{dispenser_id}/response",
+        "command": "dispense",
+        "requestId": request_id,
+        "result": result,
+    }
+
+
+def test_command_mode_dispense(dispenser, monkeypatch, capsys):
+    monkeypatch.setenv("DISPENSE_MODE", "command")
+    dispense.process_api_event(api_event(dispenser), dispenser_table(), event_table())
+    request = request_slots.get_slot(record(dispenser), "dispense")
+    # Sent on the command topic, the shadow is not written
+    with pytest.raises(ClientError):
+        clients.client("iot-data").get_thing_shadow(thingName=dispenser)
+
+    dispense.process_iot_event(
+        command_response(dispenser, request.request_id), dispenser_table(), event_table()
+    )
+    assert record(dispenser)["credits"] == Decimal("1.00")
+    assert record(dispenser)["requests"] == {}
+    metric = [
+        json.loads(line)
+        for line in capsys.readouterr().out.splitlines()
+        if "DispenseLatency" in line
+    ]
+    assert len(metric) == 1
+    assert metric[0]["Mode"] == "command"
+    assert metric[0]["_aws"]["CloudWatchMetrics"][0]["Dimensions"] == [["Mode"]]
+
+
+def test_command_mode_failure_does_not_deduct(dispenser, monkeypatch):
+    monkeypatch.setenv("DISPENSE_MODE", "command")
+    dispense.process_api_event(api_event(dispenser), dispenser_table(), event_table())
+    request = request_slots.get_slot(record(dispenser), "dispense")
+    dispense.process_iot_event(
+        command_response(dispenser, request.request_id, result="failure"),
+        dispenser_table(),
+        event_table(),
+    )
+    assert record(dispenser)["credits"] == Decimal("2.00")
+    assert record(dispenser)["requests"] == {}
+
+
+def test_dispense_stages_are_timed(dispenser, capsys):
+    event = api_event(dispenser)
+    event["requestContext"]["requestTimeEpoch"] = int(time.time() * 1000) - 20
+    dispense.process_api_event(event, dispenser_table(), event_table())
+    request = request_slots.get_slot(record(dispenser), "dispense")
+    assert "sentAt" not in record(dispenser)["requests"]["dispense"]
+    response = iot_event(dispenser, request.request_id)
+    response["receivedAt"] = int(time.time() * 1000)
+    dispense.process_iot_event(response, dispenser_table(), event_table())
+
+    documents = [
+        json.loads(line)
+        for line in capsys.readouterr().out.splitlines()
+        if line.startswith('{"_aws"')
+    ]
+    assert len(documents) == 2
+    api, iot = documents
+    assert {"ApiReceive", "Reservation", "RequestSend", "ApiHandler"} <= set(api)
+    assert {"RuleDelivery", "Reconciliation", "Completion", "DispenseLatency"} <= set(iot)
+    assert api["ApiReceive"] >= 20
+    # DeviceReport is between the records, from the send to the receipt
+    assert request.timestamp * 1000 < api["sentAt"] <= time.time() * 1000
+    assert iot["receivedAt"] == response["receivedAt"]
+    assert "DeviceReport" not in iot
+    assert api["requestId"] == iot["requestId"] == request.request_id
+    assert api["Mode"] == iot["Mode"] == "shadow"
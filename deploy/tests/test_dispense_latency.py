@@ -0,0 +1,81 @@
+"""
+Tests of the dispense stage summary script, dispense_latency.py
+"""
+
+import json
+import sys
+
+import conftest
+
+sys.path.insert(0, str(conftest.DEPLOY_DIR))
+import dispense_latency  # noqa: E402
+
+__copyright__ = (
+    "Copyright 2019 Amazon.com, Inc. or its affiliates. All Rights Reserved."
+)
+__license__ = "MIT-0"
+
+
+def record(request_id, mode="shadow", marks=None, **durations):
+    return {
+        "_aws": {
+            "Timestamp": 1576000000000,
+            "CloudWatchMetrics": [
+                {
+                    "Namespace": "cdd-test",
+                    "Dimensions": [["Mode"]],
+                    "Metrics": [
+                        {"Name": name, "Unit": "Milliseconds"} for name in durations
+                    ],
+                }
+            ],
+        },
+        "requestId": request_id,
+        "Mode": mode,
+        **(marks or {}),
+        **durations,
+    }
+
+
+def test_percentile_is_nearest_rank():
+    values = list(range(1, 101))
+    assert dispense_latency.percentile(values, 50) == 50
+    assert dispense_latency.percentile(values, 99) == 99
+    assert dispense_latency.percentile(values, 100) == 100
+    assert dispense_latency.percentile([7], 90) == 7
+
+
+def test_records_from_exported_lines():
+    lines = [
+        f"2019-12-10T17:46:40.000Z {json.dumps(record('a', Reservation=12.5))}",
+        "START RequestId: 1b4f Version: $LATEST",
+        "Params: {'dispenserId': '100'}, dispenser: 100",
+        json.dumps(record("a", DeviceReport=900.0)),
+    ]
+    assert [r["requestId"] for r in dispense_latency.records(lines)] == ["a", "a"]
+
+
+def test_messages_of_filter_log_events_output():
+    text = json.dumps({"events": [{"message": json.dumps(record("a", Completion=3.0))}]})
+    assert len(list(dispense_latency.records(dispense_latency.messages(text)))) == 1
+
+
+def test_summary_and_requests():
+    all_records = [
+        record("a", Reservation=10.0, marks={"sentAt": 1576000000020.0}),
+        record("a", DispenseLatency=1000.0, marks={"receivedAt": 1576000000920.0}),
+        record("b", Reservation=30.0, marks={"sentAt": 1576000000040.0}),
+        record("b", DispenseLatency=3200.0, marks={"receivedAt": 1576000003040.0}),
+        record("c", mode="command", DispenseLatency=400.0, marks={"sentAt": 1576000000000.0}),
+    ]
+    durations = dispense_latency.summarise(all_records)
+    assert durations["shadow"]["Reservation"] == [10.0, 30.0]
+    # Between the records, not known for c without its response's record
+    assert durations["shadow"]["DeviceReport"] == [900.0, 3000.0]
+    assert "DeviceReport" not in durations["command"]
+    assert durations["command"]["DispenseLatency"] == [400.0]
+    requests = dispense_latency.by_request(all_records)
+    assert requests["b"] == {"Reservation": 30.0, "DeviceReport": 3000.0, "DispenseLatency": 3200.0}
+    assert dispense_latency.stage_order(requests["b"]) == [
+        "Reservation", "DeviceReport", "DispenseLatency"
+    ]
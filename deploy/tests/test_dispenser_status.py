@@ -0,0 +1,122 @@
+"""
+Dispenser status projection tests against local DynamoDB and IoT stand-ins
+"""
+
+import json
+import os
+import time
+from decimal import Decimal
+
+import pytest
+
+from conftest import add_lambda_path
+
+pytest.importorskip("moto")
+add_lambda_path("api_dispenser_status")
+add_lambda_path("process_events")
+import dispenser_status  # noqa: E402
+import process_events  # noqa: E402
+from cdd_common import clients, status  # noqa: E402
+
+__copyright__ = (
+    "Copyright 2019 Amazon.com, Inc. or its affiliates. All Rights Reserved."
+)
+__license__ = "MIT-0"
+
+
+def api_event(dispenser_id):
+    return {
+        "requestContext": {
+            "authorizer": {"claims": {"custom:dispenserId": dispenser_id}}
+        },
+        "queryStringParameters": None,
+    }
+
+
+def documents(dispenser_id, version, led, count):
+    reported = {"led": led, "led_ring": {"count": count, "color": "#006600"}}
+    return {
+        "topic": f"$aws/things/{dispenser_id}/shadow/update/documents",
+        "previous": {"state": {"reported": {}}, "version": version - 1},
+        "current": {"state": {"reported": reported}, "version": version},
+    }
+
+
+@pytest.fixture
+def dispenser(aws, thing):
+    """Dispenser 100 with $2.00 of credits and a shadow reporting LED on"""
+    thing("100")
+    clients.table(os.environ["DISPENSER_TABLE"]).put_item(
+        Item={"dispenserId": "100", "credits": Decimal("2.00"), "requests": {}}
+    )
+    clients.client("iot-data").update_thing_shadow(
+        thingName="100",
+        payload=json.dumps(
+            {"state": {"reported": {"led": "on", "led_ring": {"count": 2, "color": "#009900"}}}}
+        ),
+    )
+    return "100"
+
+
+@pytest.fixture
+def live_reads(monkeypatch):
+    reads = []
+    live = status.live
+
+    def counting_live(dispenser_id):
+        reads.append(dispenser_id)
+        return live(dispenser_id)
+
+    monkeypatch.setattr(status, "live", counting_live)
+    return reads
+
+
+def get_status(dispenser_id):
+    response = dispenser_status.handler(api_event(dispenser_id), None)
+    try:
+        return json.loads(response["body"])
+    except ValueError:
+        return response["body"]
+
+
+def test_status_from_projection(dispenser, live_reads):
+    process_events.handler(documents(dispenser, 5, "off", 1), None)
+    assert get_status(dispenser) == {
+        "credits": 2.0,
+        "led_state": "off",
+        "led_ring_state": {"count": 1, "color": "#006600"},
+    }
+    assert live_reads == []
+
+
+def test_older_documents_are_ignored(dispenser, stream):
+    event = stream(
+        [
+            documents(dispenser, 7, "on", 3),
+            documents(dispenser, 6, "off", 1),
+        ]
+    )
+    assert process_events.handler(event, None)["statuses"] == 1
+    process_events.handler(documents(dispenser, 5, "off", 0), None)
+    assert get_status(dispenser)["led_ring_state"]["count"] == 3
+
+
+def test_missing_projection_reads_live_shadow(dispenser, live_reads):
+    assert get_status(dispenser)["led_ring_state"] == {"count": 2, "color": "#009900"}
+    assert get_status(dispenser)["led_state"] == "on"
+    # The projection is written from the live shadow on the first read
+    assert live_reads == [dispenser]
+
+
+def test_stale_projection_reads_live_shadow(dispenser, live_reads, monkeypatch):
+    monkeypatch.setenv("STATUS_MAX_AGE", "60")
+    status.update(
+        dispenser, status.projection({"reported": {"led": "off"}}, 1, at=time.time() - 120)
+    )
+    assert get_status(dispenser)["led_state"] == "on"
+    assert live_reads == [dispenser]
+
+
+def test_unknown_dispenser(aws):
+    assert get_status("999") == "ERROR: Dispenser 999 does not exist"
+    assert status.update("999", status.projection({}, 1)) is False
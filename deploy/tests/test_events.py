@@ -0,0 +1,88 @@
+"""
+Event log schema, writer and readers against a local DynamoDB stand-in
+"""
+
+import time
+from datetime import datetime, timedelta
+from decimal import Decimal
+
+import pytest
+
+pytest.importorskip("moto")
+from cdd_common import events  # noqa: E402
+
+__copyright__ = (
+    "Copyright 2019 Amazon.com, Inc. or its affiliates. All Rights Reserved."
+)
+__license__ = "MIT-0"
+
+AT = datetime(2019, 12, 10, 17, 46, 40, 123456)
+
+
+def test_entry_keys():
+    item = events.entry("105", "MQTT: Dispense complete", AT)
+    assert item["pk"] == "105"
+    assert item["ts"] == Decimal("1576000000.123456")
+    assert item["timestamp"] == "2019-12-10T17:46:40.123456Z"
+    assert events.iso_timestamp(item["ts"]) == item["timestamp"]
+    assert item["timeBucket"].startswith("2019-12-10#")
+    assert item["expiresAt"] == pytest.approx(time.time() + 30 * 86400, abs=5)
+
+
+def test_ttl_and_day_buckets_from_environment(monkeypatch):
+    monkeypatch.setenv("EVENT_TTL_DAYS", "7")
+    monkeypatch.setenv("EVENT_DAY_BUCKETS", "105,106")
+    item = events.entry("105", "log", AT)
+    assert item["pk"] == "105#2019-12-10"
+    assert item["expiresAt"] == pytest.approx(time.time() + 7 * 86400, abs=5)
+    assert events.entry("107", "log", AT)["pk"] == "107"
+
+
+def test_same_microsecond_entries_are_unique():
+    entries = events.unique_entries([events.entry("105", str(i), AT) for i in range(3)])
+    assert [item["timestamp"][-7:] for item in entries] == [
+        "123456Z",
+        "123457Z",
+        "123458Z",
+    ]
+
+
+def test_latest_is_newest_first(aws):
+    now = datetime.utcnow()
+    for i in range(5):
+        events.put("105", f"event {i}", now - timedelta(seconds=5 - i))
+    events.put("106", "other dispenser", now)
+    assert [item["log"] for item in events.latest("105", limit=3)] == [
+        "event 4",
+        "event 3",
+        "event 2",
+    ]
+
+
+def test_latest_reads_back_day_buckets(aws, monkeypatch):
+    monkeypatch.setenv("EVENT_DAY_BUCKETS", "*")
+    now = datetime.utcnow()
+    events.put_entries(
+        [events.entry("105", f"{days} days ago", now - timedelta(days=days)) for days in range(4)]
+    )
+    assert [item["log"] for item in events.latest("105", limit=3)] == [
+        "0 days ago",
+        "1 days ago",
+        "2 days ago",
+    ]
+    assert len(events.latest("105", limit=10, days=2)) == 2
+
+
+def test_latest_all_merges_shards(aws):
+    entries = [
+        events.entry(str(100 + i), f"event {i}", AT + timedelta(seconds=i)) for i in range(12)
+    ]
+    assert len({item["timeBucket"] for item in entries}) > 1
+    events.put_entries(entries)
+    events.put("100", "next day", AT + timedelta(days=1))
+    assert [item["log"] for item in events.latest_all(limit=4, at=AT)] == [
+        "event 11",
+        "event 10",
+        "event 9",
+        "event 8",
+    ]
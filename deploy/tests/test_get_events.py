@@ -0,0 +1,177 @@
+"""
+Event history API tests against a local DynamoDB stand-in
+"""
+
+import json
+from datetime import datetime, timedelta
+
+import pytest
+
+from conftest import add_lambda_path
+
+pytest.importorskip("moto")
+add_lambda_path("api_get_events")
+import get_events  # noqa: E402
+from cdd_common import events  # noqa: E402
+
+__copyright__ = (
+    "Copyright 2019 Amazon.com, Inc. or its affiliates. All Rights Reserved."
+)
+__license__ = "MIT-0"
+
+NOW = datetime.utcnow().replace(microsecond=0)
+
+
+def api_event(dispenser_id="100", group="user", **params):
+    claims = {"custom:group": group}
+    if dispenser_id is not None:
+        claims["custom:dispenserId"] = dispenser_id
+    return {
+        "requestContext": {"authorizer": {"claims": claims}},
+        "queryStringParameters": params or None,
+    }
+
+
+def get(*args, **kwargs):
+    response = get_events.handler(api_event(*args, **kwargs), None)
+    if response["statusCode"] != 200:
+        return response["statusCode"]
+    return json.loads(response["body"])
+
+
+def pages(*args, **params):
+    """All pages of events, as lists of logs"""
+    result = []
+    while True:
+        body = get(*args, **params)
+        result.append([item["log"] for item in body["events"]])
+        if not body["next"]:
+            return result
+        params["next"] = body["next"]
+
+
+@pytest.fixture
+def logged(aws):
+    """Events 0-9 of dispensers 100 and 101, one a minute up to now"""
+    events.put_entries(
+        [
+            events.entry(dispenser_id, f"{dispenser_id} event {i}", NOW - timedelta(minutes=9 - i))
+            for i in range(10)
+            for dispenser_id in ("100", "101")
+        ]
+    )
+
+
+def test_pages_follow_tokens(logged):
+    assert pages(limit="4") == [
+        ["100 event 9", "100 event 8", "100 event 7", "100 event 6"],
+        ["100 event 5", "100 event 4", "100 event 3", "100 event 2"],
+        ["100 event 1", "100 event 0"],
+    ]
+    (item,) = get(limit="1")["events"]
+    assert set(item) == {"dispenserId", "timestamp", "log"}
+
+
+def test_time_range(logged):
+    params = {
+        "from": (NOW - timedelta(minutes=5)).isoformat() + "Z",
+        "to": (NOW - timedelta(minutes=2)).isoformat() + "Z",
+    }
+    assert pages(limit="3", **params) == [
+        ["100 event 7", "100 event 6", "100 event 5"],
+        ["100 event 4"],
+    ]
+
+
+def test_time_range_with_offset(logged):
+    params = {
+        "from": (NOW - timedelta(minutes=5)).isoformat() + "+00:00",
+        "to": (NOW - timedelta(minutes=2) + timedelta(hours=1)).isoformat() + "+01:00",
+    }
+    assert pages(limit="3", **params) == [
+        ["100 event 7", "100 event 6", "100 event 5"],
+        ["100 event 4"],
+    ]
+
+
+def test_day_bucketed_dispenser(aws, monkeypatch):
+    monkeypatch.setenv("EVENT_DAY_BUCKETS", "100")
+    events.put_entries(
+        [events.entry("100", f"{days} days ago", NOW - timedelta(days=days)) for days in range(5)]
+    )
+    assert pages(limit="2") == [
+        ["0 days ago", "1 days ago"],
+        ["2 days ago", "3 days ago"],
+        ["4 days ago"],
+    ]
+
+
+def test_admin_reads_all_dispensers(logged):
+    # Pages of 3 split events logged in the same second, ordered by dispenser
+    logs = sum(pages(group="admin", dispenserId="all", limit="3"), [])
+    assert logs == [
+        f"{dispenser_id} event {i}" for i in range(9, -1, -1) for dispenser_id in ("101", "100")
+    ]
+    assert get(group="admin", dispenserId="101", limit="1")["events"][0]["log"] == "101 event 9"
+
+
+def test_admin_without_dispenser(logged):
+    # As created by cr_create_admin_user, with no custom:dispenserId claim
+    assert len(get(None, group="admin", dispenserId="all")["events"]) == 20
+    assert get(None, group="admin", dispenserId="101", limit="1")["events"][0]["log"] == (
+        "101 event 9"
+    )
+    assert get(None, group="admin") == 400
+
+
+def test_page_reads_are_bounded(logged, monkeypatch):
+    table = events.table()
+    read = []
+    query = table.query
+
+    def counting_query(**kwargs):
+        response = query(**kwargs)
+        read.append(len(response["Items"]))
+        return response
+
+    monkeypatch.setattr(events, "table", lambda: table)
+    monkeypatch.setattr(table, "query", counting_query)
+    body = get(limit="3")
+    get(limit="3", next=body["next"])
+    assert sum(read) == 6
+
+
+def test_other_dispenser_is_forbidden(logged):
+    assert get(dispenserId="101") == 403
+    assert get(dispenserId="all") == 403
+
+
+def test_bad_parameters(logged):
+    assert get(limit="0") == 400
+    assert get(limit="500") == 400
+    assert get(next="not a token") == 400
+    assert get(**{"from": "yesterday"}) == 400
+
+
+def test_events_of_a_request(logged):
+    events.put_entries(
+        [
+            events.entry("100", "request event 1", NOW, requestId="01ARZ3NDEKTSV4RRFFQ69G5FAV"),
+            events.entry("100", "request event 2", NOW, requestId="01ARZ3NDEKTSV4RRFFQ69G5FAV"),
+        ]
+    )
+    body = get(requestId="01ARZ3NDEKTSV4RRFFQ69G5FAV")
+    assert [item["log"] for item in body["events"]] == ["request event 1", "request event 2"]
+    assert body["events"][0]["requestId"] == "01ARZ3NDEKTSV4RRFFQ69G5FAV"
+    # Only the caller's own requests
+    assert get("101", requestId="01ARZ3NDEKTSV4RRFFQ69G5FAV")["events"] == []
+
+
+def test_admin_pages_through_all_dispensers(logged):
+    for limit in range(1, 8):
+        logs = sum(pages(group="admin", dispenserId="all", limit=str(limit)), [])
+        assert logs == [
+            f"{dispenser_id} event {i}"
+            for i in range(9, -1, -1)
+            for dispenser_id in ("101", "100")
+        ], limit
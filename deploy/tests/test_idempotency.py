@@ -0,0 +1,136 @@
+"""
+Idempotency-Key tests of the dispense and credit APIs against local AWS
+stand-ins
+"""
+
+import os
+import time
+from decimal import Decimal
+
+import pytest
+
+from conftest import add_lambda_path
+
+pytest.importorskip("moto")
+add_lambda_path("api_dispense")
+add_lambda_path("api_credit_dispenser")
+import credit_dispenser  # noqa: E402
+import dispense  # noqa: E402
+from cdd_common import clients, idempotency, request_slots  # noqa: E402
+
+__copyright__ = (
+    "Copyright 2019 Amazon.com, Inc. or its affiliates. All Rights Reserved."
+)
+__license__ = "MIT-0"
+
+
+def api_event(caller, dispenser_id, key=None):
+    event = {
+        "requestContext": {"authorizer": {"claims": {"custom:dispenserId": caller}}},
+        "queryStringParameters": {"dispenserId": dispenser_id},
+        "headers": {"Accept": "*/*"},
+    }
+    if key is not None:
+        event["headers"]["Idempotency-Key"] = key
+    return event
+
+
+def dispenser_table():
+    return clients.table(os.environ["DISPENSER_TABLE"])
+
+
+def record(dispenser_id):
+    return dispenser_table().get_item(Key={"dispenserId": dispenser_id})["Item"]
+
+
+@pytest.fixture
+def dispensers(aws, thing):
+    """Dispensers 100 and 200 with $2.00 of credits"""
+    for dispenser_id in ("100", "200"):
+        thing(dispenser_id)
+        dispenser_table().put_item(
+            Item={"dispenserId": dispenser_id, "credits": Decimal("2.00"), "requests": {}}
+        )
+
+
+def test_credit_retries_credit_once(dispensers):
+    first = credit_dispenser.handler(api_event("200", "100", "key-1"), None)
+    retry = credit_dispenser.handler(api_event("200", "100", "key-1"), None)
+    assert record("100")["credits"] == Decimal("2.25")
+    assert retry["body"] == first["body"] == "Dispenser: 100 credited $0.25"
+    assert retry["headers"]["Idempotent-Replayed"] == "true"
+    assert "Idempotent-Replayed" not in first["headers"]
+    # Another key, or none, is another credit
+    credit_dispenser.handler(api_event("200", "100", "key-2"), None)
+    credit_dispenser.handler(api_event("200", "100"), None)
+    assert record("100")["credits"] == Decimal("2.75")
+
+
+def test_dispense_retries_keep_the_request(dispensers):
+    first = dispense.handler(api_event("100", "100", "key-1"), None)
+    request = request_slots.get_slot(record("100"), "dispense")
+    retry = dispense.handler(api_event("100", "100", "key-1"), None)
+    assert retry["body"] == first["body"] == "Dispenser 100 requested to be activated"
+    assert request_slots.get_slot(record("100"), "dispense") == request
+
+
+def test_keys_are_per_caller_and_api(dispensers):
+    credit_dispenser.handler(api_event("200", "100", "key-1"), None)
+    credit_dispenser.handler(api_event("100", "200", "key-1"), None)
+    dispense.handler(api_event("100", "100", "key-1"), None)
+    assert record("100")["credits"] == Decimal("2.25")
+    assert record("200")["credits"] == Decimal("2.25")
+    assert request_slots.get_slot(record("100"), "dispense") is not None
+
+
+def test_key_reused_for_other_request(dispensers):
+    credit_dispenser.handler(api_event("200", "100", "key-1"), None)
+    response = credit_dispenser.handler(api_event("200", "999", "key-1"), None)
+    assert response["statusCode"] == 422
+
+
+def test_retry_while_in_progress(dispensers):
+    event = api_event("200", "100", "key-1")
+    assert idempotency.claim("200#credit#key-1", idempotency.fingerprint(event), time.time()) is None
+    response = credit_dispenser.handler(event, None)
+    assert response["statusCode"] == 409
+    assert record("100")["credits"] == Decimal("2.00")
+
+
+def test_abandoned_and_expired_keys_are_reclaimed(dispensers):
+    abandoned = time.time()
+    assert idempotency.claim("key", "a", abandoned) is None
+    now = abandoned + idempotency.IN_PROGRESS_TIMEOUT + 1
+    assert idempotency.claim("key", "a", now) is None
+    idempotency.complete("key", {"statusCode": 200, "body": "done"})
+    assert idempotency.claim("key", "a", now + idempotency.ttl() - 1)["status"] == "completed"
+    assert idempotency.claim("key", "a", now + idempotency.ttl() + 1) is None
+
+
+def test_rate_limited_response_is_not_kept(dispensers, monkeypatch):
+    monkeypatch.setenv("CREDIT_BURST", "1")
+    monkeypatch.setenv("CREDIT_RATE", "0.001")
+    credit_dispenser.handler(api_event("200", "100"), None)
+    assert credit_dispenser.handler(api_event("200", "100", "key-1"), None)["statusCode"] == 429
+    # Tokens refilled when retried
+    monkeypatch.setenv("CREDIT_RATE", "1000")
+    assert credit_dispenser.handler(api_event("200", "100", "key-1"), None)["statusCode"] == 200
+    assert record("100")["credits"] == Decimal("2.50")
+
+
+def test_failed_request_releases_key(dispensers, monkeypatch):
+    def fail(**kwargs):
+        raise RuntimeError("lost connection")
+
+    monkeypatch.setattr(credit_dispenser, "credit_dispenser", fail)
+    with pytest.raises(RuntimeError):
+        credit_dispenser.handler(api_event("200", "100", "key-1"), None)
+    monkeypatch.undo()
+    response = credit_dispenser.handler(api_event("200", "100", "key-1"), None)
+    assert response["statusCode"] == 200
+    assert record("100")["credits"] == Decimal("2.25")
+
+
+def test_invalid_key(dispensers):
+    response = credit_dispenser.handler(api_event("200", "100", "x" * 256), None)
+    assert response["statusCode"] == 400
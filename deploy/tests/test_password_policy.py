@@ -0,0 +1,88 @@
+"""
+Workshop password policy custom resource and provisioning modes against
+local stand-ins
+"""
+
+import boto3
+import pytest
+
+from conftest import add_lambda_path
+
+pytest.importorskip("moto")
+pytest.importorskip("cryptography")
+add_lambda_path("cr_password_policy")
+add_lambda_path("api_get_resources")
+import index as cr_password_policy  # noqa: E402
+import create_resources  # noqa: E402
+from cdd_common import password_policy, retry  # noqa: E402
+
+__copyright__ = (
+    "Copyright 2019 Amazon.com, Inc. or its affiliates. All Rights Reserved."
+)
+__license__ = "MIT-0"
+
+ACCOUNT_POLICY = {"MinimumPasswordLength": 14, "RequireSymbols": True}
+
+
+class Responses(list):
+    """cfnresponse.send() stand-in, records (status, physical id)"""
+
+    def send(self, event, context, status, data, physical_id=None):
+        self.append((status, physical_id))
+
+
+@pytest.fixture
+def responses(monkeypatch):
+    responses = Responses()
+    monkeypatch.setattr(cr_password_policy.cfnresponse, "send", responses.send)
+    return responses
+
+
+def request(request_type, physical_id=None):
+    event = {"RequestType": request_type, "ResourceProperties": {}}
+    if physical_id:
+        event["PhysicalResourceId"] = physical_id
+    cr_password_policy.main(event, None)
+
+
+def account_policy():
+    policy = password_policy.get_policy()
+    return policy and {key: policy[key] for key in ACCOUNT_POLICY}
+
+
+def test_policy_applied_for_life_of_stack(aws, unlimited_rate, responses):
+    boto3.client("iam").update_account_password_policy(**ACCOUNT_POLICY)
+    request("Create")
+    (status, physical_id), = responses
+    assert status == "SUCCESS"
+    assert password_policy.get_policy()["MinimumPasswordLength"] == 6
+
+    request("Update", physical_id)
+    assert responses[-1] == ("SUCCESS", physical_id)
+    request("Delete", physical_id)
+    assert responses[-1] == ("SUCCESS", physical_id)
+    assert account_policy() == ACCOUNT_POLICY
+
+
+def test_no_account_policy_is_restored(aws, unlimited_rate, responses):
+    request("Create")
+    assert password_policy.get_policy()["MinimumPasswordLength"] == 6
+    request("Delete", responses[-1][1])
+    assert password_policy.get_policy() is None
+
+
+def test_stack_mode_leaves_policy_alone(workshop, monkeypatch):
+    monkeypatch.setenv("PASSWORD_POLICY_MODE", "stack")
+    retry.log_metrics()
+    create_resources.iam_user("user1", "test-UserGroup")
+    assert [name for name in retry.log_metrics() if name.startswith("iam.")] == [
+        "iam.add_user_to_group",
+        "iam.create_login_profile",
+        "iam.create_user",
+    ]
+
+
+def test_per_user_mode_restores_policy(workshop):
+    boto3.client("iam").update_account_password_policy(**ACCOUNT_POLICY)
+    create_resources.iam_user("user1", "test-UserGroup")
+    assert account_policy() == ACCOUNT_POLICY
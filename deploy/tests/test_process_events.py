@@ -0,0 +1,191 @@
+"""
+Event ingestion tests, direct and batched from a Kinesis stream, against
+local stand-ins for DynamoDB and Kinesis, and the shadow diff. See
+bench_compare_shadow.py for the diff benchmark.
+"""
+
+import base64
+import os
+
+import boto3
+import pytest
+
+from conftest import add_lambda_path
+
+pytest.importorskip("moto")
+add_lambda_path("process_events")
+import process_events  # noqa: E402
+from cdd_common import batch, clients  # noqa: E402
+
+__copyright__ = (
+    "Copyright 2019 Amazon.com, Inc. or its affiliates. All Rights Reserved."
+)
+__license__ = "MIT-0"
+
+def shadow_message(dispenser_id, count):
+    return {
+        "topic": f"$aws/things/{dispenser_id}/shadow/update/documents",
+        "previous": {"state": {"reported": {"led_ring": {"count": count - 1}}}},
+        "current": {"state": {"reported": {"led_ring": {"count": count}}}},
+    }
+
+
+def messages(count):
+    """Mix of messages from the three logging rules"""
+    result = []
+    for i in range(count):
+        dispenser_id = str(100 + i % 5)
+        if i % 3 == 0:
+            result.append(shadow_message(dispenser_id, i))
+        elif i % 3 == 1:
+            result.append({"topic": f"events/{dispenser_id}", "message": f"event {i}"})
+        else:
+            result.append({"topic": "events", "dispenserId": dispenser_id, "n": i})
+    return result
+
+
+def logged_events():
+    return clients.table(os.environ["EVENT_TABLE"]).scan()["Items"]
+
+
+class UnprocessedDynamoDB:
+    """DynamoDB client that leaves the last items of the first batch
+    unprocessed, as when the table is throttled"""
+
+    def __init__(self, unprocessed):
+        self.client = boto3.client("dynamodb")
+        self.unprocessed = unprocessed
+        self.requests = []
+
+    def batch_write_item(self, RequestItems):
+        ((table_name, requests),) = RequestItems.items()
+        self.requests.append(len(requests))
+        if self.unprocessed:
+            requests, unprocessed = (
+                requests[: -self.unprocessed],
+                requests[-self.unprocessed :],
+            )
+            self.unprocessed = 0
+            self.client.batch_write_item(RequestItems={table_name: requests})
+            return {"UnprocessedItems": {table_name: unprocessed}}
+        return self.client.batch_write_item(RequestItems=RequestItems)
+
+
+def test_direct_message_is_logged(aws):
+    process_events.handler(shadow_message("100", 2), None)
+    (item,) = logged_events()
+    assert item["dispenserId"] == "100"
+    assert "[led_ring][count]" in item["log"]
+    assert item["changes"] == {
+        "added": [],
+        "removed": [],
+        "changed": ["/reported/led_ring/count"],
+    }
+
+
+def test_request_id_is_logged(aws):
+    request_id = "01ARZ3NDEKTSV4RRFFQ69G5FAV"
+    # The dispenser clears the request it responds to
+    process_events.handler(
+        {
+            "topic": "$aws/things/100/shadow/update/documents",
+            "previous": {"state": {"desired": {"request": {"requestId": request_id}}}},
+            "current": {"state": {"reported": {"response": None}}},
+        },
+        None,
+    )
+    process_events.handler(
+        {"topic": "events/100", "message": "Dispensed", "requestId": request_id}, None
+    )
+    process_events.handler({"topic": "events/100", "message": "Other"}, None)
+    assert sorted(item.get("requestId", "") for item in logged_events()) == [
+        "",
+        request_id,
+        request_id,
+    ]
+
+
+def test_batch_is_written_in_batches(stream):
+    event = stream(messages(60))
+    assert process_events.handler(event, None) == {
+        "entries": 60,
+        "requests": 3,
+        "statuses": 5,
+    }
+    items = logged_events()
+    assert len(items) == 60
+    assert {item["dispenserId"] for item in items} == {"100", "101", "102", "103", "104"}
+    assert sum("MQTT: event" in item["log"] for item in items) == 20
+
+
+def test_retried_batch_is_not_duplicated(stream):
+    event = stream(messages(30))
+    process_events.handler(event, None)
+    process_events.handler(event, None)
+    assert len(logged_events()) == 30
+
+
+def test_bad_records_are_skipped(stream):
+    event = stream(messages(3))
+    event["Records"][1]["kinesis"]["data"] = base64.b64encode(b"not json").decode()
+    assert process_events.handler(event, None)["entries"] == 2
+
+
+def test_bad_messages_are_skipped(stream, caplog):
+    bad = shadow_message("100", 1)
+    del bad["previous"], bad["current"]
+    event = stream([*messages(3), bad])
+    assert process_events.handler(event, None) == {"entries": 3, "requests": 1, "statuses": 1}
+    assert len(logged_events()) == 3
+    assert "Could not log message" in caplog.text
+    assert "Could not project message" in caplog.text
+
+
+def test_unprocessed_items_are_resubmitted(stream, monkeypatch):
+    monkeypatch.setattr(batch.retry, "BACKOFF_BASE", 0.001)
+    dynamodb = UnprocessedDynamoDB(unprocessed=10)
+    monkeypatch.setitem(clients._clients, "dynamodb", dynamodb)
+    monkeypatch.setitem(clients._unretried_clients, "dynamodb", dynamodb)
+    process_events.handler(stream(messages(30)), None)
+    assert dynamodb.requests == [25, 10, 5]
+    assert len(logged_events()) == 30
+
+
+def test_unprocessed_items_raise_at_deadline(stream, monkeypatch):
+    dynamodb = UnprocessedDynamoDB(unprocessed=10)
+    monkeypatch.setitem(clients._clients, "dynamodb", dynamodb)
+    monkeypatch.setitem(clients._unretried_clients, "dynamodb", dynamodb)
+    with pytest.raises(batch.UnprocessedItemsError) as e:
+        batch.put_items(
+            os.environ["EVENT_TABLE"],
+            process_events.record_entries(stream(messages(20))["Records"]),
+            deadline=0,
+        )
+    assert len(e.value.items) == 10
+    assert len(logged_events()) == 10
+
+
+def test_shadow_diff():
+    previous = {
+        "desired": {"led": "off", "led_ring": {"count": 1, "color": "#006600"}},
+        "reported": {"a/b": [1, 2, {"x": 1}, 4], "gone": True},
+    }
+    current = {
+        "desired": {"led": "on", "led_ring": {"count": 1, "color": "#006600"}},
+        "reported": {"a/b": [1, 3, {"x": 2}], "new": {"y": 1}},
+    }
+    changes = process_events.diff_shadow(current, previous)
+    assert process_events.structured_diff(changes) == {
+        "added": ["/reported/new"],
+        "removed": ["/reported/gone", "/reported/a~1b/3"],
+        "changed": ["/desired/led", "/reported/a~1b/1", "/reported/a~1b/2/x"],
+    }
+    assert process_events.compare_shadow(current, previous).splitlines() == [
+        'Shadow: Attribute [led] in "desired state" changed from "off" to "on"',
+        "Attribute [new] = {'y': 1} added to \"reported state\"",
+        'Attribute [gone] removed from "reported state"',
+        'Attribute [a/b][3] removed from "reported state"',
+        'Attribute [a/b][1] in "reported state" changed from "2" to "3"',
+        'Attribute [a/b][2][x] in "reported state" changed from "1" to "2"',
+    ]
+    assert process_events.diff_shadow(current, current) == []
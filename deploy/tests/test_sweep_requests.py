@@ -0,0 +1,151 @@
+"""
+Stale dispense request sweeper tests against local DynamoDB and IoT stand-ins
+"""
+
+import json
+import os
+import time
+from decimal import Decimal
+
+import pytest
+
+from conftest import add_lambda_path
+
+pytest.importorskip("moto")
+add_lambda_path("api_dispense")
+add_lambda_path("sweep_requests")
+import dispense  # noqa: E402
+import sweep_requests  # noqa: E402
+from cdd_common import clients, request_slots  # noqa: E402
+
+__copyright__ = (
+    "Copyright 2019 Amazon.com, Inc. or its affiliates. All Rights Reserved."
+)
+__license__ = "MIT-0"
+
+
+def api_event(dispenser_id):
+    return {
+        "requestContext": {
+            "authorizer": {"claims": {"custom:dispenserId": dispenser_id}}
+        },
+        "queryStringParameters": {"dispenserId": dispenser_id},
+    }
+
+
+def dispenser_table():
+    return clients.table(os.environ["DISPENSER_TABLE"])
+
+
+def record(dispenser_id):
+    return dispenser_table().get_item(Key={"dispenserId": dispenser_id})["Item"]
+
+
+def desired(dispenser_id):
+    shadow = json.loads(
+        clients.client("iot-data").get_thing_shadow(thingName=dispenser_id)["payload"].read()
+    )
+    return shadow["state"].get("desired", {})
+
+
+@pytest.fixture
+def dispensers(aws, thing):
+    """Dispensers 100-139 with $2.00 of credits, each with a dispense request"""
+    dispenser_ids = [str(100 + i) for i in range(40)]
+    for dispenser_id in dispenser_ids:
+        thing(dispenser_id)
+        dispenser_table().put_item(
+            Item={"dispenserId": dispenser_id, "credits": Decimal("2.00"), "requests": {}}
+        )
+        dispense.handler(api_event(dispenser_id), None)
+    return dispenser_ids
+
+
+def expire_at():
+    return time.time() + request_slots.COMMAND_TTL["dispense"] + 1
+
+
+def test_in_flight_index_is_sparse(dispensers):
+    request = request_slots.get_slot(record("100"), "dispense")
+    dispense.handler(
+        {
+            "topic": "$aws/things/100/shadow/update/accepted",
+            "state": {
+                "reported": {"response": {"requestId": request.request_id, "result": "success"}}
+            },
+        },
+        None,
+    )
+    assert "inFlight" not in record("100")
+    records, last = request_slots.expired(dispenser_table(), "dispense", expire_at(), limit=100)
+    assert last is None
+    assert sorted(r["dispenserId"] for r in records) == dispensers[1:]
+    # Nothing has expired yet
+    assert request_slots.expired(dispenser_table(), "dispense")[0] == []
+
+
+def test_sweep_clears_expired_requests(dispensers, capsys):
+    assert sweep_requests.sweep(now=time.time()) == 0
+    assert desired("100")["request"] is not None
+
+    assert sweep_requests.sweep(now=expire_at()) == 40
+    for dispenser_id in dispensers:
+        item = record(dispenser_id)
+        assert item["requests"] == {}
+        assert "inFlight" not in item
+        assert item["credits"] == Decimal("2.00")
+        assert desired(dispenser_id).get("request") is None
+    log = clients.table(os.environ["EVENT_TABLE"]).scan()["Items"]
+    assert sum("timed out" in item["log"] for item in log) == 40
+    metrics = [
+        json.loads(line)
+        for line in capsys.readouterr().out.splitlines()
+        if line.startswith("{")
+    ]
+    assert [m["DispenseTimeouts"] for m in metrics] == [0, 40]
+    # The dispensers may request again
+    assert dispense.handler(api_event("100"), None)["body"] == (
+        "Dispenser 100 requested to be activated"
+    )
+
+
+def test_replaced_request_is_kept(dispensers):
+    stale, _ = request_slots.expired(dispenser_table(), "dispense", expire_at(), limit=1)
+    dispenser_id = stale[0]["dispenserId"]
+    # The dispenser's request is replaced between the query and the sweep
+    new_slot = request_slots.RequestSlot.new("9999-9999", "dispense")
+    dispenser_table().update_item(
+        Key={"dispenserId": dispenser_id},
+        UpdateExpression="SET requests.dispense = :slot",
+        ExpressionAttributeValues={":slot": new_slot.to_item()},
+    )
+    assert sweep_requests.clear_slot(dispenser_table(), stale[0]) is None
+    assert request_slots.get_slot(record(dispenser_id), "dispense").request_id == "9999-9999"
+
+
+def test_shadow_with_newer_request_is_kept(dispensers):
+    clients.client("iot-data").update_thing_shadow(
+        thingName="100",
+        payload=json.dumps({"state": {"desired": {"request": {"requestId": "9999-9999"}}}}),
+    )
+    assert sweep_requests.sweep(now=expire_at()) == 40
+    assert desired("100")["request"]["requestId"] == "9999-9999"
+
+
+def test_migrated_legacy_request_is_in_flight(aws):
+    now = time.time()
+    dispenser_table().put_item(
+        Item={
+            "dispenserId": "200",
+            "credits": Decimal("2.00"),
+            "requests": [f"older|dispense|{now - 10}|dispenser", f"newer|dispense|{now}|dispenser"],
+        }
+    )
+    assert request_slots.migrate_record("200", dispenser_table())
+    migrated = record("200")
+    assert migrated["inFlight"] == "dispense"
+    assert float(migrated["inFlightExpiresAt"]) == pytest.approx(
+        now + request_slots.COMMAND_TTL["dispense"]
+    )
+    records, _ = request_slots.expired(dispenser_table(), "dispense", expire_at())
+    assert [r["dispenserId"] for r in records] == ["200"]
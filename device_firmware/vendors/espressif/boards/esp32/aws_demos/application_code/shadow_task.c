@@ -67,6 +67,15 @@
 /* Handle of the shadwow client */
 static ShadowClientHandle_t xClientHandle;
 
+/* Topics of dispense requests sent directly to the dispenser ("command" */
+/* dispense mode) and of the responses to them */
+static const char commandTopic[] = "cmd/" clientcredentialIOT_THING_NAME;
+static const char commandResponseTopic[] = "cmd/" clientcredentialIOT_THING_NAME "/response";
+
+/* True while the current request came in on the command topic, it is then */
+/* answered on the response topic rather than in the shadow */
+static bool command_request = false;
+
 char buffer[ SEND_BUFFER_SIZE ];
 
 static struct State current_state = { DEFAULT_DISPOSE_DURATION, 0, {255, 255, 255}, false, false, {}, 0, 0};
@@ -102,12 +111,25 @@ static const char shadowResponseJSon[] =
         "\"timestamp\":%u"
         "}";
 
+/* Template for the response published to commandResponseTopic */
+static const char commandResponseJSon[] =
+        "{"
+        "\"command\":\"dispense\","
+        "\"requestId\":\"%s\","
+        "\"result\":\"%s\","
+        "\"timestamp\":%u"
+        "}";
+
+static uint32_t prvResponseTimestamp(struct State state){
+    uint32_t ms_passed = TICKS_TO_MS(xTaskGetTickCount()) - state.local_start_timestamp_ms;
+    return state.cloud_start_timestamp_ms + ms_passed;
+}
+
 static void prvShadowResponseBuild(struct State state, bool finished){
     char response_buffer[256] = "";
     TickType_t current_tick_count  = xTaskGetTickCount();
     if (finished){
-        uint32_t ms_passed = TICKS_TO_MS(current_tick_count) - state.local_start_timestamp_ms;
-        sprintf(response_buffer, shadowResponseJSon, state.request_id, "success", state.cloud_start_timestamp_ms + ms_passed);
+        sprintf(response_buffer, shadowResponseJSon, state.request_id, "success", prvResponseTimestamp(state));
     }
 
     sprintf(buffer, shadowReportJSon, state.led_ring_count, state.led_ring_color.r, state.led_ring_color.g, state.led_ring_color.b,
@@ -143,6 +165,16 @@ static json_object_entry * find_key( json_value * o,
     return NULL;
 }
 
+static void prvCopyRequestId(struct State *new_state, json_value * request_id)
+{
+    size_t request_id_length = request_id->u.string.length;
+    if (request_id_length > REQUEST_ID_LENGTH){
+        request_id_length = REQUEST_ID_LENGTH;
+    }
+    strncpy(new_state->request_id, request_id->u.string.ptr, request_id_length);
+    new_state->request_id[request_id_length] = '\0';
+}
+
 void prvPopulateState(json_object_entry* state, struct State *new_state)
 {
     json_object_entry * led_ring = find_key( state->value, "led_ring" );
@@ -182,7 +214,7 @@ void prvPopulateState(json_object_entry* state, struct State *new_state)
         json_object_entry * request_id = find_key( request->value, "requestId" );
         json_object_entry * timestamp = find_key( request->value, "timestamp" );
         if ( request_id ){
-            strncpy(new_state->request_id, request_id->value->u.string.ptr, request_id->value->u.string.length);
+            prvCopyRequestId(new_state, request_id->value);
         }
         if (timestamp){
             new_state->cloud_start_timestamp_ms = timestamp->value->u.integer;
@@ -223,6 +255,78 @@ static BaseType_t prvDeltaCallback( void * pvUserData,
 
 
 
+/* Dispense request published to commandTopic, */
+/* {"command": "dispense", "requestId": "...", "timestamp": ...} */
+static MQTTBool_t prvCommandCallback( void * pvUserData,
+                                      const MQTTPublishData_t * const pxPublishData )
+{
+    ( void ) pvUserData;
+    configPRINTF(( "COMMAND: %.*s\n", pxPublishData->ulDataLength, ( const char * ) pxPublishData->pvData ));
+    struct State new_state = current_state;
+    json_value * val = json_parse( ( const char * ) pxPublishData->pvData, pxPublishData->ulDataLength );
+    if( !val || val->type != json_object )
+    {
+        json_value_free( val );
+        return eMQTTFalse;
+    }
+    json_object_entry * command = find_key( val, "command" );
+    json_object_entry * request_id = find_key( val, "requestId" );
+    json_object_entry * timestamp = find_key( val, "timestamp" );
+
+    if( command && request_id &&
+        strncmp( command->value->u.string.ptr, "dispense", command->value->u.string.length ) == 0 )
+    {
+        new_state.requested = true;
+        prvCopyRequestId(&new_state, request_id->value);
+        if (timestamp){
+            new_state.cloud_start_timestamp_ms = timestamp->value->u.integer;
+        }
+        command_request = true;
+        changeState( new_state );
+    }
+
+    json_value_free( val );
+    /* The buffer is not kept, the MQTT agent frees it */
+    return eMQTTFalse;
+}
+
+/* The shadow client has no API for other topics, its first member is the */
+/* MQTT connection it uses (ShadowClient_t in aws_shadow.c) */
+static MQTTAgentHandle_t prvMqttConnection( void )
+{
+    return *( MQTTAgentHandle_t * ) xClientHandle;
+}
+
+static MQTTAgentReturnCode_t prvSubscribeToCommands( void )
+{
+    MQTTAgentSubscribeParams_t xSubscribeParams;
+
+    memset( &xSubscribeParams, 0, sizeof( xSubscribeParams ) );
+    xSubscribeParams.pucTopic = ( const uint8_t * ) commandTopic;
+    xSubscribeParams.usTopicLength = ( uint16_t ) strlen( commandTopic );
+    xSubscribeParams.xQoS = eMQTTQoS1;
+    xSubscribeParams.pvPublishCallbackContext = NULL;
+    xSubscribeParams.pxPublishCallback = prvCommandCallback;
+    return MQTT_AGENT_Subscribe( prvMqttConnection(), &xSubscribeParams, MQTT_TIMEOUT * 3 );
+}
+
+static void prvPublishCommandResponse( struct State state )
+{
+    char response_buffer[256];
+    MQTTAgentPublishParams_t xPublishParams;
+    MQTTAgentReturnCode_t xReturn;
+
+    sprintf(response_buffer, commandResponseJSon, state.request_id, "success", prvResponseTimestamp(state));
+    memset( &xPublishParams, 0, sizeof( xPublishParams ) );
+    xPublishParams.pucTopic = ( const uint8_t * ) commandResponseTopic;
+    xPublishParams.usTopicLength = ( uint16_t ) strlen( commandResponseTopic );
+    xPublishParams.xQoS = eMQTTQoS1;
+    xPublishParams.pvData = response_buffer;
+    xPublishParams.ulDataLength = ( uint32_t ) strlen( response_buffer );
+    xReturn = MQTT_AGENT_Publish( prvMqttConnection(), &xPublishParams, MQTT_TIMEOUT * 2 );
+    configPRINTF(( "Command response publish return: %d\n", xReturn ));
+}
+
 static ShadowReturnCode_t prvGetState()
 {
     ShadowOperationParams_t xOperationParams;
@@ -329,6 +433,11 @@ void xShadowTask( void * param )
 
         if( xReturn == eShadowSuccess )
         {
+            if( prvSubscribeToCommands() != eMQTTAgentSuccess )
+            {
+                configPRINTF(( "Subscribe to %s unsuccessful\n", commandTopic ));
+            }
+
             /* Receive the current shadow state */
             xReturn = prvGetState();
             /*            if (xReturn != eShadowSuccess) return; */
@@ -339,7 +448,13 @@ void xShadowTask( void * param )
             {
 //                if( xSemaphoreTake( motorStopSema, 0 ) == pdTRUE ) /* reset desired */
                 xSemaphoreTake( motorTaskUpdateStateSema, portMAX_DELAY );/* reset desired */
-                if (current_state.requested){
+                if (current_state.requested && command_request){
+                    current_state.requested = false;
+                    command_request = false;
+                    prvPublishCommandResponse(current_state);
+                    prvShadowResponseBuild(current_state, false);
+                }
+                else if (current_state.requested){
                     current_state.requested = false;
                     prvShadowResponseBuild(current_state, true);
                 }
@@ -6,6 +6,9 @@
 
 void xShadowTask( void * param );
 
+// Request ids are ULIDs, 26 characters
+#define REQUEST_ID_LENGTH 26
+
 struct State
 {
     uint32_t dispense_time_ms;
@@ -17,7 +20,7 @@ struct State
     } led_ring_color;
     bool led_state;
     bool requested;
-    char request_id[10];
+    char request_id[REQUEST_ID_LENGTH + 1];
     uint32_t cloud_start_timestamp_ms;
     uint32_t local_start_timestamp_ms; // Is necessary since we don't use RTC and we can only rely on FreeRTOS ticks;
 };